@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+# Activity index: per-second summary of a recording in a small sidecar file (same name, .activity),
+# so the active parts of a long recording are found without reading the audio
+
+import sys
+import time
+import struct
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+# File layout: header (magic, sample rate, channels), then one record per second of audio:
+#   rms, peak: dBFS*100, snr: dB*100 (spectral peak above the median of the spectrum), flatness: 0..1 scaled to 0..65535,
+#   clips: samples at the full scale
+MAGIC = b'ACT1'
+HEADER = struct.Struct('<4sIH2x')
+record_dtype = np.dtype([("rms", "<i2"), ("peak", "<i2"), ("snr", "<i2"), ("flatness", "<u2"), ("clips", "<u2")])
+
+
+def summarize(samples: np.ndarray, fft_size: int = 2048) -> np.ndarray:
+    # samples: int16 (seconds, frames, channels), all seconds are processed with one set of vectorized calls.
+    # The spectrum of each second is the average of its fft_size blocks (Welch), the DC bin is not used
+    seconds, frames, _ = samples.shape
+    x = samples.astype(np.float32)
+    records = np.zeros(seconds, dtype=record_dtype)
+    power = np.einsum('ijk,ijk->i', x, x)/x[0].size
+    records["rms"] = np.round(100*10*np.log10(power/(32768.0*32768.0) + 1e-12))
+    magnitude = np.abs(x)
+    records["peak"] = np.round(100*20*np.log10(magnitude.max(axis=(1, 2))/32768.0 + 1e-6))
+    records["clips"] = np.minimum(np.count_nonzero(magnitude >= 32767, axis=(1, 2)), 65535)
+
+    blocks = frames // fft_size
+    if blocks > 0:
+        mono = x.mean(axis=2)[:, :blocks*fft_size].reshape(seconds, blocks, fft_size)
+        spectrum = np.fft.rfft(mono*np.hanning(fft_size).astype(np.float32), axis=-1)
+        spectrum = (spectrum.real**2 + spectrum.imag**2).mean(axis=1)[:, 1:] + 1e-6
+        flatness = np.exp(np.log(spectrum).mean(axis=1))/spectrum.mean(axis=1)
+        records["flatness"] = np.round(np.clip(flatness, 0.0, 1.0)*65535)
+        records["snr"] = np.round(100*10*np.log10(spectrum.max(axis=1)/np.median(spectrum, axis=1)))
+    return records
+
+
+class ActivityWriter:
+    # Fed with the audio as it is written, the complete seconds are summarized together, the rest is kept for the next call
+    def __init__(self, filename: str, samplerate: int, channels: int, fft_size: int = 2048):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.fft_size = fft_size
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(MAGIC, samplerate, channels))
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.seconds = 0
+        self.cost = 0.0
+
+    def process(self, data: bytes):
+        t_start = time.perf_counter()
+        x = np.frombuffer(data, dtype=np.int16)
+        if len(self.remainder) > 0:
+            x = np.concatenate((self.remainder, x))
+        second = self.samplerate*self.channels
+        seconds = len(x) // second
+        self.remainder = x[seconds*second:].copy()
+        if seconds > 0:
+            self._write(x[:seconds*second].reshape(seconds, self.samplerate, self.channels))
+        self.cost += time.perf_counter() - t_start
+
+    def close(self):
+        # The last part of a second is summarized as a whole second
+        frames = len(self.remainder) // self.channels
+        if frames >= self.fft_size:
+            self._write(self.remainder[:frames*self.channels].reshape(1, frames, self.channels))
+        self.file.close()
+
+    def stats(self) -> Dict:
+        return {"activity_seconds": self.seconds, "activity_cost_us": round(1e6*self.cost/self.seconds, 1) if self.seconds > 0 else 0.0}
+
+    def _write(self, samples: np.ndarray):
+        self.file.write(summarize(samples, self.fft_size).tobytes())
+        self.seconds += samples.shape[0]
+
+
+def read_activity(path: str) -> Tuple[int, int, np.ndarray]:
+    # Sample rate, channels and the records
+    with open(path, 'rb') as f:
+        magic, samplerate, channels = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not an activity index".format(path))
+        data = f.read()
+    return samplerate, channels, np.frombuffer(data[:len(data) - len(data) % record_dtype.itemsize], dtype=record_dtype)
+
+
+def active_segments(records: np.ndarray, level_db: float = 6.0, snr_db: float = 20.0, merge_gap: int = 2, min_length: int = 1) -> List[Tuple[int, int]]:
+    # [start, end) seconds, where the level is level_db above the noise floor (20th percentile of the file)
+    # or the spectrum has a peak snr_db above its median (a carrier with AGC). Gaps up to merge_gap seconds are joined
+    if len(records) == 0:
+        return []
+    rms = records["rms"]/100.0
+    active = (rms >= np.percentile(rms, 20) + level_db) | (records["snr"]/100.0 >= snr_db)
+    edges = np.diff(np.concatenate(([0], active.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    segments: List[List[int]] = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if len(segments) > 0 and start - segments[-1][1] <= merge_gap:
+            segments[-1][1] = end
+        else:
+            segments.append([start, end])
+    return [(start, end) for start, end in segments if end - start >= min_length]
+
+
+def describe_segments(records: np.ndarray, segments: List[Tuple[int, int]], samplerate: int, block_align: int,
+                      data_offset: Optional[int] = None, data_size: Optional[int] = None) -> List[Dict]:
+    # Segment summaries, with the byte ranges in the WAV file if data_offset is known (not for FLAC)
+    result = []
+    for start, end in segments:
+        part = records[start:end]
+        segment = {"start": start, "end": end, "peak_db": round(float(part["peak"].max())/100.0, 1), "rms_db": round(float(part["rms"].max())/100.0, 1),
+                   "snr_db": round(float(part["snr"].max())/100.0, 1), "clips": int(part["clips"].astype(np.int64).sum())}
+        if data_offset is not None:
+            begin = start*samplerate*block_align
+            stop = end*samplerate*block_align if data_size is None else min(end*samplerate*block_align, data_size)
+            segment.update(offset=data_offset + begin, length=max(0, stop - begin))
+        result.append(segment)
+    return result
+
+
+def benchmark(samplerate: int = 48000, channels: int = 2, seconds: int = 600):
+    # Summary cost per second of audio, the data is fed in 0.5s blocks as the capture worker writes it
+    rng = np.random.default_rng(1)
+    t = np.arange(samplerate*10)/samplerate
+    block = (rng.normal(0, 100, len(t)) + 5000*np.sin(2*np.pi*700*t)*((t > 4) & (t < 7))).astype(np.int16)
+    data = np.repeat(np.tile(block, seconds//10), channels).tobytes()
+    writer = ActivityWriter("/dev/null", samplerate, channels)
+    step = samplerate*channels
+    t_start = time.perf_counter()
+    for pos in range(0, len(data), step):
+        writer.process(data[pos:pos + step])
+    duration = time.perf_counter() - t_start
+    records = summarize(np.frombuffer(data[:2*step*10], dtype=np.int16).reshape(10, samplerate, channels))
+    print("{}s of {} Hz x {}: {:.3f}s, {:.0f} us per second, segments of the first 10s: {}".format(
+        seconds, samplerate, channels, duration, 1e6*duration/seconds, active_segments(records)))
+
+
+if __name__ == "__main__":
+    # python3 activity.py [samplerate] [channels]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 48000, int(sys.argv[2]) if len(sys.argv) > 2 else 2)
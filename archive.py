@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+
+# Archive of the finished recordings: WAV -> FLAC conversion in low priority processes, and the disk budget
+
+import os
+import sys
+import time
+import queue
+import hashlib
+import logging
+import collections
+import multiprocessing
+from typing import Deque, Dict, List, Set, Tuple
+import catalog
+import utils
+import storage
+
+try:
+    import soundfile  # sudo pip3 install soundfile
+except ImportError:
+    soundfile = None
+
+
+def convert_supported() -> bool:
+    return soundfile is not None
+
+
+def convert_to_flac(path: str, block_frames: int = 65536) -> Dict:
+    # The FLAC file is decoded again and compared with the WAV data before the WAV is deleted.
+    # The FLAC gets the WAV modification time, so the catalog date and the retention order are kept
+    flac_path = os.path.splitext(path)[0] + ".flac"
+    tmp_path = flac_path + ".tmp"
+    if os.path.exists(flac_path):
+        raise ValueError("{} already exists".format(os.path.basename(flac_path)))
+    digest = hashlib.sha1()
+    with soundfile.SoundFile(path) as src:
+        if src.subtype != "PCM_16":
+            raise ValueError("{}: {} is not supported".format(os.path.basename(path), src.subtype))
+        frames = src.frames
+        with soundfile.SoundFile(tmp_path, 'w', samplerate=src.samplerate, channels=src.channels, format='FLAC', subtype='PCM_16') as dst:
+            for block in src.blocks(blocksize=block_frames, dtype='int16'):
+                digest.update(block.tobytes())
+                dst.write(block)
+        samplerate = src.samplerate
+
+    check = hashlib.sha1()
+    with soundfile.SoundFile(tmp_path) as f:
+        decoded = f.frames
+        for block in f.blocks(blocksize=block_frames, dtype='int16'):
+            check.update(block.tobytes())
+    if decoded != frames or check.digest() != digest.digest():
+        os.remove(tmp_path)
+        raise ValueError("{}: FLAC verification failed".format(os.path.basename(path)))
+
+    st = os.stat(path)
+    os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp_path, flac_path)
+    os.remove(path)
+    return {"flac": os.path.basename(flac_path), "bytes_in": st.st_size, "bytes_out": os.path.getsize(flac_path),
+            "audio_seconds": frames/samplerate if samplerate > 0 else 0.0}
+
+
+def archive_worker(folder: str, job_queue: multiprocessing.Queue, result_queue: multiprocessing.Queue):
+    # One of the conversion processes, with the lowest CPU and IO priority
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s] (ARCH)  %(message)s')
+    utils.set_low_priority()
+    while True:
+        name = job_queue.get()
+        if name is None:
+            break
+        t_start = time.monotonic()
+        try:
+            result = convert_to_flac(os.path.join(folder, name))
+            result.update(name=name, duration=time.monotonic() - t_start)
+            logging.debug("%s -> %s: %.1fs, %d%% of the size", name, result["flac"], result["duration"], 100*result["bytes_out"]//max(1, result["bytes_in"]))
+        except (OSError, RuntimeError, ValueError) as e:
+            # soundfile errors are RuntimeError
+            logging.error("Archive %s error: %s", name, e)
+            result = {"name": name, "error": str(e)}
+        result_queue.put(result)
+
+
+def pool_size() -> int:
+    # One core is left for the capture
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    return max(1, cores - 1)
+
+
+class Archiver:
+    # Recorder side of the archive. Not more than one job per process is given to the workers, the rest waits in the queue,
+    # so no new conversion is started while recording. After the changes, the oldest not starred recordings are deleted
+    # while the recordings take more than budget bytes (0 - no limit)
+    def __init__(self, folder: str, recordings: catalog.RecordingsCatalog, convert: bool = True, budget: int = 0, processes: int = 0,
+                 rate_window: float = 60.0):
+        self.folder = folder
+        self.recordings = recordings
+        self.convert = convert and convert_supported()
+        if convert and self.convert is False:
+            logging.debug("FLAC encoder is not available (pip3 install soundfile), recordings are not archived")
+        self.budget = budget
+        self.processes = processes or pool_size()
+        self.rate_window = rate_window
+        self.job_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.workers: List[multiprocessing.Process] = []
+        self.queue: Deque[str] = collections.deque()
+        self.running: Set[str] = set()
+        self.done: Deque[Tuple[float, int]] = collections.deque()  # Time and WAV size of the recent conversions
+        self.converted = 0
+        self.failed = 0
+        self.saved_bytes = 0
+        self.audio_seconds = 0.0
+        self.busy_seconds = 0.0
+        self.pruned = 0
+        self.budget_check = True
+
+    def start(self):
+        # The WAV files left from the previous runs are queued too
+        if self.convert:
+            for _ in range(self.processes):
+                process = multiprocessing.Process(target=archive_worker, args=(self.folder, self.job_queue, self.result_queue), daemon=True)
+                process.start()
+                self.workers.append(process)
+            self.add([name for name, _ in self.recordings.oldest(limit=1000000, extension=".wav")])
+            logging.debug("Archive: %d processes, %d files queued", self.processes, len(self.queue))
+
+    def add(self, names: List[str]):
+        if self.convert:
+            known = self.running.union(self.queue)
+            self.queue.extend(name for name in names if name.endswith(".wav") and name not in known)
+        self.budget_check = True
+
+    def update(self, paused: bool) -> bool:
+        # Called periodically. True if the catalog was changed
+        changed = False
+        while True:
+            try:
+                result = self.result_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.running.discard(result["name"])
+            if "error" in result:
+                self.failed += 1
+                continue
+            self.recordings.replace_file(result["name"], result["flac"])
+            self.converted += 1
+            self.saved_bytes += result["bytes_in"] - result["bytes_out"]
+            self.audio_seconds += result["audio_seconds"]
+            self.busy_seconds += result["duration"]
+            self.done.append((time.monotonic(), result["bytes_in"]))
+            self.budget_check = changed = True
+
+        while self.convert and paused is False and len(self.queue) > 0 and len(self.running) < self.processes:
+            name = self.queue.popleft()
+            self.running.add(name)
+            self.job_queue.put(name)
+
+        if self.budget > 0 and self.budget_check:
+            self.budget_check = False
+            changed = self.enforce_budget() > 0 or changed
+        return changed
+
+    def enforce_budget(self) -> int:
+        # Oldest first, the starred recordings and the files being converted are kept
+        total, removed = self.recordings.total_size(), 0
+        failed: Set[str] = set()  # Not deleted, they stay in the catalog
+        while total > self.budget:
+            candidates = [(name, size) for name, size in self.recordings.oldest(limit=len(failed) + 50, starred=False)
+                          if name not in self.running and name not in failed]
+            if len(candidates) == 0:
+                logging.warning("Archive: the recordings take %d MB, the budget is %d MB, but the rest is starred, being converted or cannot be deleted",
+                                total//(1024*1024), self.budget//(1024*1024))
+                break
+            for name, size in candidates:
+                if total <= self.budget:
+                    break
+                try:
+                    storage.remove_recording(os.path.join(self.folder, name))
+                except OSError as e:
+                    logging.error("Archive: cannot delete %s: %s", name, e)
+                    failed.add(name)
+                    continue
+                self.recordings.remove_file(name)
+                if name in self.queue:
+                    self.queue.remove(name)
+                total -= size
+                removed += 1
+                logging.debug("Archive: %s deleted, over the disk budget", name)
+        self.pruned += removed
+        return removed
+
+    def status(self) -> Dict:
+        now = time.monotonic()
+        while len(self.done) > 0 and self.done[0][0] < now - self.rate_window:
+            self.done.popleft()
+        return {"queued": len(self.queue), "converting": len(self.running), "converted": self.converted, "failed": self.failed,
+                "saved_mb": self.saved_bytes//(1024*1024), "rate_kbps": round(sum(size for _, size in self.done)/self.rate_window/1024, 1),
+                "speed": round(self.audio_seconds/self.busy_seconds, 1) if self.busy_seconds > 0 else 0.0,
+                "pruned": self.pruned, "budget_mb": self.budget//(1024*1024)}
+
+    def close(self):
+        for _ in self.workers:
+            self.job_queue.put(None)
+        self.workers = []
+
+
+if __name__ == "__main__":
+    # python3 archive.py FILE.wav - convert one file, prints the speed
+    t_start = time.monotonic()
+    print(convert_to_flac(sys.argv[1]), "{:.2f}s".format(time.monotonic() - t_start))
@@ -1,11 +1,16 @@
 import pyaudio
-import wave
-from typing import Tuple, Optional, Union, Any
+from typing import Tuple, Optional, Union, Any, List
 import multiprocessing
+import time
+import queue
 import fnmatch
 from datetime import datetime
 import os
 import logging
+from ringbuffer import RingBuffer
+from wavwriter import SegmentedWavWriter
+import encoder
+import metrics
 
 
 def set_logger(level):
@@ -13,7 +18,7 @@ def set_logger(level):
 
 
 def get_files_list(folder: str):
-    return fnmatch.filter(os.listdir(folder), '*.wav')
+    return [name for name in os.listdir(folder) if fnmatch.fnmatch(name, '*.wav') or fnmatch.fnmatch(name, '*.flac')]
 
 
 def list_audio_devices(pd: pyaudio.PyAudio):
@@ -44,43 +49,169 @@ def interface_connected(pd: pyaudio.PyAudio, filter: str) -> str:
     return device_name if device_index >= 0 else ""
 
 
-def audio_recording_thread(pd: pyaudio.PyAudio, audio_device: str, recording_channels: int, recording_samplerate: int, t_name: str, t_frequency: int, stop_event: multiprocessing.Event):
-    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s] (REC)  %(message)s')
-    logging.debug("Audio devices:")
-    list_audio_devices(pd)
-    logging.debug("")
-
-    device_index, device_name = find_audio_device(pd, audio_device)
-    if device_index == -1:
-        logging.debug("Rec aborted: device %s is not found", audio_device)
-        return
-
-    chunk_size = 4096
-    stream = pd.open(format=pyaudio.paInt16, channels=recording_channels, rate=recording_samplerate,
-                    frames_per_buffer=chunk_size, input_device_index=device_index, input=True)
-
-    filename = "{}_{}_{}kHz_AF.wav".format(t_name, datetime.now().strftime("%Y%m%d_%H%M%SZ"), t_frequency//1000)
-    wf = wave.open(filename, 'wb')
-    wf.setnchannels(recording_channels)
-    wf.setframerate(recording_samplerate)
-    wf.setsampwidth(pd.get_sample_size(pyaudio.paInt16))
-
-    logging.debug('Recording the file {}, device #{} {}'.format(filename, device_index, device_name))
-    size_total, index = 0, 0
-    while stop_event.is_set() is False:  # recording_active is True and app_active is True:
-        data = stream.read(chunk_size)
-        wf.writeframes(data)
-
-        size_total += len(data)
-        index += 1
-        if index == 8:
-            logging.debug("Recording: {} KBytes recorded".format(size_total//1024))
-            index = 0
-
-    # Stop and close the stream
-    stream.stop_stream()
+class PortAudio:
+    # PortAudio instance of the recorder, for the device status only (each capture process has its own).
+    # It is created in the background after the start: the initialization probes all ALSA devices and takes about a second on a Pi.
+    # PortAudio sees only the devices present at the initialization, so on a sound card hotplug it is reset and created again
+    def __init__(self):
+        self.pd: Optional[pyaudio.PyAudio] = None
+        self.init_time = 0.0
+
+    def get(self) -> pyaudio.PyAudio:
+        if self.pd is None:
+            t_start = time.monotonic()
+            self.pd = pyaudio.PyAudio()
+            self.init_time = time.monotonic() - t_start
+        return self.pd
+
+    def reset(self):
+        pd, self.pd = self.pd, None
+        if pd is not None:
+            pd.terminate()
+
+    def interface_connected(self, filter: str) -> str:
+        # "" also while PortAudio is not initialized yet
+        return interface_connected(self.pd, filter) if self.pd is not None else ""
+
+
+capture_buffer_seconds = 10.0
+
+
+class AudioCapture:
+    # PortAudio input stream in a callback mode. The callback only copies data to the ring buffer,
+    # all disk writes are done by the reader in large batches, so an SD card stall is absorbed by the buffer
+    # instead of overflowing the PortAudio input
+    def __init__(self, pd: pyaudio.PyAudio, device_index: int, channels: int, samplerate: int, buffer_seconds: float = capture_buffer_seconds, chunk_size: int = 4096):
+        self.pd = pd
+        self.channels = channels
+        self.samplerate = samplerate
+        self.sample_width = pd.get_sample_size(pyaudio.paInt16)
+        self.frame_size = channels*self.sample_width
+        self.ring = RingBuffer(int(buffer_seconds*samplerate)*self.frame_size, self.frame_size)
+        self.input_overflows = 0
+        self.block_time = time.monotonic()
+        # Second buffer for the spectrum analyzer, filled only if it is enabled
+        self.tap = RingBuffer(samplerate*self.frame_size, self.frame_size)
+        self.tap_enabled = False
+        # Third one for the live listening
+        self.monitor = RingBuffer(samplerate*self.frame_size, self.frame_size)
+        self.monitor_enabled = False
+        # Duration of the callback, it must never be longer than the PortAudio buffer
+        self.callback_time = metrics.Histogram()
+        self.stream = pd.open(format=pyaudio.paInt16, channels=channels, rate=samplerate, frames_per_buffer=chunk_size,
+                              input_device_index=device_index, input=True, stream_callback=self._on_audio_data)
+
+    def _on_audio_data(self, in_data, frame_count, time_info, status_flags):
+        t_start = time.perf_counter()
+        if status_flags & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+        self.ring.write(in_data)
+        if self.tap_enabled:
+            self.tap.write(in_data)
+        if self.monitor_enabled:
+            self.monitor.write(in_data)
+        self.block_time = time.monotonic()
+        self.callback_time.observe(time.perf_counter() - t_start)
+        return None, pyaudio.paContinue
+
+    def read(self) -> bytes:
+        return self.ring.read(self.ring.size)
+
+    def frames_read(self) -> int:
+        return self.ring.read_pos // self.frame_size
+
+    def frame_at(self, t: float) -> int:
+        # Stream position (in frames) at the time.monotonic() moment t, estimated from the last callback time
+        frames_captured = self.ring.write_pos // self.frame_size
+        return max(0, frames_captured - int((self.block_time - t)*self.samplerate))
+
+    def stats(self) -> dict:
+        stats = self.ring.stats()
+        stats["input_overflows"] = self.input_overflows
+        return stats
+
+    def close(self):
+        self.stream.stop_stream()
+        self.pd.close(self.stream)
+
+
+class TuningTracker:
+    # Transceiver frequency/mode changes during the recording. Each change is placed at its stream frame position
+    # and either starts a new file (split=True) or is added to the segment index
+    def __init__(self, t_name: str, t_frequency: int, t_mode: str, tuning_queue: Optional[multiprocessing.Queue], split: bool = False):
+        self.state = {"name": t_name, "frequency": t_frequency, "mode": t_mode}
+        self.tuning_queue = tuning_queue
+        self.split = split
+        self.pending: List[Tuple[int, dict]] = []
+
+    def poll(self, capture: AudioCapture):
+        while self.tuning_queue is not None:
+            try:
+                update = self.tuning_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.append((capture.frame_at(update.pop("time")), update))
+
+    def discard(self, before_frame: int):
+        # Changes before the file start are only applied to the current state
+        while len(self.pending) > 0 and self.pending[0][0] < before_frame:
+            self.state.update(self.pending.pop(0)[1])
+
+    def write(self, wf: SegmentedWavWriter, data: bytes, start_frame: int):
+        # Write a data block starting at the stream position start_frame, split at the tuning changes inside it
+        frames, pos = len(data) // wf.frame_size, 0
+        while len(self.pending) > 0 and self.pending[0][0] < start_frame + frames:
+            frame, update = self.pending.pop(0)
+            split_pos = max(pos, frame - start_frame)
+            wf.writeframes(data[pos*wf.frame_size:split_pos*wf.frame_size])
+            pos = split_pos
+            self._apply(wf, update)
+        wf.writeframes(data[pos*wf.frame_size:])
+
+    def _apply(self, wf: SegmentedWavWriter, update: dict):
+        changed = {k: v for k, v in update.items() if self.state.get(k) != v}
+        if len(changed) == 0:
+            return
+        self.state.update(changed)
+        logging.debug("Tuning changed at frame %d: %s", wf.frames_written(), changed)
+        if self.split:
+            wf.new_segment()
+        else:
+            wf.write_event(changed)
+
+
+def create_recording_file(tuning: TuningTracker, channels: int, samplerate: int, sample_width: int, writer_options: Optional[dict] = None,
+                          folder: str = "") -> Tuple[str, SegmentedWavWriter]:
+    # folder: the recordings folder, the one indexed by the catalog
+    def make_filename():
+        return os.path.join(folder, "{}_{}_{}kHz_AF.wav".format(tuning.state["name"], datetime.now().strftime("%Y%m%d_%H%M%SZ"), tuning.state["frequency"]//1000))
+
+    def segment_info():
+        return {"frequency": tuning.state["frequency"], "mode": tuning.state["mode"]}
+
+    options = dict(writer_options or {})
+    writer_class = SegmentedWavWriter
+    if options.pop("format", "wav") == "flac":
+        if encoder.flac_supported():
+            writer_class = encoder.FlacSegmentWriter
+        else:
+            logging.debug("FLAC encoder is not available (pip3 install soundfile), recording to WAV")
+    wf = writer_class(make_filename, channels, samplerate, sample_width, segment_info=segment_info, **options)
+    return wf.filename, wf
+
+
+def pin_to_core(core: Optional[int]):
+    # Capture worker of each station runs on its own core
+    if core is not None and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, {core})
+        except OSError as e:
+            logging.debug("Cannot pin to core %d: %s", core, e)
 
-    pd.close(stream)
-    wf.close()
 
-    logging.debug("Recording complete")
+def send_stats(stats_queue: Optional[multiprocessing.Queue], stats: dict):
+    if stats_queue is not None:
+        try:
+            stats_queue.put_nowait(stats)
+        except queue.Full:
+            pass
@@ -0,0 +1,461 @@
+#!/usr/bin/python3
+
+# Benchmarks and soak tests without the hardware: a simulated audio interface (fake PyAudio) and a simulated CI-V radio on a pty.
+# Each scenario runs in its own process with the real capture worker, transceiver reader and status code.
+# python3 bench.py [capture] [civ] [status] [--seconds N] [--output results.jsonl]
+# python3 bench.py compare old.jsonl new.jsonl
+
+import os
+import sys
+import pty
+import json
+import time
+import queue
+import shutil
+import socket
+import tempfile
+import platform
+import argparse
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.connection import Connection
+import numpy as np
+from typing import Any, Callable, Dict, List, Optional
+import pyaudio
+import civ
+import storage
+
+
+def latency_stats(values: List[float], prefix: str) -> Dict:
+    # Percentiles of all values, not only of the last ones as in storage.LatencyStats
+    stats = storage.LatencyStats(max(1, len(values)))
+    for value in values:
+        stats.add(value)
+    return stats.stats(prefix)
+
+
+def process_rss(pid: int) -> int:
+    # Resident memory of a process in KBytes, 0 if not available (not Linux)
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+# Simulated audio interface
+
+class FakeStream:
+    # Input stream in the callback mode, like PortAudio: a thread calls the callback every frames_per_buffer frames
+    # at the real time pace (or speed times faster). The signal is deterministic: noise with a 700 Hz tone from 4s to 7s of each 10s.
+    # If the callback is late for more than max_latency seconds, the late blocks are dropped and paInputOverflow is set, as the hardware does
+    def __init__(self, channels: int, rate: int, frames_per_buffer: int, stream_callback: Callable, speed: float = 1.0, max_latency: float = 0.2, seed: int = 1):
+        self.channels = channels
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+        self.callback = stream_callback
+        self.speed = speed
+        self.max_latency = max_latency
+        rng = np.random.default_rng(seed)
+        t = np.arange(rate*10)/rate
+        mono = rng.normal(0, 100, len(t)) + 5000*np.sin(2*np.pi*700*t)*((t > 4) & (t < 7))
+        self.signal = np.repeat(mono.astype(np.int16), channels).tobytes()
+        self.frames = 0
+        self.overflows = 0
+        self.active = True
+        self.thread = threading.Thread(target=self._run, name="FakeStream", daemon=True)
+        self.thread.start()
+
+    def block(self, frames: int) -> bytes:
+        frame_size = 2*self.channels
+        start = (self.frames % (len(self.signal)//frame_size))*frame_size
+        data = self.signal[start:start + frames*frame_size]
+        if len(data) < frames*frame_size:
+            data += self.signal[:frames*frame_size - len(data)]
+        return data
+
+    def _run(self):
+        t_start = time.monotonic()
+        block_time = self.frames_per_buffer/self.rate/self.speed
+        while self.active:
+            due = t_start + self.frames/self.rate/self.speed + block_time
+            now = time.monotonic()
+            if due > now:
+                time.sleep(due - now)
+                now = time.monotonic()
+            flags = 0
+            late = int((now - due - self.max_latency)/block_time)
+            if late > 0:
+                self.frames += late*self.frames_per_buffer
+                self.overflows += 1
+                flags = pyaudio.paInputOverflow
+            self.callback(self.block(self.frames_per_buffer), self.frames_per_buffer, {}, flags)
+            self.frames += self.frames_per_buffer
+
+    def stop_stream(self):
+        self.active = False
+        self.thread.join()
+
+
+class FakePyAudio:
+    # Replaces pyaudio.PyAudio (install_fake_audio), so audio.find_audio_device finds the device and pd.open returns a FakeStream
+    device_name = "USB Audio CODEC (simulated)"
+    speed = 1.0
+
+    def get_device_count(self) -> int:
+        return 1
+
+    def get_device_info_by_host_api_device_index(self, host_api: int, index: int) -> Dict:
+        return {"index": index, "name": self.device_name, "maxInputChannels": 2}
+
+    def get_sample_size(self, sample_format: int) -> int:
+        return 2
+
+    def open(self, format: int, channels: int, rate: int, frames_per_buffer: int = 1024, input_device_index: Optional[int] = None, input: bool = True,
+             stream_callback: Optional[Callable] = None) -> FakeStream:
+        return FakeStream(channels, rate, frames_per_buffer, stream_callback, self.speed)
+
+    def close(self, stream: FakeStream):
+        stream.active = False
+
+    def terminate(self):
+        pass
+
+
+def install_fake_audio(speed: float = 1.0):
+    # Before the capture process is started: the forked process creates its PyAudio from the patched module
+    FakePyAudio.speed = speed
+    pyaudio.PyAudio = FakePyAudio
+
+
+# Simulated CI-V radio
+
+class RadioSimulator:
+    # IC-705 on a pseudo terminal: answers the poll requests of transceiver.create_poller and sends the transceive
+    # frequency broadcasts (00h) while the VFO is rotated. The bytes are paced at the baudrate, as on the real CI-V bus.
+    # The send time of each frequency is kept, to measure the latency up to the recorder
+    def __init__(self, address: int = 0xA4, baudrate: int = 19200, reply_delay: float = 0.005):
+        self.address = address
+        self.byte_time = 10.0/baudrate
+        self.reply_delay = reply_delay
+        self.master, slave = pty.openpty()
+        self.port_name = os.ttyname(slave)
+        self.slave = slave
+        self.frequency = 7074000
+        self.mode = 1
+        self.lock = threading.Lock()
+        self.sent_times: Dict[int, float] = {}
+        self.requests = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.active = True
+        self.reader = threading.Thread(target=self._answer_requests, name="RadioSim", daemon=True)
+        self.reader.start()
+
+    def frame(self, to: int, cmd: bytes) -> bytes:
+        return bytes([civ.PREAMBLE, civ.PREAMBLE, to, self.address]) + cmd + bytes([civ.END])
+
+    def send(self, data: bytes):
+        with self.lock:
+            os.write(self.master, data)
+            self.frames_sent += 1
+            self.bytes_sent += len(data)
+        # The port is busy while the frame is sent
+        time.sleep(len(data)*self.byte_time)
+
+    def tune(self, step: int = 10):
+        # One VFO step, sent as a transceive broadcast
+        self.frequency += step
+        self.sent_times[self.frequency] = time.time()
+        self.send(self.frame(civ.BROADCAST, b'\x00' + civ.encode_frequency(self.frequency)))
+
+    def answer(self, request: civ.CivFrame) -> bytes:
+        key = bytes([request.cmd]) + request.data
+        answers = {b'\x03': b'\x03' + civ.encode_frequency(self.frequency), b'\x04': bytes([0x04, self.mode, 0x01]),
+                   b'\x15\x02': b'\x15\x02\x01\x20', b'\x1A\x03': b'\x1A\x03\x31', b'\x16\x02': b'\x16\x02\x01', b'\x11': b'\x11\x00',
+                   b'\x14\x02': b'\x14\x02\x02\x55'}
+        return self.frame(civ.CONTROLLER, answers.get(key, bytes([civ.NG])))
+
+    def _answer_requests(self):
+        decoder = civ.CivDecoder()
+        while self.active:
+            try:
+                data = os.read(self.master, 256)
+            except OSError:
+                break
+            for request in decoder.feed(data):
+                if request.to == self.address and request.src == civ.CONTROLLER:
+                    self.requests += 1
+                    time.sleep(self.reply_delay)
+                    self.send(self.answer(request))
+
+    def close(self):
+        self.active = False
+        os.close(self.master)
+        os.close(self.slave)
+
+
+# Scenarios, each one returns a flat dict of the results
+
+def capture_scenario(seconds: float = 30.0, samplerate: int = 48000, channels: int = 2, speed: float = 1.0, segment_seconds: float = 0.0,
+                     fsync_interval: float = 10.0, folder: Optional[str] = None) -> Dict:
+    # Real capture worker with the simulated audio interface: throughput, drops, buffer use, write latency and memory growth.
+    # For a soak test, use a long duration with segment_seconds, the finished segments are deleted during the test
+    import worker
+    install_fake_audio(speed)
+    work_dir = tempfile.mkdtemp(prefix="bench_", dir=folder)
+    os.chdir(work_dir)
+    stats_queue, tuning_queue = multiprocessing.Queue(), multiprocessing.Queue()
+    capture = worker.CaptureWorker("USB Audio", stats_queue, tuning_queue)
+    capture.configure(channels, samplerate, 0.0, {"max_seconds": segment_seconds, "patch_interval": fsync_interval, "activity": True}, False)
+    time.sleep(1.0)
+    last: Dict = {}
+    files: List[str] = []
+    rss: List[int] = []
+
+    def collect(timeout: float):
+        nonlocal last
+        try:
+            stats = stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        files.extend(stats.pop("files", None) or [])
+        last = dict(last, **stats)
+        # All recordings but the one being written
+        recordings = sorted((entry.stat().st_mtime, entry.name) for entry in os.scandir(work_dir) if entry.name.endswith(".wav"))
+        for _, name in recordings[:-1]:
+            storage.remove_recording(os.path.join(work_dir, name))
+
+    capture.record_start("BENCH", 7074000, "USB")
+    t_start = time.monotonic()
+    while time.monotonic() - t_start < seconds:
+        collect(1.0)
+        rss.append(process_rss(capture.process.pid))
+    capture.record_stop()
+    t_stop = time.monotonic()
+    while len(files) == 0 and time.monotonic() - t_stop < 10.0:
+        collect(0.5)
+    capture.close()
+    duration = t_stop - t_start
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    frame_size = 2*channels
+    result = {"seconds": round(duration, 1), "samplerate": samplerate, "channels": channels, "speed": speed,
+              "bytes_written": last.get("bytes_written", 0), "throughput_kbps": round(last.get("bytes_written", 0)/duration/1024, 1),
+              "realtime_ratio": round(last.get("bytes_written", 0)/(duration*samplerate*frame_size), 3),
+              "dropped_frames": last.get("dropped_frames", 0), "input_overflows": last.get("input_overflows", 0),
+              "buffer_high_water": round(last.get("high_water", 0)/max(1, last.get("buffer_size", 1)), 3), "files": len(files),
+              "rss_start_kb": rss[0] if len(rss) > 0 else 0, "rss_end_kb": rss[-1] if len(rss) > 0 else 0,
+              "rss_max_kb": max(rss, default=0)}
+    result.update({key: value for key, value in last.items() if key.startswith(("write_", "fsync_", "activity_cost"))})
+    return result
+
+
+def civ_scenario(seconds: float = 30.0, flood_rate: float = 50.0, status_rate: float = 10.0) -> Dict:
+    # Simulated radio -> transceiver.py reader (pty) -> IPC socket -> status broadcast, as in the recorder.
+    # The VFO is rotated for one second and left for one second in turn. The latency is measured from the frame write
+    # to the IPC message and to the Socket.IO emit (the browser part is measured by the recorder itself, civ_latency_ms.browser)
+    import transceiver
+    import broadcast
+    import ipc
+    radio = RadioSimulator()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    transceiver.socket_server, transceiver.socket_port = server.getsockname()
+    ipc_times: Dict[int, float] = {}
+    emit_times: Dict[int, float] = {}
+    state = {"frequency": 0, "levels": {}}
+    wakeup = threading.Event()
+    active = True
+
+    def receive():
+        conn, _ = server.accept()
+        conn.settimeout(ipc.heartbeat_timeout)
+        reader = ipc.MessageReader(conn)
+        while active:
+            try:
+                message = reader.read()
+            except OSError:
+                break
+            if message is None:
+                break
+            if "frequency" in message:
+                ipc_times[message["frequency"]] = time.time()
+                state["frequency"] = message["frequency"]
+                wakeup.set()
+            if "levels" in message:
+                state["levels"] = message["levels"]
+            if "civ_poll" in message:
+                state["civ_poll"] = message["civ_poll"]
+        conn.close()
+
+    def emit(event: str, data: dict, sid: str):
+        if "frequency" in data:
+            emit_times[data["frequency"]] = time.time()
+
+    def send_status():
+        # Same loop as recorder.status_update_thread, one client
+        clients = broadcast.StatusBroadcaster(default_rate=status_rate)
+        clients.add("bench")
+        while active:
+            clients.update(dict(state), emit)
+            wakeup.wait(max(0.02, clients.next_update()))
+            wakeup.clear()
+
+    threading.Thread(target=receive, daemon=True).start()
+    threading.Thread(target=send_status, daemon=True).start()
+    radio_data = transceiver.TransceiverData()
+    radio_data.name, radio_data.port_name, radio_data.civ_address = "IC-705", radio.port_name, bytes([radio.address])
+    reader = threading.Thread(target=transceiver.transceiver_port_thread, args=(radio_data,), name="IC-705", daemon=True)
+    reader.start()
+
+    time.sleep(1.0)
+    t_start = time.monotonic()
+    tuned = 0
+    while time.monotonic() - t_start < seconds:
+        if int(time.monotonic() - t_start) % 2 == 0:
+            radio.tune()
+            tuned += 1
+            time.sleep(1.0/flood_rate)
+        else:
+            time.sleep(0.05)
+    time.sleep(1.0)
+    active = False
+    transceiver.app_active = False
+    reader.join(timeout=2.0)
+    radio.close()
+    server.close()
+
+    ipc_latency = [t - radio.sent_times[freq] for freq, t in ipc_times.items() if freq in radio.sent_times]
+    emit_latency = [t - radio.sent_times[freq] for freq, t in emit_times.items() if freq in radio.sent_times]
+    flood = civ.tuning_flood(10000)
+    t_decode = time.perf_counter()
+    civ.CivDecoder().feed(flood)
+    decode_us = (time.perf_counter() - t_decode)*1e6/10000
+    poll = state.get("civ_poll", {})
+    result = {"seconds": seconds, "flood_rate": flood_rate, "tuning_frames": tuned, "frames_sent": radio.frames_sent, "poll_requests": radio.requests,
+              "poll_timeouts": poll.get("timeouts", 0), "bus_load": poll.get("bus_load", 0.0), "ipc_messages": len(ipc_times),
+              "status_deltas": len(emit_times), "coalesced": radio_data.updates.coalesced,
+              "final_frequency_ok": state["frequency"] == radio.frequency, "decode_us_per_frame": round(decode_us, 2)}
+    result.update(latency_stats(ipc_latency, "ipc_latency"))
+    result.update(latency_stats(emit_latency, "emit_latency"))
+    return result
+
+
+def status_scenario(calls: int = 2000, stations: int = 2, clients: int = 10) -> Dict:
+    # recorder.device_status() cost (all the cached values, the statistics of the stations) and the delta broadcast to the clients.
+    # The recorder module is imported here, in its own process, the eventlet monkey patching does not affect other scenarios
+    install_fake_audio()
+    import recorder
+    import station
+    for index in range(stations):
+        name = "IC-{}".format(7300 + index)
+        recorder.stations[name] = station.Station(recorder.portaudio, name, "USB Audio")
+    costs = []
+    for _ in range(calls):
+        t_start = time.perf_counter()
+        recorder.device_status()
+        costs.append(time.perf_counter() - t_start)
+
+    sent = []
+    for index in range(clients):
+        recorder.status_clients.add("client{}".format(index))
+    broadcast_costs = []
+    for index in range(calls//10):
+        recorder.transceiver_freq_hz = 7074000 + 10*index
+        t_start = time.perf_counter()
+        recorder.status_clients.update(recorder.device_status(), lambda event, data, sid: sent.append(len(json.dumps(data))), force=True)
+        broadcast_costs.append(time.perf_counter() - t_start)
+    result = {"calls": calls, "stations": stations, "clients": clients, "delta_bytes": int(np.mean(sent)) if len(sent) > 0 else 0,
+              "full_bytes": len(json.dumps(recorder.device_status()))}
+    result.update(latency_stats(costs, "device_status"))
+    result.update(latency_stats(broadcast_costs, "broadcast"))
+    return result
+
+
+scenarios = {"capture": capture_scenario, "civ": civ_scenario, "status": status_scenario}
+
+
+def run_scenario(name: str, params: Dict, conn: Connection):
+    # The result is sent through a pipe, not a queue: a queue needs its feeder thread, which does not run after the eventlet monkey patching
+    try:
+        conn.send(scenarios[name](**params))
+    except Exception as e:
+        conn.send({"error": "{}: {}".format(type(e).__name__, e)})
+
+
+def run(names: List[str], params: Dict[str, Dict]) -> Dict:
+    # Each scenario in a new process, the result document can be compared with the other commits
+    results: Dict[str, Any] = {}
+    for name in names:
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_scenario, args=(name, params.get(name, {}), child_conn))
+        process.start()
+        results[name] = conn.recv()
+        process.join(timeout=10.0)
+        print("{}: {}".format(name, results[name]), file=sys.stderr)
+    return {"commit": git_revision(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "host": platform.node(), "machine": platform.machine(),
+            "python": platform.python_version(), "cores": os.cpu_count(), "scenarios": results}
+
+
+def git_revision() -> str:
+    # Short hash, with "+" if there are local changes
+    path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=path, capture_output=True, text=True).stdout.strip()
+        return revision + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def last_result(path: str) -> Dict:
+    with open(path) as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1])
+
+
+def compare(old: Dict, new: Dict):
+    # Numeric results of the same scenarios, the change in percent
+    print("{:<34} {:>14} {:>14} {:>8}".format("{} -> {}".format(old.get("commit", "?"), new.get("commit", "?")), "old", "new", "change"))
+    for name, result in new["scenarios"].items():
+        before = old["scenarios"].get(name, {})
+        for key, value in result.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(before.get(key), (int, float)):
+                continue
+            change = "{:+.1f}%".format(100.0*(value - before[key])/before[key]) if before[key] != 0 else ""
+            print("{:<34} {:>14} {:>14} {:>8}".format(name + "." + key, before[key], value, change))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "compare":
+        compare(last_result(sys.argv[2]), last_result(sys.argv[3]))
+        sys.exit(0)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", nargs="*", help="Scenarios to run: {}, all by default".format(", ".join(scenarios.keys())))
+    parser.add_argument("--seconds", type=float, default=30.0, help="Duration of the capture and CI-V scenarios, use hours for a soak test")
+    parser.add_argument("--samplerate", type=int, default=48000)
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--speed", type=float, default=1.0, help="Simulated audio at N times the real time rate")
+    parser.add_argument("--segment-minutes", type=float, default=0.0, help="Start a new file every N minutes (soak test of the file rotation)")
+    parser.add_argument("--folder", default=None, help="Folder for the recordings, the system temporary folder by default")
+    parser.add_argument("--flood-rate", type=float, default=50.0, help="CI-V frequency broadcasts per second while tuning")
+    parser.add_argument("--output", default=None, help="Append the results as a JSON line to this file")
+    args = parser.parse_args()
+    for name in args.scenario:
+        if name not in scenarios:
+            parser.error("Unknown scenario: {}".format(name))
+    params = {"capture": {"seconds": args.seconds, "samplerate": args.samplerate, "channels": args.channels, "speed": args.speed,
+                          "segment_seconds": args.segment_minutes*60, "folder": args.folder},
+              "civ": {"seconds": args.seconds, "flood_rate": args.flood_rate},
+              "status": {}}
+    document = run(args.scenario or list(scenarios.keys()), params)
+    print(json.dumps(document))
+    if args.output is not None:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(document) + "\n")
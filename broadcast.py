@@ -0,0 +1,49 @@
+import time
+from typing import Any, Callable, Dict
+
+
+class StatusBroadcaster:
+    # Status updates for several clients: a client gets the full status on connect and then only the changed fields,
+    # not more often than its own update rate. Fast changes between two updates (VFO tuning) are coalesced,
+    # the client gets only the latest value
+    def __init__(self, default_rate: float = 10.0):
+        self.default_rate = default_rate
+        self.clients: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, sid: str, rate: float = 0.0):
+        self.clients[sid] = {"interval": 1.0/(rate if rate > 0 else self.default_rate), "sent": 0.0, "status": {}}
+
+    def remove(self, sid: str):
+        self.clients.pop(sid, None)
+
+    def set_rate(self, sid: str, rate: float):
+        if sid in self.clients and rate > 0:
+            self.clients[sid]["interval"] = 1.0/min(rate, self.default_rate)
+
+    def has_clients(self) -> bool:
+        return len(self.clients) > 0
+
+    def next_update(self) -> float:
+        # Time in seconds until one of the clients needs an update
+        now = time.monotonic()
+        return max(0.0, min((c["sent"] + c["interval"] - now for c in self.clients.values()), default=1.0/self.default_rate))
+
+    def send_full(self, sid: str, status: dict, emit: Callable[[str, dict, str], None]):
+        client = self.clients.get(sid)
+        if client is not None:
+            client["status"] = dict(status)
+            client["sent"] = time.monotonic()
+            emit('device_status', status, sid)
+
+    def update(self, status: dict, emit: Callable[[str, dict, str], None], force: bool = False):
+        # Send the changed fields to the clients, which update time has come (or to all clients if force is set)
+        now = time.monotonic()
+        for sid, client in list(self.clients.items()):
+            if force is False and now - client["sent"] < client["interval"]:
+                continue
+            sent_status = client["status"]
+            delta = {key: value for key, value in status.items() if key not in sent_status or sent_status[key] != value}
+            client["sent"] = now
+            if len(delta) > 0:
+                sent_status.update(delta)
+                emit('device_status_delta', delta, sid)
@@ -0,0 +1,237 @@
+import sqlite3
+import struct
+import json
+import re
+import os
+import threading
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from wavwriter import index_filename
+
+
+# Amateur bands, Hz
+bands = {"160m": (1810000, 2000000), "80m": (3500000, 3800000), "60m": (5350000, 5370000), "40m": (7000000, 7200000),
+         "30m": (10100000, 10150000), "20m": (14000000, 14350000), "17m": (18068000, 18168000), "15m": (21000000, 21450000),
+         "12m": (24890000, 24990000), "10m": (28000000, 29700000), "6m": (50000000, 54000000), "4m": (70000000, 70500000),
+         "2m": (144000000, 146000000), "70cm": (430000000, 440000000)}
+
+sort_columns = ("created", "name", "size", "duration", "frequency", "mode")
+
+recording_extensions = (".wav", ".flac")
+
+
+def sort_column(sort: str) -> str:
+    return sort if sort in sort_columns else "created"
+
+
+def page_cursor(row: Dict, sort: str) -> str:
+    # Position of the row in the list: the sort key and the name (unique), for the next or previous page
+    return json.dumps([row[sort_column(sort)], row["name"]])
+
+
+def parse_cursor(text: Optional[str]) -> Optional[List]:
+    try:
+        cursor = json.loads(text) if text else None
+    except ValueError:
+        return None
+    if isinstance(cursor, list) and len(cursor) == 2 and isinstance(cursor[0], (str, int, float)) and isinstance(cursor[1], str):
+        return cursor
+    return None
+
+
+def read_wav_info(f) -> Dict:
+    # RIFF/RF64 chunks: only fmt, ds64 and the data size are needed
+    header = f.read(12)
+    if len(header) < 12 or header[8:12] != b'WAVE' or header[0:4] not in (b'RIFF', b'RF64'):
+        return {}
+    info, data_size_64 = {}, None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break
+        chunk_id, chunk_size = chunk[0:4], struct.unpack('<I', chunk[4:8])[0]
+        if chunk_id == b'fmt ':
+            fmt = f.read(16)
+            _, channels, samplerate, _, block_align, _ = struct.unpack('<HHIIHH', fmt)
+            info.update(channels=channels, samplerate=samplerate, block_align=block_align)
+            f.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+        elif chunk_id == b'ds64':
+            ds64 = f.read(chunk_size)
+            data_size_64 = struct.unpack('<Q', ds64[8:16])[0]
+        elif chunk_id == b'data':
+            data_size = data_size_64 if data_size_64 is not None and chunk_size == 0xFFFFFFFF else chunk_size
+            info.update(data_offset=f.tell(), data_size=data_size)
+            if "block_align" in info and info["samplerate"] > 0:
+                info["duration"] = data_size / info["block_align"] / info["samplerate"]
+            break
+        else:
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+    return info
+
+
+def read_flac_info(f) -> Dict:
+    # STREAMINFO is always the first metadata block
+    header = f.read(4 + 4 + 34)
+    if len(header) < 42 or header[0:4] != b'fLaC':
+        return {}
+    streaminfo = int.from_bytes(header[18:26], 'big')
+    samplerate = streaminfo >> 44
+    channels = ((streaminfo >> 41) & 0x07) + 1
+    total_samples = streaminfo & 0xFFFFFFFFF
+    return {"channels": channels, "samplerate": samplerate, "duration": total_samples/samplerate if samplerate > 0 else 0}
+
+
+def read_audio_info(path: str) -> Dict:
+    try:
+        with open(path, 'rb') as f:
+            return read_flac_info(f) if path.endswith(".flac") else read_wav_info(f)
+    except (OSError, struct.error):
+        return {}
+
+
+def read_tuning(path: str) -> Tuple[int, str]:
+    # Frequency and mode: from the index file if it exists, otherwise the frequency from the file name
+    try:
+        with open(index_filename(path)) as f:
+            event = json.loads(f.readline())
+            return event.get("frequency", 0), event.get("mode", "")
+    except (OSError, ValueError):
+        pass
+    m = re.search(r'_(\d+)kHz_', os.path.basename(path))
+    return (int(m.group(1))*1000 if m else 0), ""
+
+
+class RecordingsCatalog:
+    # Persistent index of the recordings folder (SQLite database in the same folder).
+    # Files are added when a recording is finished, the folder is scanned only once on startup
+    def __init__(self, folder: str, db_name: str = ".recordings.db"):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(folder, db_name), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS recordings (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, created TEXT, duration REAL, "
+                        "samplerate INTEGER, channels INTEGER, frequency INTEGER, mode TEXT)")
+        for column in ("created", "frequency", "mode", "size", "duration"):
+            self.db.execute("CREATE INDEX IF NOT EXISTS recordings_{0} ON recordings ({0})".format(column))
+            # Pages are read by the sort key and the name, see list()
+            self.db.execute("CREATE INDEX IF NOT EXISTS recordings_{0}_name ON recordings ({0}, name)".format(column))
+        # Starred recordings are never deleted by the retention rules
+        self.db.execute("CREATE TABLE IF NOT EXISTS starred (name TEXT PRIMARY KEY)")
+        self.db.commit()
+
+    def add_file(self, name: str, commit: bool = True) -> bool:
+        path = os.path.join(self.folder, name)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            logging.error("Catalog: cannot add %s: %s", name, e)
+            return False
+        info = read_audio_info(path)
+        frequency, mode = read_tuning(path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (name, st.st_size, st.st_mtime, datetime.fromtimestamp(st.st_mtime).strftime("%Y-%m-%d %H:%M:%S"),
+                             round(info.get("duration", 0), 2), info.get("samplerate", 0), info.get("channels", 0), frequency, mode))
+            if commit:
+                self.db.commit()
+        return True
+
+    def remove_file(self, name: str):
+        with self.lock:
+            self.db.execute("DELETE FROM recordings WHERE name = ?", (name,))
+            self.db.execute("DELETE FROM starred WHERE name = ?", (name,))
+            self.db.commit()
+
+    def replace_file(self, name: str, new_name: str):
+        # The file is converted to another format, the star is kept
+        self.add_file(new_name, commit=False)
+        with self.lock:
+            self.db.execute("DELETE FROM recordings WHERE name = ?", (name,))
+            self.db.execute("UPDATE starred SET name = ? WHERE name = ?", (new_name, name))
+            self.db.commit()
+
+    def set_starred(self, name: str, starred: bool) -> bool:
+        with self.lock:
+            if self.db.execute("SELECT COUNT(*) FROM recordings WHERE name = ?", (name,)).fetchone()[0] == 0:
+                return False
+            if starred:
+                self.db.execute("INSERT OR IGNORE INTO starred VALUES (?)", (name,))
+            else:
+                self.db.execute("DELETE FROM starred WHERE name = ?", (name,))
+            self.db.commit()
+        return True
+
+    def total_size(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM recordings").fetchone()[0]
+
+    def oldest(self, limit: int = 50, extension: Optional[str] = None, starred: bool = True) -> List[Tuple[str, int]]:
+        # Names and sizes of the oldest recordings, starred=False skips the starred ones
+        conditions = ([] if extension is None else ["name LIKE ?"]) + ([] if starred else ["name NOT IN (SELECT name FROM starred)"])
+        where = ("WHERE " + " AND ".join(conditions)) if len(conditions) > 0 else ""
+        with self.lock:
+            return self.db.execute("SELECT name, size FROM recordings {} ORDER BY created, name LIMIT ?".format(where),
+                                   ([] if extension is None else ["%" + extension]) + [limit]).fetchall()
+
+    def reconcile(self) -> Tuple[int, int]:
+        # Sync the catalog with the folder: new or changed files are (re)indexed, deleted files are removed
+        with self.lock:
+            known = {name: (size, mtime) for name, size, mtime in self.db.execute("SELECT name, size, mtime FROM recordings")}
+        added = 0
+        present = set()
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if not entry.is_file() or not entry.name.endswith(recording_extensions):
+                    continue
+                present.add(entry.name)
+                st = entry.stat()
+                if known.get(entry.name) != (st.st_size, st.st_mtime):
+                    self.add_file(entry.name, commit=False)
+                    added += 1
+        removed = [name for name in known if name not in present]
+        with self.lock:
+            self.db.executemany("DELETE FROM recordings WHERE name = ?", [(name,) for name in removed])
+            self.db.executemany("DELETE FROM starred WHERE name = ?", [(name,) for name in removed])
+            self.db.commit()
+        logging.debug("Catalog: %d files, %d added or updated, %d removed", len(present), added, len(removed))
+        return added, len(removed)
+
+    def count(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM recordings").fetchone()[0]
+
+    def list(self, page_size: int = 50, sort: str = "created", descending: bool = True, band: Optional[str] = None, mode: Optional[str] = None,
+             date: Optional[str] = None, after: Optional[List] = None, before: Optional[List] = None) -> Tuple[List[Dict], int]:
+        # One page of the filtered and sorted list, and the total number of matching files.
+        # The page starts after the cursor (page_cursor() of the last row of the previous page) or ends before it,
+        # so a page is read from the index without skipping the rows of the previous pages
+        conditions, params = [], []
+        if band in bands:
+            conditions.append("frequency BETWEEN ? AND ?")
+            params += list(bands[band])
+        if mode:
+            conditions.append("mode = ?")
+            params.append(mode)
+        if date:
+            # YYYY-MM-DD
+            conditions.append("created >= ? AND created < ?")
+            params += [date, date + " 99"]
+        where = ("WHERE " + " AND ".join(conditions)) if len(conditions) > 0 else ""
+        key = sort_column(sort)
+        # The previous page is read backwards from the cursor
+        backwards = after is None and before is not None
+        if after is not None or before is not None:
+            conditions.append("({}, name) {} (?, ?)".format(key, "<" if descending != backwards else ">"))
+        page_where = ("WHERE " + " AND ".join(conditions)) if len(conditions) > 0 else ""
+        order = "{0} {1}, name {1}".format(key, "DESC" if descending != backwards else "ASC")
+        with self.lock:
+            total = self.db.execute("SELECT COUNT(*) FROM recordings " + where, params).fetchone()[0]
+            cursor = self.db.execute("SELECT *, name IN (SELECT name FROM starred) AS starred FROM recordings {} ORDER BY {} LIMIT ?".format(page_where, order),
+                                     params + list(after or before or []) + [page_size])
+            columns = [d[0] for d in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return (rows[::-1] if backwards else rows), total
+
+    def modes(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT DISTINCT mode FROM recordings WHERE mode != '' ORDER BY mode")]
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+# CI-V frame decoder
+# Frame: FE FE <to> <from> <cmd> [<sub-cmd/data>...] FD
+# Docs: http://www.plicht.de/ekki/civ/civ-p41.html
+
+import time
+import sys
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional
+
+
+PREAMBLE = 0xFE
+END = 0xFD
+COLLISION = 0xFC
+OK = 0xFB
+NG = 0xFA
+CONTROLLER = 0xE0
+BROADCAST = 0x00
+
+# BCD byte -> value, to decode the frequency without string conversions
+bcd_table = [(b >> 4)*10 + (b & 0x0F) for b in range(256)]
+
+
+class CivFrame(NamedTuple):
+    to: int
+    src: int
+    cmd: int
+    data: bytes
+
+
+def decode_frequency(data: bytes) -> int:
+    # 5 BCD bytes, the least significant first: 00 40 07 07 00 -> 7074000
+    freq = 0
+    for b in reversed(data[:5]):
+        freq = freq*100 + bcd_table[b]
+    return freq
+
+
+def decode_bcd(data: bytes) -> int:
+    # BCD, the most significant byte first: 01 28 -> 128
+    value = 0
+    for b in data:
+        value = value*100 + bcd_table[b]
+    return value
+
+
+def encode_frequency(freq: int) -> bytes:
+    data = bytearray()
+    for _ in range(5):
+        two_digits = freq % 100
+        data.append(((two_digits // 10) << 4) | (two_digits % 10))
+        freq //= 100
+    return bytes(data)
+
+
+class CivDecoder:
+    # Streaming decoder: data is fed as it comes from the serial port, complete frames are returned.
+    # The buffer is bounded: garbage before the FE FE preamble is dropped, a frame longer than max_frame is dropped,
+    # a frame with the collision code FC is dropped.
+    # If radio_address is set, only frames from this radio to the controller (or broadcast) are returned
+    def __init__(self, radio_address: Optional[int] = None, max_frame: int = 64):
+        self.radio_address = radio_address
+        self.max_frame = max_frame
+        self.buffer = bytearray()
+        # Statistics
+        self.frames = 0
+        self.collisions = 0
+        self.errors = 0
+        self.filtered = 0
+        self.bytes = 0
+
+    def feed(self, data: bytes) -> List[CivFrame]:
+        frames = []
+        self.buffer += data
+        self.bytes += len(data)
+        buf = self.buffer
+        pos = 0
+        while True:
+            start = buf.find(b'\xFE\xFE', pos)
+            if start == -1:
+                # Keep the last byte, it can be the first half of the preamble
+                pos = len(buf) - 1 if len(buf) > 0 and buf[-1] == PREAMBLE else len(buf)
+                break
+            # Skip the repeated preamble bytes (FE FE FE ...)
+            body = start + 2
+            while body < len(buf) and buf[body] == PREAMBLE:
+                body += 1
+            end = buf.find(b'\xFD', body)
+            if end == -1:
+                if len(buf) - start > self.max_frame:
+                    # No end marker, resync on the next preamble
+                    self.errors += 1
+                    pos = body
+                    continue
+                pos = start
+                break
+            next_start = buf.find(b'\xFE\xFE', body, end)
+            if next_start != -1:
+                # New preamble inside the frame: the previous frame was broken
+                self.errors += 1
+                pos = next_start
+                continue
+            pos = end + 1
+            if end - start > self.max_frame:
+                # Garbage between the preamble and the end marker
+                self.errors += 1
+                continue
+            frame = buf[body:end]
+            if COLLISION in frame:
+                self.collisions += 1
+                continue
+            if len(frame) < 3:
+                self.errors += 1
+                continue
+            if self.radio_address is not None and (frame[1] != self.radio_address or frame[0] not in (CONTROLLER, BROADCAST)):
+                self.filtered += 1
+                continue
+            self.frames += 1
+            frames.append(CivFrame(frame[0], frame[1], frame[2], bytes(frame[3:])))
+        del buf[:pos]
+        return frames
+
+    def stats(self) -> Dict:
+        return {"frames": self.frames, "errors": self.errors, "collisions": self.collisions, "filtered": self.filtered, "bytes": self.bytes}
+
+
+class PollItem:
+    # Backoff of a radio that does not answer: up to backoff_limit normal intervals.
+    # A command answered with NG is asked again after reprobe_interval seconds, the NG can be temporary
+    backoff_limit = 8
+    reprobe_interval = 300.0
+
+    def __init__(self, name: str, cmd: bytes, interval: float, initial_interval: float):
+        self.name = name
+        self.cmd = cmd
+        self.interval = interval
+        self.initial_interval = initial_interval
+        self.next_time = 0.0
+        self.answered = False
+        self.failures = 0
+        self.unsupported = False
+
+    def matches(self, frame: CivFrame) -> bool:
+        return frame.cmd == self.cmd[0] and frame.data[:len(self.cmd) - 1] == self.cmd[1:]
+
+    def current_interval(self) -> float:
+        # Fast polling until the first answer, then a slow periodic re-sync.
+        # On timeouts the interval grows exponentially, up to backoff_limit normal intervals
+        if self.unsupported:
+            return self.reprobe_interval
+        if self.failures > 0:
+            return min(self.initial_interval*2**self.failures, max(self.interval, self.initial_interval)*self.backoff_limit)
+        return self.interval if self.answered else self.initial_interval
+
+
+class CivPoller:
+    # CI-V request scheduler. Only one request is outstanding at a time (CI-V is half-duplex),
+    # and requests use not more than bus_share of the serial port capacity.
+    # Values updated by the transceive broadcasts (frequency, mode) are not polled until their re-sync time
+    def __init__(self, radio_address: int, baudrate: int = 19200, bus_share: float = 0.25, timeout: float = 0.3):
+        self.radio_address = radio_address
+        self.bytes_per_second = baudrate/10
+        self.bus_share = bus_share
+        self.timeout = timeout
+        self.items: List[PollItem] = []
+        self.outstanding: Optional[PollItem] = None
+        self.sent_time = 0.0
+        self.bus_log = deque()  # (time, bytes), requests and the expected answers for the last second
+        # Statistics
+        self.requests = 0
+        self.timeouts = 0
+
+    def add(self, name: str, cmd: bytes, interval: float, initial_interval: Optional[float] = None):
+        self.items.append(PollItem(name, cmd, interval, initial_interval if initial_interval is not None else interval))
+
+    def request_frame(self, item: PollItem) -> bytes:
+        return bytes([PREAMBLE, PREAMBLE, self.radio_address, CONTROLLER]) + item.cmd + bytes([END])
+
+    def bus_load(self, now: float) -> float:
+        while len(self.bus_log) > 0 and self.bus_log[0][0] < now - 1.0:
+            self.bus_log.popleft()
+        return sum(b for _, b in self.bus_log)/self.bytes_per_second
+
+    def on_frame(self, frame: CivFrame, now: float):
+        if frame.cmd == NG and self.outstanding is not None:
+            # Command is not supported by this radio model (or not now, it is asked again later)
+            self.outstanding.unsupported = True
+            self.outstanding.next_time = now + self.outstanding.current_interval()
+            self.outstanding = None
+            return
+        for item in self.items:
+            if item.matches(frame) or (frame.cmd in (0x00, 0x01) and item.cmd[0] == frame.cmd + 3):
+                # Answer, or the transceive broadcast of the same value (00h for 03h, 01h for 04h)
+                item.answered = True
+                item.unsupported = False
+                item.failures = 0
+                item.next_time = now + item.interval
+                if item is self.outstanding:
+                    self.outstanding = None
+
+    def poll(self, now: float) -> Optional[bytes]:
+        # Request to send now, or None
+        if self.outstanding is not None:
+            if now - self.sent_time < self.timeout:
+                return None
+            self.timeouts += 1
+            self.outstanding.failures += 1
+            self.outstanding.next_time = now + self.outstanding.current_interval()
+            self.outstanding = None
+
+        due = [item for item in self.items if item.next_time <= now]
+        if len(due) == 0:
+            return None
+        item = min(due, key=lambda i: i.next_time)
+        request = self.request_frame(item)
+        # The answer is usually the request with the data, 2x is used as an estimate
+        if self.bus_load(now) + 2*len(request)/self.bytes_per_second > self.bus_share:
+            return None
+        self.bus_log.append((now, 2*len(request)))
+        self.outstanding = item
+        self.sent_time = now
+        item.next_time = now + item.current_interval()
+        self.requests += 1
+        return request
+
+    def stats(self, now: float) -> Dict:
+        return {"requests": self.requests, "timeouts": self.timeouts, "bus_load": round(self.bus_load(now), 3),
+                "unsupported": [item.name for item in self.items if item.unsupported]}
+
+
+def benchmark(data: bytes, repeat: int = 10) -> float:
+    # Decoding speed, bytes per second. Data is fed in 32 byte blocks, as it is read from the serial port
+    t_start = time.perf_counter()
+    frames = 0
+    for _ in range(repeat):
+        decoder = CivDecoder()
+        for i in range(0, len(data), 32):
+            frames += len(decoder.feed(data[i:i + 32]))
+    duration = time.perf_counter() - t_start
+    print("{} bytes x {}: {} frames, {:.3f}s, {:.0f} KBytes/s, {:.0f} frames/s".format(len(data), repeat, frames, duration,
+                                                                                     len(data)*repeat/duration/1024, frames/duration))
+    return len(data)*repeat/duration
+
+
+def check_decoder():
+    # Frames split between the reads, noise, a collision and a frame longer than max_frame
+    frame = b'\xFE\xFE\xE0\xA4\x03' + encode_frequency(7074000) + b'\xFD'
+    data = b'\x12' + frame + b'\xFE\xFE\xE0\xA4\xFC\xFD' + b'\xFE\xFE' + bytes(range(1, 40)) + b'\xFD' + frame
+    for block in (len(data), 5):
+        decoder = CivDecoder(max_frame=16)
+        frames = [f for i in range(0, len(data), block) for f in decoder.feed(data[i:i + block])]
+        assert [(f.cmd, decode_frequency(f.data)) for f in frames] == [(0x03, 7074000)]*2, frames
+        assert decoder.stats()["collisions"] == 1 and decoder.stats()["errors"] == 1, decoder.stats()
+        assert len(decoder.buffer) == 0
+
+
+def tuning_flood(frames: int = 10000, address: int = 0xA4) -> bytes:
+    # Transceive frequency broadcasts, as the radio sends them while the VFO is rotated
+    return b''.join(b'\xFE\xFE\x00%c\x00%b\xFD' % (address, encode_frequency(7000000 + 10*i)) for i in range(frames))
+
+
+if __name__ == "__main__":
+    # python3 civ.py [serial_capture.bin]
+    check_decoder()
+    benchmark(open(sys.argv[1], 'rb').read() if len(sys.argv) > 1 else tuning_flood())
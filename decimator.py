@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+# Mode-aware decimation: narrow modes are recorded at a lower sample rate, in mono
+
+import sys
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Dict, Optional, Tuple
+
+
+# Mode: (minimal sample rate, channels). Modes, that are not listed (WFM, RTTY, PSK, DV, data), are recorded at the full rate
+mode_profiles = {"CW": (12000, 1), "CW-R": (12000, 1), "LSB": (24000, 1), "USB": (24000, 1),
+                 "AM": (24000, 1), "SAM": (24000, 1), "FM": (24000, 1)}
+
+
+def mode_profile(mode: str, samplerate: int, channels: int) -> Optional[Tuple[int, int]]:
+    # Integer decimation factor and the output channels, None if the data is written as is
+    if mode not in mode_profiles:
+        return None
+    min_rate, out_channels = mode_profiles[mode]
+    factor = max(1, samplerate // min_rate)
+    out_channels = min(out_channels, channels)
+    if factor == 1 and out_channels == channels:
+        return None
+    return factor, out_channels
+
+
+def lowpass(taps: int, cutoff: float) -> np.ndarray:
+    # Windowed sinc, cutoff in cycles per sample
+    n = np.arange(taps) - (taps - 1)/2
+    h = np.sinc(2*cutoff*n)*np.blackman(taps)
+    return (h/h.sum()).astype(np.float32)
+
+
+class Decimator:
+    # FIR low-pass and decimation by an integer factor. Only every factor-th output is calculated (polyphase),
+    # all outputs of a data block are one matrix product of the sliding windows and the filter.
+    # The last input samples are kept between the blocks, the delay is taps/2 input samples
+    def __init__(self, samplerate: int, channels: int, factor: int, out_channels: int, taps_per_phase: int = 24):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.factor = factor
+        self.out_channels = out_channels
+        self.taps = taps_per_phase*factor + 1 if factor > 1 else 1
+        self.h = lowpass(self.taps, 0.45/factor)[::-1].copy()
+        self.state = np.zeros((self.taps - 1, out_channels), dtype=np.float32)
+        self.offset = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def out_samplerate(self) -> int:
+        return self.samplerate // self.factor
+
+    def process(self, data: bytes) -> bytes:
+        x = np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels).astype(np.float32)
+        if self.out_channels < self.channels:
+            x = x.mean(axis=1, keepdims=True)
+        buf = np.concatenate((self.state, x))
+        count = (len(buf) - self.taps - self.offset)//self.factor + 1 if len(buf) - self.taps - self.offset >= 0 else 0
+        if count > 0:
+            windows = sliding_window_view(buf, self.taps, axis=0)[self.offset:self.offset + count*self.factor:self.factor]
+            y = windows @ self.h
+        else:
+            y = np.zeros((0, self.out_channels), dtype=np.float32)
+        next_start = self.offset + count*self.factor
+        keep = min(next_start, len(buf))
+        self.state = buf[keep:]
+        self.offset = next_start - keep
+        out = np.clip(np.rint(y), -32768, 32767).astype(np.int16).tobytes()
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        return out
+
+    def stats(self) -> Dict:
+        return {"decimation": "{}x{} -> {}x{}".format(self.samplerate, self.channels, self.out_samplerate, self.out_channels),
+                "saved_bytes": self.bytes_in - self.bytes_out}
+
+
+class DecimatingWriter:
+    # Segment writer wrapper: the data is decimated before it is written. frame_size is the input frame size,
+    # so the tuning changes are placed by the input stream positions
+    def __init__(self, wf, decimator: Decimator):
+        self.wf = wf
+        self.decimator = decimator
+        self.frame_size = decimator.channels*2
+        self.filename = wf.filename
+        self.filenames = wf.filenames
+
+    def writeframes(self, data: bytes):
+        self.wf.writeframes(self.decimator.process(data))
+
+    def frames_written(self) -> int:
+        return self.wf.frames_written()
+
+    def new_segment(self):
+        self.wf.new_segment()
+
+    def write_event(self, event: Dict):
+        self.wf.write_event(event)
+
+    def stats(self) -> Dict:
+        return dict(self.wf.stats(), **self.decimator.stats())
+
+    def close(self):
+        self.wf.close()
+
+
+def benchmark(samplerate: int = 48000, channels: int = 2, mode: str = "CW", seconds: float = 60.0) -> float:
+    # Realtime factor, the data is fed in 0.5s blocks as the capture worker does
+    profile = mode_profile(mode, samplerate, channels)
+    if profile is None:
+        print("{} at {} Hz x {} is recorded as is".format(mode, samplerate, channels))
+        return 0.0
+    factor, out_channels = profile
+    decimator = Decimator(samplerate, channels, factor, out_channels)
+    rng = np.random.default_rng(1)
+    data = rng.integers(-3000, 3000, int(seconds*samplerate)*channels, dtype=np.int16).tobytes()
+    step = samplerate*channels*2//2
+    t_start = time.perf_counter()
+    for pos in range(0, len(data), step):
+        decimator.process(data[pos:pos + step])
+    duration = time.perf_counter() - t_start
+    print("{} {}s: {}, {} taps, {:.3f}s, {:.0f}x realtime, {:.0f}% saved".format(mode, seconds, decimator.stats()["decimation"], decimator.taps,
+                                                                           duration, seconds/duration, 100*decimator.stats()["saved_bytes"]/decimator.bytes_in))
+    return seconds/duration
+
+
+if __name__ == "__main__":
+    # python3 decimator.py [samplerate] [channels] [mode]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 48000, int(sys.argv[2]) if len(sys.argv) > 2 else 2, sys.argv[3] if len(sys.argv) > 3 else "CW")
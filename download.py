@@ -0,0 +1,87 @@
+import os
+import time
+import logging
+from typing import Dict, Iterator
+from flask import Request, Response
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import http_date, quote_etag
+
+
+class TransferStats:
+    # Download throughput: number of active transfers, total bytes and the rate of the last finished transfer
+    def __init__(self):
+        self.active = 0
+        self.bytes_sent = 0
+        self.last_rate = 0.0
+
+    def status(self) -> Dict:
+        return {"active": self.active, "bytes_sent": self.bytes_sent, "last_rate_kbps": round(self.last_rate/1024, 1)}
+
+
+transfer_stats = TransferStats()
+
+
+def file_chunks(path: str, start: int, length: int, chunk_size: int, pause: float) -> Iterator[bytes]:
+    # Sequential reads of large blocks. The pages already sent are dropped from the page cache,
+    # so a multi-GB download does not push out the pages used by the recording.
+    # The short pause between blocks lets other greenlets (status, spectrum) run
+    fd = os.open(path, os.O_RDONLY)
+    transfer_stats.active += 1
+    t_start, sent = time.monotonic(), 0
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, start, length, os.POSIX_FADV_SEQUENTIAL)
+        while sent < length:
+            data = os.pread(fd, min(chunk_size, length - sent), start + sent)
+            if len(data) == 0:
+                break
+            yield data
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, start + sent, len(data), os.POSIX_FADV_DONTNEED)
+            sent += len(data)
+            transfer_stats.bytes_sent += len(data)
+            time.sleep(pause)
+    finally:
+        os.close(fd)
+        transfer_stats.active -= 1
+        duration = time.monotonic() - t_start
+        if duration > 0:
+            transfer_stats.last_rate = sent/duration
+        logging.debug("Download %s: %d KBytes in %.1fs, %.1f KBytes/s", os.path.basename(path), sent//1024, duration, sent/1024/max(duration, 0.001))
+
+
+def if_range_matches(request: Request, etag: str, mtime: float) -> bool:
+    # If-Range has an ETag or the Last-Modified date of the client copy, the date has a second precision
+    if request.if_range.etag is not None:
+        return request.if_range.etag == etag
+    if request.if_range.date is not None:
+        return int(mtime) == int(request.if_range.date.timestamp())
+    return True
+
+
+def send_recording(request: Request, path: str, mimetype: str, chunk_size: int = 256*1024, pause: float = 0.0) -> Response:
+    # File response with Range (resumed downloads, seeking in the browser audio player), ETag and Last-Modified support
+    st = os.stat(path)
+    etag = "{:x}-{:x}".format(st.st_size, int(st.st_mtime*1000))
+    headers = {"Accept-Ranges": "bytes", "ETag": quote_etag(etag), "Last-Modified": http_date(st.st_mtime), "Cache-Control": "no-cache"}
+
+    # Conditional request: the browser already has this version
+    if request.if_none_match.contains(etag) or (len(request.if_none_match) == 0 and request.if_modified_since is not None and
+                                                int(st.st_mtime) <= request.if_modified_since.timestamp()):
+        return Response(status=304, headers=headers)
+
+    start, length, status = 0, st.st_size, 200
+    byte_range = request.range
+    # If-Range: the range is valid only if the file was not changed, otherwise the whole file is sent
+    # Only one range is supported, for several ranges (or other units) the whole file is sent
+    if byte_range is not None and byte_range.units == "bytes" and len(byte_range.ranges) == 1 and if_range_matches(request, etag, st.st_mtime):
+        r = byte_range.range_for_length(st.st_size)
+        if r is None:
+            # The range is outside of the file
+            headers["Content-Range"] = ContentRange("bytes", None, None, st.st_size).to_header()
+            return Response(status=416, headers=headers)
+        start, length, status = r[0], r[1] - r[0], 206
+        headers["Content-Range"] = ContentRange("bytes", r[0], r[1], st.st_size).to_header()
+
+    headers["Content-Length"] = str(length)
+    return Response(file_chunks(path, start, length, chunk_size, pause), status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
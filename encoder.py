@@ -0,0 +1,107 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import time
+import logging
+from typing import Callable, Dict, Optional
+from wavwriter import SegmentedWavWriter
+
+try:
+    import soundfile  # sudo pip3 install soundfile
+except ImportError:
+    soundfile = None
+
+
+def flac_supported() -> bool:
+    return soundfile is not None
+
+
+def flac_encoder_process(shm_name: str, channels: int, samplerate: int, cmd_queue: multiprocessing.Queue, encoded: multiprocessing.Value):
+    # Encoder worker: PCM blocks are taken from the shared memory buffer, cmd_queue only has (offset, size) descriptors
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s] (ENC)  %(message)s')
+    shm = shared_memory.SharedMemory(name=shm_name)
+    sf = None
+    while True:
+        cmd = cmd_queue.get()
+        if cmd[0] == "data":
+            _, offset, size = cmd
+            samples = np.frombuffer(shm.buf[offset:offset + size], dtype=np.int16).reshape(-1, channels)
+            sf.write(samples)
+            del samples
+            with encoded.get_lock():
+                encoded.value += size
+        elif cmd[0] == "open":
+            sf = soundfile.SoundFile(cmd[1], 'w', samplerate=samplerate, channels=channels, format='FLAC', subtype='PCM_16')
+        elif cmd[0] == "close":
+            if sf is not None:
+                sf.close()
+                sf = None
+        elif cmd[0] == "quit":
+            break
+    shm.close()
+
+
+class FlacSegmentWriter(SegmentedWavWriter):
+    # Same segmentation and index files as SegmentedWavWriter, but the audio is encoded to FLAC in a separate process.
+    # PCM blocks are copied to a shared memory ring, the encoder position is shared back to calculate the encoder lag
+    extension = ".flac"
+
+    def __init__(self, make_filename: Callable[[], str], channels: int, samplerate: int, sample_width: int, buffer_seconds: float = 10.0, **kwargs):
+        self.shm_size = int(buffer_seconds*samplerate)*channels*sample_width
+        self.shm = shared_memory.SharedMemory(create=True, size=self.shm_size)
+        self.cmd_queue = multiprocessing.Queue()
+        self.encoded = multiprocessing.Value('q', 0)
+        self.submitted = 0
+        self.encoder = multiprocessing.Process(target=flac_encoder_process, args=(self.shm.name, channels, samplerate, self.cmd_queue, self.encoded))
+        self.encoder.start()
+        super().__init__(make_filename, channels, samplerate, sample_width, **kwargs)
+
+    def encoder_lag(self) -> float:
+        # Data waiting for the encoder, seconds
+        return (self.submitted - self.encoded.value)/(self.samplerate*self.frame_size)
+
+    def data_offset(self) -> Optional[int]:
+        return None
+
+    def stats(self) -> Dict:
+        return dict(super().stats(), encoder_lag=round(self.encoder_lag(), 2))
+
+    def patch_header(self, sync: bool = True):
+        # FLAC header is written by the encoder
+        self.patched_at = time.monotonic()
+
+    def _open_segment(self):
+        self.file = self.filename
+        self.cmd_queue.put(("open", self.filename))
+
+    def _write_data(self, data: memoryview):
+        pos = 0
+        while pos < len(data):
+            # Wait if the encoder is a whole buffer behind
+            free = self.shm_size - (self.submitted - self.encoded.value)
+            if free < self.frame_size:
+                if self.encoder.is_alive() is False:
+                    # The position will never move, the data cannot be written
+                    raise RuntimeError("FLAC encoder of {} stopped with exit code {}".format(self.filename, self.encoder.exitcode))
+                time.sleep(0.01)
+                continue
+            start = self.submitted % self.shm_size
+            n = min(len(data) - pos, free, self.shm_size - start)
+            n -= n % self.frame_size
+            self.shm.buf[start:start + n] = data[pos:pos + n]
+            self.cmd_queue.put(("data", start, n))
+            self.submitted += n
+            pos += n
+
+    def _close_segment(self):
+        self.cmd_queue.put(("close",))
+
+    def close(self):
+        # Last segment is closed, wait until the encoder writes all the data
+        super().close()
+        if self.encoder is not None:
+            self.cmd_queue.put(("quit",))
+            self.encoder.join()
+            self.encoder = None
+            self.shm.close()
+            self.shm.unlink()
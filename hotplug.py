@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+# Sound card and serial port hotplug events, instead of rescanning the devices periodically
+
+import os
+import time
+import struct
+import socket
+import select
+import ctypes
+import ctypes.util
+import logging
+from typing import List, Optional, Tuple
+import utils
+
+NETLINK_KOBJECT_UEVENT = 15
+IN_CREATE, IN_DELETE, IN_IGNORED, IN_NONBLOCK, IN_CLOEXEC = 0x100, 0x200, 0x8000, 0o4000, 0o2000000
+inotify_event = struct.Struct('iIII')
+serial_prefixes = ("ttyUSB", "ttyACM", "ttyAMA", "rfcomm")
+
+
+class DeviceWatcher:
+    # Changes of the devices of the subsystems ("sound", "tty"), from the best source available:
+    # - kernel uevents (netlink), the same events udev gets
+    # - inotify on /dev and /dev/snd, if netlink is not allowed (containers)
+    # - a scan of /proc/asound/cards and the serial ports every poll_interval seconds (not Linux)
+    def __init__(self, subsystems: Tuple[str, ...] = ("sound", "tty"), poll_interval: float = 5.0):
+        self.subsystems = subsystems
+        self.poll_interval = poll_interval
+        self.sock: Optional[socket.socket] = None
+        self.inotify_fd = -1
+        self.watches = {}  # Watch descriptor: directory
+        self.snapshot = None
+        self.events = 0
+        self.method = self._open()
+
+    def _open(self) -> str:
+        if hasattr(socket, "AF_NETLINK"):
+            try:
+                sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+                # Port id is assigned by the kernel, group 1: kernel uevents
+                sock.bind((0, 1))
+                self.sock = sock
+                return "netlink"
+            except OSError as e:
+                logging.debug("Netlink uevents are not available: %s", e)
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.libc, self.inotify_fd = libc, fd
+                for path in ("/dev", "/dev/snd"):
+                    self._watch(path)
+                return "inotify"
+        except (OSError, AttributeError, TypeError) as e:
+            logging.debug("inotify is not available: %s", e)
+        self.snapshot = self._scan()
+        return "poll"
+
+    def _watch(self, path: str):
+        if os.path.isdir(path) and path not in self.watches.values():
+            wd = self.libc.inotify_add_watch(self.inotify_fd, path.encode(), IN_CREATE | IN_DELETE)
+            if wd >= 0:
+                self.watches[wd] = path
+
+    def wait(self, timeout: float, settle: float = 1.0) -> List[Tuple[str, str]]:
+        # (action, subsystem) of the changes, waits up to timeout seconds for the first one. The events in the next settle seconds
+        # are collected too: a radio adds several devices at once (sound card, serial ports), and udev needs time to set them up
+        events = self._read(timeout)
+        if len(events) > 0:
+            deadline = time.monotonic() + settle
+            while time.monotonic() < deadline:
+                events += self._read(deadline - time.monotonic())
+        self.events += len(events)
+        return events
+
+    def _read(self, timeout: float) -> List[Tuple[str, str]]:
+        if self.method == "poll":
+            time.sleep(max(0.0, min(timeout, self.poll_interval)))
+            previous, self.snapshot = self.snapshot, self._scan()
+            return [("change", subsystem) for subsystem, before, after in zip(("sound", "tty"), previous, self.snapshot)
+                    if subsystem in self.subsystems and before != after]
+        fd = self.sock.fileno() if self.sock is not None else self.inotify_fd
+        if len(select.select([fd], [], [], max(0.0, timeout))[0]) == 0:
+            return []
+        if self.sock is not None:
+            return self._parse_uevent(self.sock.recv(16384))
+        try:
+            return self._parse_inotify(os.read(self.inotify_fd, 4096))
+        except BlockingIOError:
+            return []
+
+    def _parse_uevent(self, data: bytes) -> List[Tuple[str, str]]:
+        # "add@/devices/...\0ACTION=add\0DEVPATH=...\0SUBSYSTEM=sound\0..."
+        fields = dict(item.split("=", 1) for item in data.decode(errors="replace").split("\0") if "=" in item)
+        if fields.get("ACTION") in ("add", "remove") and fields.get("SUBSYSTEM") in self.subsystems:
+            return [(fields["ACTION"], fields["SUBSYSTEM"])]
+        return []
+
+    def _parse_inotify(self, data: bytes) -> List[Tuple[str, str]]:
+        events, pos = [], 0
+        while pos + inotify_event.size <= len(data):
+            wd, mask, _, size = inotify_event.unpack_from(data, pos)
+            name = data[pos + inotify_event.size:pos + inotify_event.size + size].rstrip(b'\0').decode(errors="replace")
+            pos += inotify_event.size + size
+            if mask & IN_IGNORED:
+                # The directory was deleted (/dev/snd, the last sound card is disconnected), it is watched again when it is created
+                self.watches.pop(wd, None)
+                continue
+            path = self.watches.get(wd)
+            action = "add" if mask & IN_CREATE else "remove"
+            if path == "/dev" and name == "snd":
+                # The first sound card is connected
+                self._watch("/dev/snd")
+                subsystem = "sound"
+            elif path == "/dev/snd":
+                subsystem = "sound"
+            elif path == "/dev" and name.startswith(serial_prefixes):
+                subsystem = "tty"
+            else:
+                continue
+            if subsystem in self.subsystems:
+                events.append((action, subsystem))
+        return events
+
+    def _scan(self) -> Tuple[Optional[str], List[str]]:
+        import serial.tools.list_ports
+        return utils.get_sound_cards(), sorted(port.device for port in serial.tools.list_ports.comports())
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        if self.inotify_fd >= 0:
+            os.close(self.inotify_fd)
+
+
+if __name__ == "__main__":
+    # python3 hotplug.py - print the events, connect or disconnect a radio to test
+    watcher = DeviceWatcher()
+    print("Waiting for the sound and serial device changes ({})".format(watcher.method))
+    while True:
+        for action, subsystem in watcher.wait(60.0):
+            print(time.strftime("%H:%M:%S"), action, subsystem)
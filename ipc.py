@@ -0,0 +1,91 @@
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+from typing import Dict, Optional
+
+
+# Messages between transceiver.py and recorder.py: 4-byte big endian length + JSON.
+# The sender sends a heartbeat when there is nothing to send, the receiver reconnects if nothing was received
+# for heartbeat_timeout seconds
+heartbeat_interval = 2.0
+heartbeat_timeout = 3*heartbeat_interval
+max_message = 64*1024
+header = struct.Struct('>I')
+
+
+def send_message(sock: socket.socket, message: Dict):
+    data = json.dumps(message).encode()
+    sock.sendall(header.pack(len(data)) + data)
+
+
+class MessageReader:
+    # Blocking reader, the socket timeout is used for the heartbeat check
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def read(self) -> Optional[Dict]:
+        # Next message, or None if the connection is closed. socket.timeout is raised if the sender is silent
+        while True:
+            if len(self.buffer) >= header.size:
+                size = header.unpack_from(self.buffer)[0]
+                if size > max_message:
+                    raise ValueError("IPC message too big: {}".format(size))
+                if len(self.buffer) >= header.size + size:
+                    data = bytes(self.buffer[header.size:header.size + size])
+                    del self.buffer[:header.size + size]
+                    return json.loads(data.decode())
+            data = self.sock.recv(4096)
+            if len(data) == 0:
+                return None
+            self.buffer += data
+
+
+class UpdateQueue:
+    # Latest values only: updates, which were not sent yet, are merged, so during fast tuning
+    # only the last frequency is sent. "civ_time" is the time of the CI-V frame of the latest update
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending: Dict = {}
+        self.state: Dict = {}
+        self.coalesced = 0
+
+    def put(self, update: Dict):
+        with self.condition:
+            self.coalesced += len(self.pending.keys() & update.keys())
+            self.pending.update(update)
+            self.state.update(update)
+            self.condition.notify()
+
+    def resend(self):
+        # All the latest values, for the receiver connected again
+        self.put({key: value for key, value in self.state.items() if key != "civ_time"})
+
+    def get(self, timeout: float) -> Dict:
+        # Merged updates, or an empty dict after the timeout
+        with self.condition:
+            if len(self.pending) == 0:
+                self.condition.wait(timeout)
+            update, self.pending = self.pending, {}
+            return update
+
+
+def sender_loop(updates: UpdateQueue, address, is_active, min_interval: float = 0.02, reconnect_interval: float = 2.0):
+    # Connect to the receiver and send the updates, reconnect on errors.
+    # min_interval limits the message rate, the updates received meanwhile are coalesced
+    while is_active():
+        try:
+            with socket.create_connection(address, timeout=5.0) as sock:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                logging.debug("IPC connected to %s:%d", *address)
+                updates.resend()
+                while is_active():
+                    update = updates.get(timeout=heartbeat_interval)
+                    send_message(sock, update if len(update) > 0 else {"heartbeat": time.time()})
+                    time.sleep(min_interval)
+        except OSError as e:
+            logging.debug("IPC connection to %s:%d: %s", address[0], address[1], e)
+            time.sleep(reconnect_interval)
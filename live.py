@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+# Live listening: the capture process writes the monitor audio to one shared memory ring,
+# each browser reads it with its own cursor
+
+import sys
+import time
+import threading
+import logging
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from typing import Callable, Dict, List, Optional, Tuple
+import decimator
+
+encodings = {"ulaw": 1, "pcm": 2}  # Bytes per sample
+
+
+def ulaw_encode(samples: np.ndarray) -> bytes:
+    # G.711 mu-law, 8 bits per sample: half of the PCM bandwidth and enough for the voice and CW
+    x = samples.astype(np.int32)
+    sign = (x < 0).astype(np.int32) << 7
+    x = np.minimum(np.abs(x), 32635) + 0x84
+    exponent = np.floor(np.log2(x)).astype(np.int32) - 7
+    mantissa = (x >> (exponent + 3)) & 0x0F
+    return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+
+def ulaw_decode(data: bytes) -> np.ndarray:
+    u = ~np.frombuffer(data, dtype=np.uint8).astype(np.int32) & 0xFF
+    exponent, mantissa = (u >> 4) & 0x07, u & 0x0F
+    x = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    return np.where(u & 0x80, -x, x).astype(np.int16)
+
+
+class SharedRing:
+    # Single producer, many readers. The producer only moves write_pos, a reader keeps its own cursor (absolute byte position).
+    # The data is never locked: a reader checks after the copy, that the producer has not overwritten it
+    def __init__(self, size: int):
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.write_pos = multiprocessing.Value('q', 0)
+        self.samplerate = multiprocessing.Value('i', 0)  # Set by the producer, 0 - no data yet
+
+    def write(self, data: bytes):
+        n = len(data)
+        if n > self.size:
+            data, n = data[n - self.size:], self.size
+        pos = self.write_pos.value
+        start = pos % self.size
+        first = min(n, self.size - start)
+        self.shm.buf[start:start + first] = data[:first]
+        if first < n:
+            self.shm.buf[0:n - first] = data[first:]
+        self.write_pos.value = pos + n
+
+    def read(self, cursor: int, max_size: int) -> Optional[bytes]:
+        # Data from the cursor, None if it was already overwritten (the reader is more than the ring size behind)
+        end = self.write_pos.value
+        n = min(end - cursor, max_size)
+        if end - cursor > self.size:
+            return None
+        if n <= 0:
+            return b''
+        start = cursor % self.size
+        first = min(n, self.size - start)
+        data = bytes(self.shm.buf[start:start + first]) + bytes(self.shm.buf[0:n - first])
+        if self.write_pos.value - cursor > self.size:
+            return None
+        return data
+
+    def close(self, unlink: bool = False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def monitor_thread(capture, ring: SharedRing, enabled_event: multiprocessing.Event, stop_event: threading.Event,
+                   target_rate: int, encoding: str, interval: float):
+    # Runs in the capture process, like the spectrum thread: the audio comes from the capture monitor tap
+    # and is mixed to mono, downsampled and encoded once for all clients
+    factor = max(1, capture.samplerate // target_rate) if target_rate > 0 else 1
+    mixer = decimator.Decimator(capture.samplerate, capture.channels, factor, 1)
+    ring.samplerate.value = mixer.out_samplerate
+    while stop_event.wait(interval) is False:
+        capture.monitor_enabled = enabled_event.is_set()
+        if capture.monitor_enabled is False:
+            continue
+        data = mixer.process(capture.monitor.read(capture.monitor.size))
+        if len(data) > 0:
+            ring.write(ulaw_encode(np.frombuffer(data, dtype=np.int16)) if encoding == "ulaw" else data)
+
+
+def start_monitor(capture, ring: SharedRing, enabled_event: multiprocessing.Event, target_rate: int = 12000, encoding: str = "ulaw",
+                  interval: float = 0.04) -> Tuple[threading.Thread, threading.Event]:
+    stop_event = threading.Event()
+    thread = threading.Thread(target=monitor_thread, args=(capture, ring, enabled_event, stop_event, target_rate, encoding, interval), name="Monitor", daemon=True)
+    thread.start()
+    logging.debug("Monitor started: %d Hz, %s", ring.samplerate.value or target_rate, encoding)
+    return thread, stop_event
+
+
+class MonitorClients:
+    # Per-client cursors in the shared ring. Each chunk is acknowledged by the browser, not more than max_unacked seconds
+    # may wait for the acknowledgement. A slow client is not waited for: when it is more than max_lag seconds behind,
+    # it is moved ahead to start_delay seconds before the write position (the skipped audio is counted)
+    def __init__(self, ring: SharedRing, encoding: str = "ulaw", max_lag: float = 2.0, max_unacked: float = 1.0, start_delay: float = 0.2,
+                 rate_window: float = 5.0):
+        self.ring = ring
+        self.encoding = encoding
+        self.sample_size = encodings[encoding]
+        self.max_lag = max_lag
+        self.max_unacked = max_unacked
+        self.start_delay = start_delay
+        self.rate_window = rate_window
+        self.clients: Dict[str, Dict] = {}
+
+    def bytes_per_second(self) -> int:
+        return max(1, self.ring.samplerate.value)*self.sample_size
+
+    def position_before(self, seconds: float) -> int:
+        # Write position minus seconds of audio, aligned to the sample size
+        end = self.ring.write_pos.value
+        return max(0, end - int(seconds*self.bytes_per_second())//self.sample_size*self.sample_size)
+
+    def add(self, sid: str):
+        self.clients[sid] = {"cursor": self.position_before(self.start_delay), "samplerate": 0, "unacked": collections.deque(),
+                             "sent": collections.deque(), "skipped": 0.0, "lag": 0.0}
+
+    def remove(self, sid: str):
+        self.clients.pop(sid, None)
+
+    def has_clients(self) -> bool:
+        return len(self.clients) > 0
+
+    def ack(self, sid: str):
+        client = self.clients.get(sid)
+        if client is not None and len(client["unacked"]) > 0:
+            client["unacked"].popleft()
+
+    def update(self, emit: Callable[[str, str, object], None]):
+        # emit(sid, event, data)
+        now = time.monotonic()
+        rate = self.bytes_per_second()
+        for sid, client in list(self.clients.items()):
+            if self.ring.samplerate.value == 0:
+                continue
+            if client["samplerate"] != self.ring.samplerate.value:
+                # New client or the capture was reopened
+                client["samplerate"] = self.ring.samplerate.value
+                client["cursor"] = self.position_before(self.start_delay)
+                emit(sid, 'monitor_format', {"samplerate": client["samplerate"], "encoding": self.encoding})
+            unacked = sum(size for _, size in client["unacked"])
+            backlog = self.ring.write_pos.value - client["cursor"]
+            client["lag"] = backlog/rate + (now - client["unacked"][0][0] if len(client["unacked"]) > 0 else 0.0)
+            if client["lag"] > self.max_lag or backlog > self.ring.size:
+                skip_to = self.position_before(self.start_delay)
+                client["skipped"] += max(0, skip_to - client["cursor"])/rate
+                client["cursor"] = skip_to
+                client["unacked"].clear()
+                continue
+            if unacked >= self.max_unacked*rate:
+                continue
+            data = self.ring.read(client["cursor"], int(self.max_unacked*rate) - unacked)
+            if data is None:
+                client["cursor"] = self.position_before(self.start_delay)
+                continue
+            data = data[:len(data)//self.sample_size*self.sample_size]
+            if len(data) == 0:
+                continue
+            client["cursor"] += len(data)
+            client["unacked"].append((now, len(data)))
+            client["sent"].append((now, len(data)))
+            emit(sid, 'monitor_audio', data)
+
+    def status(self) -> List[Dict]:
+        now = time.monotonic()
+        result = []
+        for sid, client in self.clients.items():
+            while len(client["sent"]) > 0 and client["sent"][0][0] < now - self.rate_window:
+                client["sent"].popleft()
+            result.append({"client": sid[:6], "lag_ms": int(client["lag"]*1000), "skipped_s": round(client["skipped"], 1),
+                           "rate_kbps": round(sum(size for _, size in client["sent"])/self.rate_window/1024, 1)})
+        return result
+
+
+def benchmark(clients: int = 20, seconds: float = 10.0, samplerate: int = 12000):
+    # Fan-out cost: one producer, the clients read every 50 ms, one of them never acknowledges
+    ring = SharedRing(samplerate*10)
+    ring.samplerate.value = samplerate
+    monitor = MonitorClients(ring)
+    for i in range(clients):
+        monitor.add("client{:02d}".format(i))
+    chunk = ulaw_encode(np.zeros(samplerate//20, dtype=np.int16))
+    cost = 0.0
+    for _ in range(int(seconds*20)):
+        ring.write(chunk)
+        t_start = time.perf_counter()
+        monitor.update(lambda sid, event, data: monitor.ack(sid) if event == 'monitor_audio' and sid != "client00" else None)
+        cost += time.perf_counter() - t_start
+    print("{} clients, {:.0f} us per pass: {}".format(clients, 1e6*cost/(seconds*20), monitor.status()[:2]))
+    ring.close(unlink=True)
+
+
+if __name__ == "__main__":
+    # python3 live.py [clients]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
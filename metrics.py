@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+# Metrics of the hot paths: latency histograms, Prometheus text format, a rolling history of the main values,
+# CPU and memory of the processes and the on-demand sampling profiler
+
+import os
+import sys
+import time
+import bisect
+import importlib
+import collections
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+import psutil
+
+# Seconds, from 100 us (a PortAudio callback) to 2.5 s (an SD card stall)
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    # Cumulative counts since the process start, like a Prometheus histogram. Cheap enough for the audio callback
+    def __init__(self, buckets: Tuple[float, ...] = latency_buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t_start)
+
+    def snapshot(self) -> Dict:
+        # Plain values, to be sent from the capture process with its statistics
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+
+def format_labels(labels: Optional[Dict[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items()) + "}"
+
+
+def metric_lines(name: str, kind: str, help_text: str, samples: Iterable[Tuple[Optional[Dict[str, str]], float]]) -> List[str]:
+    # Gauge or counter in the Prometheus text format, one sample per label set
+    lines = ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, kind)]
+    for labels, value in samples:
+        lines.append("{}{} {}".format(name, format_labels(labels), float(value)))
+    return lines
+
+
+def histogram_lines(name: str, help_text: str, samples: Iterable[Tuple[Optional[Dict[str, str]], Dict]]) -> List[str]:
+    # Histogram snapshots (Histogram.snapshot()), the bucket counts are cumulative in the text format
+    lines = ["# HELP {} {}".format(name, help_text), "# TYPE {} histogram".format(name)]
+    for labels, snapshot in samples:
+        total = 0
+        for bound, count in zip(list(snapshot["buckets"]) + ["+Inf"], snapshot["counts"]):
+            total += count
+            lines.append("{}_bucket{} {}".format(name, format_labels(dict(labels or {}, le=bound)), total))
+        lines.append("{}_sum{} {}".format(name, format_labels(labels), snapshot["sum"]))
+        lines.append("{}_count{} {}".format(name, format_labels(labels), snapshot["count"]))
+    return lines
+
+
+class History:
+    # The main values sampled every interval seconds, for the last length samples (1 hour by default)
+    def __init__(self, interval: float = 10.0, length: int = 360):
+        self.interval = interval
+        self.samples: Deque[Tuple[float, Dict[str, float]]] = collections.deque(maxlen=length)
+
+    def add(self, values: Dict[str, float]):
+        self.samples.append((time.time(), values))
+
+    def to_dict(self) -> Dict:
+        # Column per value, the values missing in some samples are None
+        names = sorted(set(name for _, values in self.samples for name in values))
+        return {"interval": self.interval, "time": [round(t, 1) for t, _ in self.samples],
+                "values": {name: [values.get(name) for _, values in self.samples] for name in names}}
+
+
+class ProcessMonitor:
+    # CPU and memory of the processes by pid. The psutil objects are kept, so cpu_percent is the load since the previous call
+    def __init__(self):
+        self.processes: Dict[int, psutil.Process] = {}
+
+    def stats(self, pids: Dict[str, int]) -> Dict[str, Dict]:
+        result = {}
+        for name, pid in pids.items():
+            try:
+                if pid not in self.processes:
+                    self.processes[pid] = psutil.Process(pid)
+                process = self.processes[pid]
+                with process.oneshot():
+                    cpu = process.cpu_times()
+                    result[name] = {"cpu_percent": process.cpu_percent(), "cpu_seconds": cpu.user + cpu.system,
+                                    "rss_bytes": process.memory_info().rss, "threads": process.num_threads()}
+            except psutil.Error:
+                self.processes.pop(pid, None)
+        return result
+
+
+def _original(module: str):
+    # Not monkey patched module: under eventlet, the sampler must be a real thread, a green thread would only see itself
+    if "eventlet" in sys.modules:
+        from eventlet import patcher
+        return patcher.original(module)
+    return importlib.import_module(module)
+
+
+class Sampler:
+    # Sampling profiler: the stacks of all threads are taken every interval seconds by a separate OS thread, for seconds seconds.
+    # Under eventlet the main thread stack is the green thread running at that moment (or the hub, when idle).
+    # The result is in the collapsed stack format (flamegraph.pl, speedscope): "thread;outer;...;inner count" per line
+    def __init__(self):
+        self.stacks: collections.Counter = collections.Counter()
+        self.samples = 0
+        self.stop_time = 0.0
+        self.thread = None
+        self.result: Optional[str] = None
+
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds: float = 30.0, interval: float = 0.01):
+        # Called again while running: the profiling time is changed
+        self.stop_time = time.monotonic() + seconds
+        if self.running():
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self.result = None
+        self.thread = _original("threading").Thread(target=self._run, args=(interval,), name="Sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_time = 0.0
+
+    def pop_result(self) -> Optional[str]:
+        # Collapsed stacks of the finished profile, once
+        result, self.result = self.result, None
+        return result
+
+    def _run(self, interval: float):
+        sleep = _original("time").sleep
+        own = _original("threading").get_ident()
+        while time.monotonic() < self.stop_time:
+            names = {thread.ident: thread.name for thread in _original("threading").enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append("{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            sleep(interval)
+        self.result = "".join("{} {}\n".format(stack, count) for stack, count in self.stacks.most_common())
+
+    def status(self) -> Dict:
+        return {"running": self.running(), "samples": self.samples, "seconds_left": round(max(0.0, self.stop_time - time.monotonic()), 1) if self.running() else 0.0}
+
+
+if __name__ == "__main__":
+    # python3 metrics.py - observe cost of the histogram and a short profile of a busy loop
+    histogram = Histogram()
+    t_start = time.perf_counter()
+    for i in range(100000):
+        histogram.observe(i*1e-8)
+    print("Histogram: {:.2f} us per observe".format((time.perf_counter() - t_start)*10))
+    sampler = Sampler()
+    sampler.start(1.0)
+    while sampler.running():
+        sum(i*i for i in range(10000))
+    print(sampler.pop_result()[:500])
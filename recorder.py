@@ -16,30 +16,40 @@
 
 import eventlet  # sudo pip3 install eventlet
 eventlet.monkey_patch()
+from eventlet import tpool
 
-from flask import Flask, Response, render_template, request, jsonify, send_file, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, send_file, send_from_directory, abort
+from werkzeug.utils import safe_join
 from flask_socketio import SocketIO  # sudo pip3 install flask-socketio
 
 import time
-import sys
-import subprocess
+import math
 import os
 import threading
 import multiprocessing
 import queue
-import re
-import fnmatch
-import textwrap
-import json
 import argparse
 import audio
+import thumbnails
+import download
+import broadcast
+import status
+import catalog
+import wavwriter
+import archive
+import spectrum
+import live
+import activity
+import metrics
 import transceiver
+import ipc
+import station
+import worker
+import hotplug
 import pyaudio
-import wave
-import requests
 import logging
 import socket
-from typing import Tuple, Optional, Union, Any
+from typing import Dict, List, Tuple, Optional
 from datetime import datetime
 import serial.tools.list_ports
 import utils
@@ -51,15 +61,19 @@ app = Flask(__name__, template_folder=dname)
 app._static_folder = dname
 app.config['SECRET_KEY'] = '1234'
 socketio = SocketIO(app, async_mode='eventlet')
-socket_connected = False
+status_clients = broadcast.StatusBroadcaster(default_rate=10.0)
+status_wakeup = threading.Event()  # Set on a tuning change, to send the status without waiting
 port_number = 8000
 app_active = False
+# Seconds from the process start to: the __main__ start (imports), the first answer of the web server, PortAudio and catalog ready
+startup_stats: Dict[str, float] = {}
 recording_active = False
 recording_start = 0.0
 recording_samplerate = 44100
 recording_channels = 1
 recordings_path = "/home/pi/Documents" if utils.is_raspberry_pi() else utils.get_app_path()
-recordings_count = len(audio.get_files_list(recordings_path))
+recordings_count = 0
+recordings_catalog: Optional[catalog.RecordingsCatalog] = None
 
 # Transceiver
 
@@ -67,33 +81,270 @@ transceiver_name: str = ""  # IC705, IC7300, etc
 transceiver_freq_hz: int = 0  # Frequency in Hz
 transceiver_mode: str = ""  # AM, FM, USB, LSB, etc
 transceiver_time: str = "00:00"
+transceiver_levels: Dict[str, int] = {}  # Polled values: smeter, filter_width, preamp, attenuator, rf_gain
+transceiver_poll_stats: Dict = {}
+transceiver_civ_time: float = 0.0  # Time of the CI-V frame of the last tuning change
+# CI-V frame -> recorder, -> Socket.IO emit, -> browser and back
+transceiver_latency = {"ipc": status.CostMeter(), "emit": status.CostMeter(), "browser": status.CostMeter()}
 transceiver_queue_in = multiprocessing.Queue()
 transceiver_queue_out = multiprocessing.Queue()
 
 # Audio Interface
 
-pd = pyaudio.PyAudio()
+portaudio = audio.PortAudio()  # Initialized in the background after the web server start, see startup_thread
 recording_interface = "USB Audio"
-recording_stop_event = multiprocessing.Event()
+recording_stats_queue = multiprocessing.Queue()
+recording_stats = {}
+recording_segment_seconds = 0  # Start a new file after N seconds, 0 - no limit
+recording_segment_size = 0  # Start a new file after N bytes, 0 - no limit (files over 4 GB are written as RF64)
+recording_format = "wav"  # wav or flac, FLAC is encoded in a separate process
+recording_split_on_tuning = False  # Start a new file on frequency/mode change, otherwise the change is added to the index file
+recording_tuning_queue = multiprocessing.Queue()
+recording_squelch: Optional[dict] = None  # Squelch mode: only the signal bursts are recorded, see worker.CaptureWorker.configure
+recording_decimate = False  # Record CW/SSB/AM/FM at a lower sample rate in mono, see decimator.mode_profiles
+recording_fsync_interval = 10.0  # Seconds of audio at risk on a power cut: the file is synced and the WAV header is updated every N seconds
+recording_write_block = 1024*1024  # Bytes, the data is written to the SD card in large aligned blocks
+recording_preallocate = 32*1024*1024  # Bytes, the file space is reserved ahead of the data
+recording_disk_guard = {"reserve": 200*1024*1024, "action": "stop"}  # Free space reserve, "stop" the recording or "rotate" (delete the oldest files)
+recording_disk_full = False
+recording_activity = True  # Per-second level summary next to each recording, see activity.py
+recording_throughput = station.Throughput()
+recording_core: Optional[int] = None  # CPU core of the main capture process
+capture_worker: Optional[worker.CaptureWorker] = None
+
+# Additional transceiver + audio interface pairs, recorded together with the main one
+stations: Dict[str, station.Station] = {}
+
+# Time-shift (pre-trigger) buffer: the last timeshift_seconds are written to the file on record start
+
+timeshift_seconds = 0.0  # 0 - disabled
+timeshift_max_memory = 64*1024*1024  # Bytes, limit for the Raspberry Pi RAM
+
+# Live spectrum: rows are calculated in the capture process, each client gets them with its own width and rate
+
+spectrum_fps = 10.0
+spectrum_queue = multiprocessing.Queue(maxsize=100)
+spectrum_event = multiprocessing.Event()
+spectrum_clients = {}  # sid: {"width": pixels, "fps": rate, "sent": time}
+spectrum_row_cost = 0.0
+
+# Live listening: the capture process writes the mono, downsampled audio to one shared ring, each client has its own cursor
+
+monitor_samplerate = 12000  # Hz, the capture rate is divided by an integer factor, 0 - not downsampled
+monitor_encoding = "ulaw"  # ulaw (8 bits) or pcm (16 bits)
+monitor_event = multiprocessing.Event()  # Set while there are listeners
+monitor_ring: Optional[live.SharedRing] = None
+monitor_clients: Optional[live.MonitorClients] = None
+
+# Thumbnails of the recordings, generated by a low priority background process
+
+thumbnails_dir = os.path.join(recordings_path, ".thumbnails")
+thumbnails_budget = 50*1024*1024  # Bytes
+thumbnails_queue = multiprocessing.Queue()
+thumbnails_pause = multiprocessing.Event()  # Set while recording
+
+# Archive: the finished WAV files are converted to FLAC by low priority processes, the oldest files are deleted over the disk budget
+
+archive_convert = False
+archive_budget = 0  # Bytes, 0 - no limit
+archive_processes = 0  # 0 - all cores but one
+archiver: Optional[archive.Archiver] = None
+
+# Status values, that are slow to get, are cached. The audio device is checked again on a sound card hotplug (hotplug_thread)
+
+status_audio = status.CachedValue(lambda: portaudio.interface_connected(recording_interface), ttl=300.0)
+status_disk_space = status.CachedValue(lambda: utils.get_disk_space()[0], ttl=5.0)
+status_ip = status.CachedValue(utils.get_ip_address, ttl=10.0)
+status_cost = status.CostMeter()
+status_soc = status.CachedValue(lambda: (utils.get_soc_temperature(), utils.get_throttled()), ttl=5.0)
+
+# Metrics: /metrics (Prometheus text format), the rolling history of the main values and the on-demand sampling profiler
+
+recording_histograms: Dict = {}  # Capture process latency histograms, see metrics.Histogram.snapshot
+transceiver_civ_stats: Dict[str, Dict] = {}  # Radio name: CI-V decoder counters, frames per second and the transceiver.py pid
+transceiver_latency_histograms = {name: metrics.Histogram() for name in transceiver_latency}
+emit_time = metrics.Histogram()
+metrics_history = metrics.History(interval=10.0, length=360)
+metrics_processes = {"history": metrics.ProcessMonitor(), "scrape": metrics.ProcessMonitor()}  # Separate, cpu_percent is measured since the previous call
+profiler = metrics.Sampler()
+profiles: Dict[str, str] = {}  # Process name: collapsed stacks of its last profile
 
 # Recording
 
 # manager = Manager()
 # recording_active = manager.Value('i', 0)
 
+def get_catalog() -> catalog.RecordingsCatalog:
+    global recordings_catalog
+    if recordings_catalog is None:
+        recordings_catalog = catalog.RecordingsCatalog(recordings_path)
+    return recordings_catalog
+
+
+def update_recording_stats():
+    global recording_stats, recording_histograms
+    # Capture process sends its buffer statistics periodically, keep the latest one.
+    # When a recording is finished, the list of files is sent
+    while True:
+        try:
+            stats = recording_stats_queue.get_nowait()
+        except queue.Empty:
+            break
+        files = stats.pop("files", None)
+        if files is not None:
+            recording_files_added(files)
+        recording_histograms = stats.pop("histograms", recording_histograms)
+        profile = stats.pop("profile", None)
+        if profile is not None:
+            profiles["capture"] = profile
+        recording_files_removed(stats.pop("files_removed", None) or [])
+        if stats.pop("disk_full", False):
+            recording_stopped_disk_full()
+        recording_throughput.update(stats.get("bytes_written", 0), stats.get("time", time.monotonic()))
+        recording_stats = stats
+    for st in stations.values():
+        files, removed = st.update_stats()
+        if len(files) > 0:
+            recording_files_added(files)
+        recording_files_removed(removed)
+
+
+def recording_files_added(files: List[str]):
+    global recordings_count
+    for file_name in files:
+        get_catalog().add_file(os.path.basename(file_name))
+        thumbnails_queue.put(os.path.basename(file_name))
+    recordings_count = get_catalog().count()
+    if archiver is not None:
+        archiver.add([os.path.basename(file_name) for file_name in files])
+
+
+def recording_files_removed(files: List[str]):
+    # Oldest files, deleted by the capture process on a full disk (it removes them from the catalog too)
+    global recordings_count
+    if len(files) > 0:
+        recordings_count = get_catalog().count()
+
+
+def recording_stopped_disk_full():
+    # Capture process has stopped the recording before the disk is full
+    global recording_disk_full
+    logging.warning("Recording stopped: the disk is full")
+    recording_disk_full = True
+    on_record_stop()
+
+
+def stations_status() -> Dict:
+    # Aggregate write rate and drop counters of all capture processes
+    rate = recording_throughput.rate if recording_active else 0.0
+    dropped = recording_stats.get("dropped_frames", 0)
+    for st in stations.values():
+        rate += st.throughput.rate if st.active() else 0.0
+        dropped += st.stats.get("dropped_frames", 0)
+    return {"stations": [st.status() for st in stations.values()],
+            "throughput_kbps": round(rate/1024, 1),
+            "dropped_frames_total": dropped}
+
+
+def recording_writer_options() -> dict:
+    return {"max_seconds": recording_segment_seconds, "max_bytes": recording_segment_size, "format": recording_format,
+            "patch_interval": recording_fsync_interval, "block_size": recording_write_block, "preallocate": recording_preallocate,
+            "activity": recording_activity}
+
+
+def recording_tuning_update():
+    # Send the current frequency and mode to the capture process, it places the change at the matching sample position
+    if capture_worker is not None:
+        recording_tuning_queue.put_nowait({"time": time.monotonic(), "frequency": transceiver_freq_hz, "mode": transceiver_mode})
+
+
+def timeshift_max_seconds() -> float:
+    # History that fits to the memory limit of the time-shift buffer
+    bytes_per_second = recording_samplerate*recording_channels*pyaudio.get_sample_size(pyaudio.paInt16)
+    return timeshift_max_memory/bytes_per_second
+
+
+def timeshift_buffer_seconds() -> float:
+    # Time-shift duration, limited by the memory available for the buffer
+    return min(timeshift_seconds, timeshift_max_seconds())
+
+
+def timeshift_memory() -> int:
+    # History and the margin of one capture buffer
+    return int((timeshift_buffer_seconds() + audio.capture_buffer_seconds)*recording_samplerate)*recording_channels*pyaudio.get_sample_size(pyaudio.paInt16)
+
+
+def timeshift_active() -> bool:
+    return timeshift_seconds > 0 and capture_worker is not None and capture_worker.is_alive()
+
+
+def capture_start():
+    # Capture processes are started once and kept running, so a recording starts without opening the audio device
+    global capture_worker
+    monitor = {"ring": monitor_ring, "event": monitor_event, "samplerate": monitor_samplerate, "encoding": monitor_encoding} if monitor_ring is not None else None
+    capture_worker = worker.CaptureWorker(recording_interface, recording_stats_queue, recording_tuning_queue,
+                                          spectrum_queue, spectrum_event, spectrum_fps, recording_core, monitor)
+    for st in stations.values():
+        st.open()
+    capture_configure()
+    recording_tuning_update()
+
+
+def capture_configure():
+    # The stream is reopened only if the sample rate or the number of channels is changed,
+    # other settings are used for the next recording
+    if capture_worker is not None:
+        logging.debug('Capture settings: {} Hz, {} channels, time-shift {:.1f}s'.format(recording_samplerate, recording_channels, timeshift_buffer_seconds()))
+        capture_worker.configure(recording_channels, recording_samplerate, timeshift_buffer_seconds(), recording_writer_options(), recording_split_on_tuning,
+                                 recording_squelch, recording_decimate, recording_disk_guard, recordings_path)
+    for st in stations.values():
+        st.configure(recording_channels, recording_samplerate, recording_writer_options(), recording_split_on_tuning, recording_squelch, recording_decimate,
+                     recording_disk_guard, recordings_path)
+
+
+def capture_stop():
+    if capture_worker is not None:
+        capture_worker.close()
+    for st in stations.values():
+        st.close()
+
+
 def device_status():
+    with status_cost.measure():
+        return device_status_update()
+
+
+def device_status_update():
+    update_recording_stats()
     return {'recordings': recordings_count,
-            "audio": audio.interface_connected(pd, filter=recording_interface),
+            "audio": status_audio.get(),
             "recording_active": recording_active,
-            "recording_time": (time.monotonic() - recording_start) if recording_active else 0,
+            "recording_time": int(time.monotonic() - recording_start) if recording_active else 0,
             "recording_samplerate": recording_samplerate,
             "recording_channels": recording_channels,
-            "disk_space": round(utils.get_disk_space()[0]/(1024*1024*1024), 2),
+            "recording_stats": recording_stats,
+            "timeshift_active": timeshift_active(),
+            "timeshift_seconds": round(timeshift_buffer_seconds(), 1) if timeshift_seconds > 0 else 0,
+            "timeshift_memory": timeshift_memory() if timeshift_seconds > 0 else 0,
+            "start_latency_ms": recording_stats.get("start_latency_ms", 0),
+            "spectrum_row_cost_ms": round(spectrum_row_cost*1000, 2),
+            "disk_space": round(status_disk_space.get()/(1024*1024*1024), 2),
+            "disk_full": recording_disk_full,
             "time": datetime.now().strftime('%H:%M:%S'),
             "transceiver": transceiver_name,
             "frequency": transceiver_freq_hz,
             "mode": transceiver_mode,
-            "ip": "http://{}:{}".format(utils.get_ip_address(), port_number)}
+            "levels": transceiver_levels,
+            "civ_poll": transceiver_poll_stats,
+            "civ_time": transceiver_civ_time,
+            "civ_latency_ms": {name: round(meter.average*1000, 1) for name, meter in transceiver_latency.items()},
+            "ip": "http://{}:{}".format(status_ip.get(), port_number),
+            "status_cost_ms": round(status_cost.average*1000, 3),
+            "downloads": download.transfer_stats.status(),
+            "archive": archiver.status() if archiver is not None else {},
+            "monitor": monitor_clients.status() if monitor_clients is not None else [],
+            "startup": dict(startup_stats),
+            **stations_status()}
 
 
 @app.route('/')
@@ -101,14 +352,242 @@ def main_page():
     return render_template('index.html', async_mode=socketio.async_mode)
 
 
+def recordings_query() -> dict:
+    # "after" or "before": catalog.page_cursor() of the row next to the page, "page" is only the shown page number
+    query = {"page": max(0, request.args.get("page", 0, type=int)),
+             "sort": request.args.get("sort", "created"),
+             "descending": request.args.get("order", "desc") == "desc",
+             "band": request.args.get("band"),
+             "mode": request.args.get("mode"),
+             "date": request.args.get("date"),
+             "after": catalog.parse_cursor(request.args.get("after")),
+             "before": catalog.parse_cursor(request.args.get("before"))}
+    if query["after"] is None and query["before"] is None:
+        # No cursor: the first page
+        query["page"] = 0
+    return query
+
+
+def recordings_select(page_size: int) -> Tuple[dict, List[Dict], int, Optional[str], Optional[str]]:
+    # Query, the page of files, the total and the cursors of the previous and the next pages
+    query = recordings_query()
+    files, total = get_catalog().list(page_size, **{key: value for key, value in query.items() if key != "page"})
+    prev_cursor = catalog.page_cursor(files[0], query["sort"]) if len(files) > 0 and query["page"] > 0 else None
+    next_cursor = catalog.page_cursor(files[-1], query["sort"]) if len(files) == page_size and (query["page"] + 1)*page_size < total else None
+    return query, files, total, prev_cursor, next_cursor
+
+
 @app.route('/recordings.html')
 def recordings_page():
-    return render_template('recordings.html', async_mode=socketio.async_mode, wav_files=audio.get_files_list(recordings_path))
+    page_size = 50
+    query, files, total, prev_cursor, next_cursor = recordings_select(page_size)
+    return render_template('recordings.html', async_mode=socketio.async_mode, files=files, total=total, query=query, prev_cursor=prev_cursor,
+                           next_cursor=next_cursor, pages=(total + page_size - 1)//page_size, bands=catalog.bands.keys(), modes=get_catalog().modes())
+
+
+@app.route('/api/recordings')
+def recordings_list():
+    page_size = min(max(request.args.get("page_size", 50, type=int), 1), 500)
+    _, files, total, prev_cursor, next_cursor = recordings_select(page_size)
+    return jsonify({"total": total, "files": files, "prev": prev_cursor, "next": next_cursor})
+
+
+@app.route('/api/recordings/<name>/star', methods=['POST'])
+def recording_star(name):
+    # {"starred": true}: the recording is kept by the archive retention rules
+    starred = bool((request.get_json(silent=True) or {}).get("starred", True))
+    if get_catalog().set_starred(name, starred) is False:
+        abort(404)
+    return jsonify({"name": name, "starred": starred})
+
+
+@app.route('/api/recordings/<name>/activity')
+def recording_activity_segments(name):
+    # Active parts of the recording from its activity index, with the byte ranges in the WAV file.
+    # ?level_db=6&snr_db=20: detection thresholds, ?detail=1: the per-second values too
+    path = safe_join(recordings_path, name)
+    index_path = wavwriter.activity_filename(path) if path is not None else None
+    if index_path is None or os.path.isfile(index_path) is False:
+        abort(404)
+    samplerate, channels, records = activity.read_activity(index_path)
+    info = catalog.read_audio_info(path)
+    segments = activity.active_segments(records, request.args.get("level_db", 6.0, type=float), request.args.get("snr_db", 20.0, type=float))
+    result = {"name": name, "seconds": len(records), "samplerate": samplerate, "channels": channels,
+              "segments": activity.describe_segments(records, segments, samplerate, info.get("block_align", channels*2), info.get("data_offset"), info.get("data_size"))}
+    if request.args.get("detail", 0, type=int):
+        result.update(rms=(records["rms"]/100.0).tolist(), peak=(records["peak"]/100.0).tolist(), snr=(records["snr"]/100.0).tolist(),
+                      flatness=(records["flatness"]/65535.0).round(3).tolist(), clips=records["clips"].tolist())
+    return jsonify(result)
+
+
+def metrics_pids() -> Dict[str, int]:
+    pids = {"recorder": os.getpid()}
+    if capture_worker is not None:
+        pids["capture"] = capture_worker.process.pid
+    for st in stations.values():
+        if st.worker is not None:
+            pids["capture-" + st.name] = st.worker.process.pid
+    for civ_stats in transceiver_civ_stats.values():
+        # One transceiver.py process reads all radios
+        if civ_stats.get("pid") and civ_stats["pid"] not in pids.values():
+            pids["transceiver"] = civ_stats["pid"]
+    return pids
+
+
+def capture_sources() -> List[Tuple[str, Dict, Dict]]:
+    # Station name, the latest statistics and histograms of each capture process
+    return [("main", recording_stats, recording_histograms)] + [(st.name, st.stats, st.histograms) for st in stations.values()]
+
+
+def queue_depths() -> Dict[str, int]:
+    depths = {}
+    for name, q in (("stats", recording_stats_queue), ("tuning", recording_tuning_queue), ("spectrum", spectrum_queue), ("thumbnails", thumbnails_queue)):
+        try:
+            depths[name] = q.qsize()
+        except NotImplementedError:
+            # macOS
+            pass
+    if archiver is not None:
+        depths["archive"] = archiver.status()["queued"]
+    return depths
+
+
+def metrics_values() -> Dict[str, float]:
+    # Main values for the history, sampled every metrics_history.interval seconds
+    update_recording_stats()
+    sources = capture_sources()
+    soc_temperature, throttled = status_soc.get()
+    values = {"recording_active": int(recording_active), "throughput_kbps": stations_status()["throughput_kbps"],
+              "dropped_frames": sum(stats.get("dropped_frames", 0) for _, stats, _ in sources),
+              "input_overflows": sum(stats.get("input_overflows", 0) for _, stats, _ in sources),
+              "buffer_level": max(stats.get("buffer_level", 0)/max(1, stats.get("buffer_size", 1)) for _, stats, _ in sources),
+              "write_p99_ms": max(stats.get("write_p99_ms", 0.0) for _, stats, _ in sources),
+              "civ_frames_per_second": sum(civ_stats["frames_per_second"] for civ_stats in transceiver_civ_stats.values()),
+              "civ_errors": sum(civ_stats["errors"] + civ_stats["collisions"] for civ_stats in transceiver_civ_stats.values()),
+              "civ_emit_latency_ms": round(transceiver_latency["emit"].average*1000, 1), "status_cost_ms": round(status_cost.average*1000, 3),
+              "soc_temperature": soc_temperature, "soc_throttled": throttled}
+    for name, process in metrics_processes["history"].stats(metrics_pids()).items():
+        values["cpu_percent_" + name] = process["cpu_percent"]
+        values["rss_mb_" + name] = round(process["rss_bytes"]/(1024*1024), 1)
+    return {name: value for name, value in values.items() if value is not None}
+
+
+@app.route('/metrics')
+def metrics_page():
+    # Prometheus text format
+    update_recording_stats()
+    sources = capture_sources()
+    lines = []
+    for key, name, help_text in (("callback", "capture_callback_seconds", "PortAudio callback duration"),
+                                 ("read", "capture_read_seconds", "Capture ring buffer read duration"),
+                                 ("write", "writeframes_seconds", "Duration of the writes of the audio blocks (writer, index, disk)")):
+        lines += metrics.histogram_lines("hamrecorder_" + name, help_text,
+                                         [({"station": station_name}, histograms[key]) for station_name, _, histograms in sources if key in histograms])
+    lines += metrics.histogram_lines("hamrecorder_socketio_emit_seconds", "Socket.IO status emit duration", [(None, emit_time.snapshot())])
+    lines += metrics.histogram_lines("hamrecorder_civ_latency_seconds", "CI-V frame time to the recorder (ipc), to the emit and to the browser acknowledgement",
+                                     [({"stage": stage}, histogram.snapshot()) for stage, histogram in transceiver_latency_histograms.items()])
+    for key, name, kind, help_text in (("buffer_level", "capture_buffer_level_bytes", "gauge", "Capture ring buffer level"),
+                                       ("high_water", "capture_buffer_high_water_bytes", "gauge", "Capture ring buffer maximum level"),
+                                       ("buffer_size", "capture_buffer_size_bytes", "gauge", "Capture ring buffer size"),
+                                       ("dropped_frames", "capture_dropped_frames_total", "counter", "Frames lost on the capture ring buffer overruns"),
+                                       ("overruns", "capture_overruns_total", "counter", "Capture ring buffer overruns"),
+                                       ("input_overflows", "capture_input_overflows_total", "counter", "PortAudio input overflows"),
+                                       ("timeshift_overwritten", "timeshift_overwritten_total", "counter", "Time-shift frames overwritten before they were written"),
+                                       ("bytes_written", "recording_bytes", "gauge", "Bytes written by the current or the last recording")):
+        lines += metrics.metric_lines("hamrecorder_" + name, kind, help_text,
+                                      [({"station": station_name}, stats[key]) for station_name, stats, _ in sources if key in stats])
+    lines += metrics.metric_lines("hamrecorder_recording_active", "gauge", "Recording is active", [(None, int(recording_active))])
+    lines += metrics.metric_lines("hamrecorder_queue_depth", "gauge", "Items waiting in the queues", [({"queue": name}, depth) for name, depth in queue_depths().items()])
+    lines += metrics.metric_lines("hamrecorder_civ_frames_total", "counter", "CI-V frames decoded",
+                                  [({"radio": radio}, civ_stats["frames"]) for radio, civ_stats in transceiver_civ_stats.items()])
+    lines += metrics.metric_lines("hamrecorder_civ_frames_per_second", "gauge", "CI-V frames per second",
+                                  [({"radio": radio}, civ_stats["frames_per_second"]) for radio, civ_stats in transceiver_civ_stats.items()])
+    lines += metrics.metric_lines("hamrecorder_civ_parse_errors_total", "counter", "CI-V broken frames and collisions",
+                                  [({"radio": radio, "kind": kind}, civ_stats[kind]) for radio, civ_stats in transceiver_civ_stats.items() for kind in ("errors", "collisions")])
+    processes = metrics_processes["scrape"].stats(metrics_pids())
+    lines += metrics.metric_lines("hamrecorder_process_cpu_seconds_total", "counter", "User and system CPU time",
+                                  [({"process": name}, process["cpu_seconds"]) for name, process in processes.items()])
+    lines += metrics.metric_lines("hamrecorder_process_resident_memory_bytes", "gauge", "Resident memory",
+                                  [({"process": name}, process["rss_bytes"]) for name, process in processes.items()])
+    lines += metrics.metric_lines("hamrecorder_process_threads", "gauge", "OS threads", [({"process": name}, process["threads"]) for name, process in processes.items()])
+    lines += metrics.metric_lines("hamrecorder_status_cost_seconds", "gauge", "device_status() duration, moving average", [(None, status_cost.average)])
+    lines += metrics.metric_lines("hamrecorder_startup_seconds", "gauge", "Seconds from the process start to the startup stages",
+                                  [({"stage": stage}, seconds) for stage, seconds in startup_stats.items()])
+    soc_temperature, throttled = status_soc.get()
+    if soc_temperature is not None:
+        lines += metrics.metric_lines("hamrecorder_soc_temperature_celsius", "gauge", "SoC temperature", [(None, soc_temperature)])
+    if throttled is not None:
+        lines += metrics.metric_lines("hamrecorder_soc_throttled", "gauge", "Raspberry Pi throttling flags now (vcgencmd get_throttled)",
+                                      [({"flag": flag}, (throttled >> bit) & 1) for bit, flag in enumerate(("under_voltage", "frequency_capped", "throttled", "soft_temperature_limit"))])
+        lines += metrics.metric_lines("hamrecorder_soc_throttled_since_boot", "gauge", "Raspberry Pi throttling flags since the boot",
+                                      [({"flag": flag}, (throttled >> (16 + bit)) & 1) for bit, flag in enumerate(("under_voltage", "frequency_capped", "throttled", "soft_temperature_limit"))])
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/api/metrics/history')
+def metrics_history_page():
+    return jsonify(metrics_history.to_dict())
+
+
+@app.route('/api/profile', methods=['POST'])
+def profile_start():
+    # {"process": "recorder" or "capture", "seconds": 30, "interval": 0.01}: start the sampling profiler, 0 seconds - stop it
+    params = request.get_json(silent=True) or {}
+    process = params.get("process", "recorder")
+    seconds, interval = params.get("seconds", 30.0), params.get("interval", 0.01)
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) for value in (seconds, interval)):
+        abort(400)
+    if seconds < 0 or interval <= 0:
+        abort(400)
+    seconds, interval = min(float(seconds), 600.0), min(max(float(interval), 0.001), 1.0)
+    if process == "recorder":
+        if seconds > 0:
+            profiler.start(seconds, interval)
+        else:
+            profiler.stop()
+    elif process == "capture" and capture_worker is not None:
+        capture_worker.profile(seconds, interval)
+    else:
+        abort(400)
+    logging.debug("Profiler %s: %.0fs", process, seconds)
+    return jsonify({"process": process, "seconds": seconds, "interval": interval})
+
+
+@app.route('/api/profile')
+def profile_result():
+    # ?process=recorder: the last finished profile, collapsed stacks (flamegraph.pl, speedscope)
+    process = request.args.get("process", "recorder")
+    update_recording_stats()
+    result = profiler.pop_result()
+    if result is not None:
+        profiles["recorder"] = result
+    if process not in profiles:
+        return jsonify(profiler.status() if process == "recorder" else {}), 404
+    return Response(profiles[process], mimetype="text/plain")
 
 
 @app.route('/recordings/<wav_file>')
 def get_recording(wav_file):
-    return send_file(recordings_path + os.sep + wav_file, mimetype='audio/wav')
+    path = safe_join(recordings_path, wav_file)
+    if path is None or os.path.isfile(path) is False:
+        abort(404)
+    # Downloads are slowed down a bit during the recording, so the SD card has time for the capture writes
+    return download.send_recording(request, path, mimetype='audio/flac' if wav_file.endswith('.flac') else 'audio/wav',
+                                   pause=0.01 if recording_active else 0.0)
+
+
+@app.route('/thumbnails/<wav_file>')
+def get_thumbnail(wav_file):
+    file_path = safe_join(recordings_path, wav_file)
+    path = thumbnails.thumbnail_path(thumbnails_dir, file_path) if file_path is not None else None
+    if path is None or os.path.exists(thumbnails.no_thumbnail_path(path)):
+        abort(404)
+    if os.path.exists(path) is False:
+        # Not ready yet, ask the worker to make it
+        thumbnails_queue.put(wav_file)
+        abort(404)
+    thumbnails.touch(path)
+    return send_file(path, mimetype='image/png', max_age=3600)
 
 
 @app.route('/favicon.ico')
@@ -118,41 +597,47 @@ def favicon():
 
 @socketio.on('connect', namespace='/info')
 def on_connect():
-    global socket_connected, socketio
-    logging.debug('HTTP Client connected')
-    socketio.emit('device_status', device_status(), namespace='/info')
-    socket_connected = True
+    logging.debug('HTTP Client connected: %s', request.sid)
+    status_clients.add(request.sid)
+    status_clients.send_full(request.sid, device_status(), status_emit)
 
 
 @socketio.on('disconnect', namespace='/info')
 def on_disconnect():
-    global socket_connected
-    logging.debug('HTTP Client disconnected')
-    socket_connected = False
+    logging.debug('HTTP Client disconnected: %s', request.sid)
+    status_clients.remove(request.sid)
+    spectrum_remove(request.sid)
+    monitor_remove(request.sid)
 
 
 @socketio.on('record_start', namespace='/info')
 def on_record_start():
-    global recording_active, transceiver_name, transceiver_freq_hz, recording_start, recording_stop_event, recording_interface
+    global recording_active, recording_start, recording_disk_full
     if recording_active is False:
+        recording_disk_full = False
         logging.debug('Start Recording: interface {}, s/r={}, channels={}'.format(recording_interface, recording_samplerate, recording_channels))
         recording_active = True
         recording_start = time.monotonic()
-        recording_stop_event.clear()
-        multiprocessing.Process(target=audio.audio_recording_thread, args=(pd, recording_interface, recording_channels, recording_samplerate,
-                                                                           transceiver_name, transceiver_freq_hz, recording_stop_event)).start()
+        thumbnails_pause.set()
+        recording_throughput.reset()
+        # Capture is already running, the time-shift history (if enabled) is written first
+        capture_worker.record_start(transceiver_name, transceiver_freq_hz, transceiver_mode)
+        for st in stations.values():
+            st.start()
     else:
         logging.debug('Start Recording: already started')
 
 
 @socketio.on('record_stop', namespace='/info')
 def on_record_stop():
-    global recording_active, recordings_count, recordings_path, recording_stop_event
+    global recording_active
     if recording_active:
         logging.debug('Stop Recording')
         recording_active = False
-        recording_stop_event.set()
-        recordings_count = len(audio.get_files_list(recordings_path))
+        capture_worker.record_stop()
+        for st in stations.values():
+            st.stop()
+        thumbnails_pause.clear()
     else:
         logging.debug('Stop Recording: already stopped')
 
@@ -161,26 +646,280 @@ def on_record_stop():
 def set_mode_mono():
     global recording_channels
     recording_channels = 1
-    socketio.emit('device_status', device_status(), namespace='/info')
+    capture_configure()
+    status_broadcast()
 
 
 @socketio.on('set_mode_stereo', namespace='/info')
 def set_mode_stereo():
     global recording_channels
     recording_channels = 2
-    socketio.emit('device_status', device_status(), namespace='/info')
+    capture_configure()
+    status_broadcast()
 
 
 @socketio.on('set_sample_rate', namespace='/info')
 def set_sample_rate(sr):
     global recording_samplerate
     recording_samplerate = sr
-    socketio.emit('device_status', device_status(), namespace='/info')
+    capture_configure()
+    status_broadcast()
 
 
-def transceiver_update_thread():
-    global app_active, recording_active, socket_connected, transceiver_queue_out, transceiver_freq_hz, transceiver_name, transceiver_mode
+@socketio.on('set_timeshift', namespace='/info')
+def set_timeshift(seconds):
+    global timeshift_seconds
+    if not isinstance(seconds, (int, float, str)) or isinstance(seconds, bool):
+        return
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        return
+    if math.isfinite(seconds) is False:
+        return
+    timeshift_seconds = min(max(seconds, 0.0), timeshift_max_seconds())
+    capture_configure()
+    status_broadcast()
+
+
+@socketio.on('spectrum_start', namespace='/info')
+def on_spectrum_start(params):
+    # {"width": 16..4096 bins, "fps": rows per second, up to --spectrum-fps}, invalid requests are ignored
+    if not isinstance(params, dict):
+        return
+    try:
+        width, fps = int(params.get("width", 512)), float(params.get("fps", spectrum_fps))
+    except (TypeError, ValueError):
+        return
+    if not 16 <= width <= 4096 or not math.isfinite(fps) or fps <= 0:
+        return
+    logging.debug('Spectrum start: width {}, {} fps'.format(width, fps))
+    spectrum_clients[request.sid] = {"width": width, "fps": min(fps, spectrum_fps), "sent": 0.0}
+    spectrum_event.set()
+
+
+@socketio.on('spectrum_stop', namespace='/info')
+def on_spectrum_stop():
+    spectrum_remove(request.sid)
+
 
+def spectrum_remove(sid):
+    spectrum_clients.pop(sid, None)
+    if len(spectrum_clients) == 0:
+        spectrum_event.clear()
+
+
+def spectrum_update_thread():
+    global spectrum_row_cost
+
+    logging.debug("spectrum_update_thread started")
+    while app_active:
+        try:
+            row, spectrum_row_cost = spectrum_queue.get_nowait()
+        except queue.Empty:
+            time.sleep(0.02)
+            continue
+
+        now = time.monotonic()
+        for sid, client in list(spectrum_clients.items()):
+            if now - client["sent"] >= 0.9/client["fps"]:
+                client["sent"] = now
+                socketio.emit('spectrum', spectrum.decimate_row(row, client["width"]), namespace='/info', room=sid)
+
+    logging.debug("spectrum_update_thread ended")
+
+
+@socketio.on('monitor_start', namespace='/info')
+def on_monitor_start():
+    logging.debug('Live listening start: %s', request.sid)
+    monitor_clients.add(request.sid)
+    monitor_event.set()
+
+
+@socketio.on('monitor_stop', namespace='/info')
+def on_monitor_stop():
+    monitor_remove(request.sid)
+
+
+def monitor_remove(sid):
+    monitor_clients.remove(sid)
+    if monitor_clients.has_clients() is False:
+        monitor_event.clear()
+
+
+def monitor_emit(sid: str, event: str, data):
+    # Each audio chunk is acknowledged by the browser, the unacknowledged chunks limit the data in flight
+    socketio.emit(event, data, namespace='/info', to=sid, callback=(lambda *args: monitor_clients.ack(sid)) if event == 'monitor_audio' else None)
+
+
+def monitor_update_thread():
+    logging.debug("monitor_update_thread started")
+    while app_active:
+        if monitor_clients.has_clients():
+            monitor_clients.update(monitor_emit)
+        time.sleep(0.05)
+
+
+@socketio.on('set_status_rate', namespace='/info')
+def set_status_rate(rate):
+    logging.debug('Status rate for %s: %s', request.sid, rate)
+    status_clients.set_rate(request.sid, float(rate))
+
+
+@socketio.on('civ_ack', namespace='/info')
+def civ_ack(civ_time):
+    # The browser got the tuning change
+    civ_latency_add("browser", time.time() - float(civ_time))
+
+
+def civ_latency_add(stage: str, seconds: float):
+    transceiver_latency[stage].add(max(0.0, seconds))
+    transceiver_latency_histograms[stage].observe(max(0.0, seconds))
+
+
+def status_emit(event: str, data: dict, sid: str):
+    with emit_time.time():
+        socketio.emit(event, data, namespace='/info', room=sid)
+    if event == 'device_status_delta' and "civ_time" in data:
+        civ_latency_add("emit", time.time() - data["civ_time"])
+
+
+def status_broadcast():
+    # Settings changed, send the changes to all clients now
+    status_clients.update(device_status(), status_emit, force=True)
+
+
+def on_transceiver_message(t_data: Dict, station_name: str):
+    global transceiver_freq_hz, transceiver_name, transceiver_mode, transceiver_levels, transceiver_poll_stats, transceiver_civ_time
+    if "civ_decoder" in t_data:
+        on_civ_decoder_stats(station_name, t_data["civ_decoder"], t_data.get("pid"))
+    if station_name in stations:
+        # Additional station, its recording is controlled separately
+        stations[station_name].on_message(t_data)
+        if "civ_time" in t_data:
+            status_wakeup.set()
+        return
+    if "name" in t_data:
+        transceiver_name = t_data["name"]
+        logging.debug("Transceiver Name: %s", transceiver_name)
+    if "mode" in t_data:
+        transceiver_mode = t_data["mode"]
+        logging.debug("Transceiver Mode: %s", transceiver_mode)
+    if "frequency" in t_data:
+        transceiver_freq_hz = t_data["frequency"]
+        logging.debug("Transceiver Frequency: %d", transceiver_freq_hz)
+    if "levels" in t_data:
+        transceiver_levels = t_data["levels"]
+    if "civ_poll" in t_data:
+        transceiver_poll_stats = t_data["civ_poll"]
+    if "mode" in t_data or "frequency" in t_data:
+        recording_tuning_update()
+    if "civ_time" in t_data:
+        # Tuning changed: measure the CI-V -> recorder latency and send the status without waiting for the next update
+        transceiver_civ_time = t_data["civ_time"]
+        civ_latency_add("ipc", time.time() - transceiver_civ_time)
+        status_wakeup.set()
+
+
+def on_civ_decoder_stats(radio: str, decoder: Dict, pid: Optional[int]):
+    # Frames per second since the previous counters (sent every 5s)
+    now = time.monotonic()
+    previous = transceiver_civ_stats.get(radio)
+    fps = 0.0
+    if previous is not None and now > previous["time"] and decoder["frames"] >= previous["frames"]:
+        fps = (decoder["frames"] - previous["frames"])/(now - previous["time"])
+    transceiver_civ_stats[radio] = dict(decoder, time=now, frames_per_second=round(fps, 1), pid=pid)
+
+
+def metrics_history_thread():
+    logging.debug("metrics_history_thread started")
+    while app_active:
+        metrics_history.add(metrics_values())
+        time.sleep(metrics_history.interval)
+
+
+def startup_thread(process_start: float):
+    # Slow initialization, after the web server is started: the browser gets the page first
+    global recordings_count
+    wait_first_response(process_start)
+
+    # PortAudio probes all ALSA devices, it runs in a real thread, not to block the web server
+    tpool.execute(portaudio.get)
+    startup_stats["portaudio_s"] = round(portaudio.init_time, 2)
+    logging.debug("Audio Devices found:")
+    audio.list_audio_devices(portaudio.get())
+    status_audio.invalidate()
+    for st in stations.values():
+        st.audio_status.invalidate()
+    logging.debug("Serial Ports found:")
+    for port, desc, hw in sorted(serial.tools.list_ports.comports()):
+        logging.debug(f"{port}: {desc}")
+
+    # Recordings catalog, the new files are indexed
+    t_start = time.monotonic()
+    get_catalog().reconcile()
+    recordings_count = get_catalog().count()
+    startup_stats["catalog_s"] = round(time.monotonic() - t_start, 2)
+
+    # Archive, the files left from before are taken from the catalog
+    if archiver is not None:
+        socketio.start_background_task(target=archive_update_thread)
+
+    startup_stats["ready_s"] = round(time.time() - process_start, 2)
+    logging.info("Startup: %s", startup_stats)
+    status_wakeup.set()
+
+
+def wait_first_response(process_start: float):
+    # Time from the process start to the first answer of the web server, as the kiosk browser sees it
+    while app_active:
+        try:
+            with socket.create_connection(("127.0.0.1", port_number), timeout=1.0) as s:
+                s.sendall(b"HEAD /favicon.ico HTTP/1.0\r\n\r\n")
+                if s.recv(16).startswith(b"HTTP/"):
+                    break
+        except OSError:
+            time.sleep(0.05)
+    startup_stats["first_response_s"] = round(time.time() - process_start, 2)
+    logging.info("Web server answered in %.2fs after the process start", startup_stats["first_response_s"])
+
+
+def hotplug_thread():
+    # Sound card connected or disconnected: PortAudio is initialized again (it does not see the new devices),
+    # the device status is checked again and the capture processes look for their devices
+    watcher = hotplug.DeviceWatcher(("sound",))
+    logging.debug("hotplug_thread started: %s", watcher.method)
+    while app_active:
+        events = watcher.wait(2.0)
+        if len(events) == 0:
+            continue
+        logging.debug("Sound cards changed: %s", events)
+        if portaudio.pd is not None:
+            tpool.execute(lambda: (portaudio.reset(), portaudio.get()))
+            audio.list_audio_devices(portaudio.get())
+        status_audio.invalidate()
+        if capture_worker is not None:
+            capture_worker.rescan()
+        for st in stations.values():
+            st.rescan()
+        status_wakeup.set()
+    watcher.close()
+
+
+def archive_update_thread():
+    global recordings_count
+
+    logging.debug("archive_update_thread started")
+    archiver.start()
+    while app_active:
+        # New conversions are started only when nothing is recorded
+        if archiver.update(paused=recording_active or any(st.active() for st in stations.values())):
+            recordings_count = get_catalog().count()
+        time.sleep(1.0)
+    archiver.close()
+
+
+def transceiver_update_thread():
     logging.debug("transceiver_update_thread started")
     # Waiting for connection
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -188,66 +927,48 @@ def transceiver_update_thread():
     s.settimeout(5.0)
     while app_active:
         try:
-            socket_port = 12020
-            s.bind(('0.0.0.0', socket_port))
-            while app_active:
-                try:
-                    s.listen()
-                    conn, addr = s.accept()
-                    conn.settimeout(0.1)
-
-                    no_data = 0
-                    socket_data = b''
-                    logging.debug('Connected by {}'.format(addr))
-                    while app_active:
-                        try:
-                            data = conn.recv(32)
-                            if len(data) > 0:
-                                socket_data += data
-                                # Data block ends with 0xFD - split to parts
-                                while socket_data.find(b'\xFD') != -1:
-                                    data_end = socket_data.find(b'\xFD')
-                                    if data_end != -1:
-                                        # New data in json found
-                                        d = socket_data[:data_end]
-                                        # print("Data:", d)
-                                        t_data = json.loads(d.decode())
-                                        if "name" in t_data:
-                                            transceiver_name = t_data["name"]
-                                            logging.debug("Transceiver Name: %s", transceiver_name)
-                                        if "mode" in t_data:
-                                            transceiver_mode = t_data["mode"]
-                                            logging.debug("Transceiver Mode: %s", transceiver_mode)
-                                        if "frequency" in t_data:
-                                            transceiver_freq_hz = t_data["frequency"]
-                                            logging.debug("Transceiver Frequency: %d", transceiver_freq_hz)
-
-                                        socket_data = socket_data[data_end + 1:]
-                                    else:
-                                        # If command too big, something is wrong
-                                        if len(socket_data) > 1024:
-                                            socket_data = b''
-                                no_data = 0
-                            else:
-                                no_data += 1
-                                time.sleep(0.1)
-                                if no_data >= 128:
-                                    break
-                        except socket.timeout:
-                            # logging.error("  Connection timeout")
-                            pass
-                except Exception as e:
-                    logging.error("Socket Error: %s", e)
-                    time.sleep(1.0)
-                    # s.close()
-        except Exception as e:
-            logging.error("Socket Error: %s", e)
+            s.bind(('0.0.0.0', transceiver.socket_port))
+            break
+        except OSError as e:
+            # Port is still used by the previous instance, wait
+            logging.error("Cannot bind the transceiver port %d: %s, retry in 5s", transceiver.socket_port, e)
+            time.sleep(5.0)
+    if app_active is False:
+        s.close()
+        return
+    s.listen()
+    while app_active:
+        try:
+            conn, addr = s.accept()
+        except socket.timeout:
+            continue
+        # Each transceiver has its own connection
+        socketio.start_background_task(target=transceiver_connection_thread, conn=conn, addr=addr)
+    s.close()
 
     logging.debug("transceiver_update_thread done")
 
-def status_update_thread():
-    global app_active, recording_active, socket_connected, transceiver_freq_hz, transceiver_name, transceiver_mode
 
+def transceiver_connection_thread(conn: socket.socket, addr):
+    logging.debug('Connected by {}'.format(addr))
+    # The transceiver sends heartbeats, the connection is closed if it is silent too long
+    conn.settimeout(ipc.heartbeat_timeout)
+    reader = ipc.MessageReader(conn)
+    station_name = ""
+    try:
+        with conn:
+            while app_active:
+                t_data = reader.read()
+                if t_data is None:
+                    break
+                station_name = t_data.get("name", station_name)
+                on_transceiver_message(t_data, station_name)
+    except (OSError, ValueError) as e:
+        logging.error("Transceiver connection error: %s", e)
+    logging.debug('Disconnected {} {}'.format(station_name, addr))
+
+
+def status_update_thread():
     logging.debug("status_update_thread started")
     while app_active:
         # Get all data from the transceiver
@@ -267,17 +988,82 @@ def status_update_thread():
         #     except queue.Empty:
         #         break
 
-        # Update client
-        if socket_connected:
-            socketio.emit('device_status', device_status(), namespace='/info')
-        time.sleep(0.1)
+        # Update clients, each client has its own rate
+        if status_clients.has_clients():
+            status_clients.update(device_status(), status_emit)
+            status_wakeup.wait(max(0.02, status_clients.next_update()))
+            status_wakeup.clear()
+        else:
+            status_wakeup.wait(0.1)
+            status_wakeup.clear()
 
     logging.debug("status_update_thread ended")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--timeshift", type=float, default=0.0, help="Keep the last N seconds of audio and add them to the recording")
+    parser.add_argument("--timeshift-memory", type=int, default=64, help="Time-shift buffer memory limit, MBytes")
+    parser.add_argument("--segment-minutes", type=float, default=0.0, help="Split recordings to files of N minutes")
+    parser.add_argument("--segment-size", type=int, default=0, help="Split recordings to files of N MBytes")
+    parser.add_argument("--flac", action="store_true", help="Encode recordings to FLAC (requires soundfile)")
+    parser.add_argument("--spectrum-fps", type=float, default=10.0, help="Live spectrum rows per second")
+    parser.add_argument("--split-on-tuning", action="store_true", help="Start a new file when the transceiver frequency or mode is changed")
+    parser.add_argument("--station", action="append", default=[], metavar="RADIO=AUDIO_DEVICE",
+                        help="Additional transceiver and its audio device, for example IC-7300=hw:2,0. Can be used several times")
+    parser.add_argument("--squelch", type=float, default=0.0, metavar="DB",
+                        help="Record only the signals, which are DB decibels above the noise floor, each signal to its own file")
+    parser.add_argument("--squelch-preroll", type=float, default=1.0, help="Seconds recorded before the signal")
+    parser.add_argument("--squelch-hang", type=float, default=2.0, help="Seconds recorded after the signal")
+    parser.add_argument("--squelch-min", type=float, default=0.5, help="Signals shorter than N seconds are ignored")
+    parser.add_argument("--squelch-index", action="store_true", help="Write all signals to one file, the signal start times are added to the index file")
+    parser.add_argument("--decimate", action="store_true", help="Record narrow modes (CW, SSB, AM, FM) at a lower sample rate in mono")
+    parser.add_argument("--fsync-interval", type=float, default=10.0,
+                        help="Sync the file and update the WAV header every N seconds: less audio is lost on a power cut, but the SD card writes more")
+    parser.add_argument("--write-block", type=int, default=1024, metavar="KB", help="Write the data in blocks of N KBytes")
+    parser.add_argument("--preallocate", type=int, default=32, metavar="MB", help="Reserve the file space in chunks of N MBytes, 0 - disabled")
+    parser.add_argument("--disk-reserve", type=int, default=200, metavar="MB", help="Free space, that is never used for the recordings")
+    parser.add_argument("--disk-full", choices=("stop", "rotate"), default="stop",
+                        help="When the free space is below the reserve: stop the recording, or delete the oldest recordings")
+    parser.add_argument("--archive", action="store_true", help="Convert the finished WAV recordings to FLAC in the background (requires soundfile)")
+    parser.add_argument("--archive-budget", type=float, default=0.0, metavar="GB",
+                        help="Delete the oldest not starred recordings, when all recordings take more than GB gigabytes")
+    parser.add_argument("--archive-processes", type=int, default=0, help="FLAC conversion processes, all cores but one by default")
+    parser.add_argument("--monitor-rate", type=int, default=12000, help="Live listening sample rate, Hz (0 - the recording sample rate)")
+    parser.add_argument("--monitor-pcm", action="store_true", help="Live listening in 16-bit PCM instead of 8-bit mu-law")
+    parser.add_argument("--no-activity-index", action="store_true", help="Do not write the per-second activity index next to the recordings")
+    args = parser.parse_args()
+    recording_segment_seconds = args.segment_minutes*60
+    recording_segment_size = args.segment_size*1024*1024
+    recording_split_on_tuning = args.split_on_tuning
+    recording_decimate = args.decimate
+    recording_fsync_interval = args.fsync_interval
+    recording_write_block = args.write_block*1024
+    recording_preallocate = args.preallocate*1024*1024
+    recording_activity = args.no_activity_index is False
+    monitor_samplerate = args.monitor_rate
+    monitor_encoding = "pcm" if args.monitor_pcm else "ulaw"
+    archive_convert = args.archive
+    archive_budget = int(args.archive_budget*1024*1024*1024)
+    archive_processes = args.archive_processes
+    recording_disk_guard = {"reserve": args.disk_reserve*1024*1024, "action": args.disk_full}
+    recording_format = "flac" if args.flac else "wav"
+    spectrum_fps = args.spectrum_fps
+    timeshift_seconds = args.timeshift
+    timeshift_max_memory = args.timeshift_memory*1024*1024
+    if args.squelch > 0:
+        recording_squelch = {"threshold_db": args.squelch, "pre_roll": args.squelch_preroll, "hang_time": args.squelch_hang,
+                             "min_event": args.squelch_min, "split": args.squelch_index is False}
+    recording_core = station.station_core(0)
+    for index, spec in enumerate(args.station):
+        name, audio_filter = station.parse_station(spec)
+        stations[name] = station.Station(portaudio, name, audio_filter, station.station_core(index + 1))
+
     logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s] (%(threadName)-10s)  %(message)s')
 
+    process_start = utils.get_process_start_time()
+    startup_stats["imports_s"] = round(time.time() - process_start, 2)
+
     print("")
     print("HAM Radio Recorder v0.1 by Dmitrii Eliuseev\n")
     print("Run:\npython3 recorder.py")
@@ -290,19 +1076,45 @@ if __name__ == "__main__":
     dir_path = os.path.dirname(abs_path)
     os.chdir(dir_path)
 
-    # Show available audio devices and ports
-    logging.debug("Audio Devices found:")
-    audio.list_audio_devices(pd)
-    logging.debug("Serial Ports found:")
-    for port, desc, hw in sorted(serial.tools.list_ports.comports()):
-       logging.debug(f"{port}: {desc}")
-    logging.debug("")
+    # The audio devices, the serial ports and the catalog are checked in the background (startup_thread),
+    # the web server answers first. The count is updated after the catalog sync
+    recordings_count = get_catalog().count()
 
     app_active = True
 
+    # Thumbnails worker
+    multiprocessing.Process(target=thumbnails.thumbnail_worker, args=(recordings_path, thumbnails_dir, thumbnails_queue, thumbnails_pause, thumbnails_budget),
+                            daemon=True).start()
+
+    # Live listening ring of the mono monitor stream: 4 seconds at 48 kHz (--monitor-rate 0), 16 seconds at 12 kHz
+    monitor_ring = live.SharedRing(4*48000*live.encodings[monitor_encoding])
+    monitor_clients = live.MonitorClients(monitor_ring, monitor_encoding)
+
+    # Capture processes, the streams are kept open
+    capture_start()
+
+    # Archive, started after the catalog sync
+    if archive_convert or archive_budget > 0:
+        archiver = archive.Archiver(recordings_path, get_catalog(), archive_convert, archive_budget, archive_processes)
+
+    # PortAudio, the catalog sync and the startup time
+    socketio.start_background_task(target=startup_thread, process_start=process_start)
+
+    # Sound card hotplug
+    socketio.start_background_task(target=hotplug_thread)
+
     # Status update thread
     socketio.start_background_task(target=status_update_thread)
 
+    # Metrics history
+    socketio.start_background_task(target=metrics_history_thread)
+
+    # Live spectrum
+    socketio.start_background_task(target=spectrum_update_thread)
+
+    # Live listening
+    socketio.start_background_task(target=monitor_update_thread)
+
     # Transceiver update via sockets
     # cmd = f"sudo python{sys.version_info.major}.{sys.version_info.minor} {os.path.dirname(os.path.abspath(__file__))}/transceiver.py &"
     # logging.debug("Running Transceiver Control separately: %s", cmd)
@@ -314,13 +1126,10 @@ if __name__ == "__main__":
     socketio.run(app, host='0.0.0.0', debug=True, port=port_number, use_reloader=False)    # app.run(host='0.0.0.0')
 
     app_active = False
-    recording_stop_event.set()
+    capture_stop()
+    monitor_ring.close(unlink=True)
     # transceiver_queue_in.put({"command": "quit"})
 
-    pd.terminate()
+    portaudio.reset()
 
     print("App done")
-
-
-
-
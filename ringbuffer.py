@@ -0,0 +1,123 @@
+import numpy as np
+from typing import Dict
+
+
+class RingBuffer:
+    # Single-producer / single-consumer byte ring.
+    # The producer (PortAudio callback) only moves write_pos, the consumer (writer thread) only moves read_pos,
+    # so no lock is needed: both counters grow monotonically and each side only reads the other one.
+    def __init__(self, size: int, frame_size: int = 1):
+        # Keep the size aligned to the frame size, so a wrap never splits a sample
+        self.frame_size = frame_size
+        self.size = max(frame_size, size - size % frame_size)
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+        self.write_pos = 0
+        self.read_pos = 0
+        # Statistics
+        self.overruns = 0
+        self.underruns = 0
+        self.dropped_bytes = 0
+        self.high_water = 0
+
+    def available(self) -> int:
+        return self.write_pos - self.read_pos
+
+    def free(self) -> int:
+        return self.size - self.available()
+
+    def write(self, data: bytes) -> bool:
+        n = len(data)
+        if n > self.free():
+            # Consumer is too slow: drop the whole block, never overwrite unread data
+            self.overruns += 1
+            self.dropped_bytes += n
+            return False
+
+        start = self.write_pos % self.size
+        first = min(n, self.size - start)
+        self.view[start:start + first] = data[:first]
+        if first < n:
+            self.view[0:n - first] = data[first:]
+        self.write_pos += n
+
+        level = self.write_pos - self.read_pos
+        if level > self.high_water:
+            self.high_water = level
+        return True
+
+    def read(self, max_size: int) -> bytes:
+        n = min(self.available(), max_size)
+        n -= n % self.frame_size
+        if n <= 0:
+            self.underruns += 1
+            return b''
+
+        start = self.read_pos % self.size
+        first = min(n, self.size - start)
+        if first < n:
+            data = bytes(self.view[start:start + first]) + bytes(self.view[0:n - first])
+        else:
+            data = bytes(self.view[start:start + n])
+        self.read_pos += n
+        return data
+
+    def stats(self) -> Dict:
+        return {"buffer_size": self.size,
+                "buffer_level": self.available(),
+                "high_water": self.high_water,
+                "overruns": self.overruns,
+                "underruns": self.underruns,
+                "dropped_frames": self.dropped_bytes // self.frame_size}
+
+
+class HistoryBuffer:
+    # Keeps the last N frames of int16 audio in a fixed-size array (time-shift / pre-trigger buffer).
+    # Works as a FIFO: append() overwrites the oldest samples when full, pop() returns the oldest samples first.
+    def __init__(self, frames: int, channels: int):
+        self.channels = channels
+        self.samples = np.zeros(max(1, frames)*channels, dtype=np.int16)
+        self.start = 0
+        self.count = 0
+        self.overwritten = 0
+
+    @property
+    def memory_bytes(self) -> int:
+        return self.samples.nbytes
+
+    def frames(self) -> int:
+        return self.count // self.channels
+
+    def clear(self):
+        self.start, self.count = 0, 0
+
+    def append(self, data: bytes):
+        x = np.frombuffer(data, dtype=np.int16)
+        n, size = len(x), len(self.samples)
+        if n == 0:
+            return
+        if n >= size:
+            self.overwritten += self.count + n - size
+            self.samples[:] = x[n - size:]
+            self.start, self.count = 0, size
+            return
+
+        end = (self.start + self.count) % size
+        first = min(n, size - end)
+        self.samples[end:end + first] = x[:first]
+        self.samples[:n - first] = x[first:]
+        self.count += n
+        if self.count > size:
+            self.overwritten += self.count - size
+            self.start = (self.start + self.count - size) % size
+            self.count = size
+
+    def pop(self, max_frames: int) -> bytes:
+        n, size = min(self.count, max_frames*self.channels), len(self.samples)
+        first = min(n, size - self.start)
+        data = self.samples[self.start:self.start + first].tobytes()
+        if first < n:
+            data += self.samples[:n - first].tobytes()
+        self.start = (self.start + n) % size
+        self.count -= n
+        return data
@@ -0,0 +1,74 @@
+import numpy as np
+import time
+import threading
+import queue
+import multiprocessing
+import logging
+from typing import List, Tuple
+
+
+class SpectrumAnalyzer:
+    # Waterfall rows from the audio stream: each row covers 1/fps seconds of audio,
+    # all FFTs of all complete rows are computed with one vectorized call.
+    # Row is fft_size/2 uint8 values, 0..255 maps to db_min..db_max
+    def __init__(self, samplerate: int, channels: int, fps: float = 10.0, fft_size: int = 1024, db_min: float = -120.0, db_max: float = 0.0):
+        self.channels = channels
+        self.fft_size = fft_size
+        self.db_min, self.db_max = db_min, db_max
+        self.samples_per_row = max(fft_size, int(samplerate/fps))
+        self.ffts_per_row = self.samples_per_row // fft_size
+        self.window = np.hanning(fft_size).astype(np.float32)
+        # Power normalization: full scale sine = 0 dB
+        self.scale = 1.0/(np.sum(self.window)/2)**2
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.row_cost = 0.0
+
+    def process(self, data: bytes) -> List[bytes]:
+        x = np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels).mean(axis=1, dtype=np.float32)/32768.0
+        self.buffer = np.concatenate((self.buffer, x))
+        rows_count = len(self.buffer) // self.samples_per_row
+        if rows_count == 0:
+            return []
+
+        t_start = time.perf_counter()
+        block = self.buffer[:rows_count*self.samples_per_row].reshape(rows_count, self.samples_per_row)
+        self.buffer = self.buffer[rows_count*self.samples_per_row:]
+        frames = block[:, :self.ffts_per_row*self.fft_size].reshape(rows_count, self.ffts_per_row, self.fft_size)*self.window
+        spectrum = np.fft.rfft(frames, axis=-1)[:, :, :self.fft_size//2]
+        power = np.mean(spectrum.real**2 + spectrum.imag**2, axis=1)*self.scale
+        db = 10*np.log10(power + 1e-20)
+        rows = np.clip((db - self.db_min)*(255.0/(self.db_max - self.db_min)), 0, 255).astype(np.uint8)
+        self.row_cost = (time.perf_counter() - t_start)/rows_count
+        return [row.tobytes() for row in rows]
+
+
+def decimate_row(row: bytes, width: int) -> bytes:
+    # Reduce the row to the client pixel width, max value of each bin group is used, so narrow peaks are not lost
+    values = np.frombuffer(row, dtype=np.uint8)
+    if width <= 0 or width >= len(values):
+        return row
+    edges = np.linspace(0, len(values), width + 1).astype(np.int32)[:-1]
+    return np.maximum.reduceat(values, edges).tobytes()
+
+
+def spectrum_thread(capture, analyzer: SpectrumAnalyzer, spectrum_queue: multiprocessing.Queue, enabled_event: multiprocessing.Event, stop_event: threading.Event, fps: float):
+    # Runs in the capture process. Audio comes from the capture tap buffer, if the analyzer is too slow
+    # the tap buffer overflows, but the main capture buffer is not affected
+    while stop_event.wait(1.0/fps) is False:
+        capture.tap_enabled = enabled_event.is_set()
+        if capture.tap_enabled is False:
+            continue
+        for row in analyzer.process(capture.tap.read(capture.tap.size)):
+            try:
+                spectrum_queue.put_nowait((row, analyzer.row_cost))
+            except queue.Full:
+                pass
+
+
+def start_spectrum(capture, spectrum_queue: multiprocessing.Queue, enabled_event: multiprocessing.Event, fps: float) -> Tuple[threading.Thread, threading.Event]:
+    stop_event = threading.Event()
+    analyzer = SpectrumAnalyzer(capture.samplerate, capture.channels, fps)
+    thread = threading.Thread(target=spectrum_thread, args=(capture, analyzer, spectrum_queue, enabled_event, stop_event, fps), name="Spectrum", daemon=True)
+    thread.start()
+    logging.debug("Spectrum started: %d bins, %.1f fps", analyzer.fft_size//2, fps)
+    return thread, stop_event
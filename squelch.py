@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+# Signal-activated recording: energy detector with an adaptive noise floor
+
+import sys
+import time
+import numpy as np
+from typing import Dict, List, Optional
+
+
+class SquelchGate:
+    # The level is calculated for each block_time block of the stream (vectorized), the noise floor follows the level down
+    # immediately and rises slowly (floor_rise dB/s), only while the squelch is closed.
+    # The first settle_time of the stream is held back: its minimum level is the initial floor, then the held blocks are
+    # gated against it, so a signal present from the start is recorded too.
+    # The squelch opens when the level is threshold_db above the floor and closes after hang_time below it.
+    # Events shorter than min_event are ignored, the recorded burst starts pre_roll seconds before the signal.
+    # bursts: [start_frame, end_frame] of the stream, end_frame is None while the burst continues
+    def __init__(self, samplerate: int, channels: int, threshold_db: float = 10.0, pre_roll: float = 1.0, hang_time: float = 2.0,
+                 min_event: float = 0.5, block_time: float = 0.02, floor_rise: float = 1.0, hysteresis_db: float = 3.0,
+                 settle_time: float = 5.0):
+        self.channels = channels
+        self.block_frames = max(1, int(block_time*samplerate))
+        self.threshold_db = threshold_db
+        self.hysteresis_db = hysteresis_db
+        self.pre_roll_frames = int(pre_roll*samplerate)
+        self.hang_frames = int(hang_time*samplerate)
+        self.min_event_frames = int(min_event*samplerate)
+        self.floor_step = floor_rise*block_time
+        self.floor = -100.0
+        self.settle_blocks = max(1, int(settle_time/block_time))
+        self.settle_levels: Optional[List[float]] = []  # Levels of the held blocks, None after the floor has settled
+        self.settle_frame = 0
+        self.level = -100.0
+        self.remainder = np.zeros(0, dtype=np.float32)
+        self.frame = 0  # Stream position of the first frame after the processed blocks
+        self.is_open = False
+        self.open_frame = 0
+        self.active_frame = 0
+        self.confirmed = False
+        self.bursts: List[List[Optional[int]]] = []
+        self.events = 0
+        self.block_cost = 0.0
+
+    def keep_from(self, frame: int) -> int:
+        # The oldest stream position, that may still be recorded: the pre-roll of the signal, which is not confirmed yet
+        if self.settle_levels:
+            start = self.settle_frame
+        else:
+            start = self.open_frame if self.is_open else self.frame
+        return max(0, min(start, frame) - self.pre_roll_frames)
+
+    def process(self, data: bytes, start_frame: int):
+        # data: int16 frames starting at the stream position start_frame
+        t_start = time.perf_counter()
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        if len(self.remainder) == 0:
+            self.frame = start_frame
+        samples = np.concatenate((self.remainder, samples)) if len(self.remainder) > 0 else samples
+        block_size = self.block_frames*self.channels
+        blocks = len(samples) // block_size
+        self.remainder = samples[blocks*block_size:]
+        if blocks == 0:
+            return
+        block_data = samples[:blocks*block_size].reshape(blocks, block_size)
+        levels = 10*np.log10(np.einsum('ij,ij->i', block_data, block_data)/block_size/(32768.0*32768.0) + 1e-12)
+
+        for level in levels.tolist():
+            if self.settle_levels is not None:
+                self._settle(level)
+                continue
+            self._update(level)
+            self.frame += self.block_frames
+        self.level = float(levels[-1])
+        self.block_cost = (time.perf_counter() - t_start)/blocks
+
+    def _settle(self, level: float):
+        if len(self.settle_levels) == 0:
+            self.settle_frame = self.frame
+        self.settle_levels.append(level)
+        self.frame += self.block_frames
+        if len(self.settle_levels) < self.settle_blocks:
+            return
+        levels, self.settle_levels = self.settle_levels, None
+        self.floor = min(levels)
+        self.frame = self.settle_frame
+        for held in levels:
+            self._update(held)
+            self.frame += self.block_frames
+
+    def _update(self, level: float):
+        snr = level - self.floor
+        if self.is_open is False:
+            self.floor = level if level < self.floor else self.floor + self.floor_step
+            if snr > self.threshold_db:
+                self.is_open, self.confirmed = True, False
+                self.open_frame = self.active_frame = self.frame
+            return
+
+        if snr > self.threshold_db - self.hysteresis_db:
+            self.active_frame = self.frame
+        if self.confirmed is False and self.active_frame + self.block_frames - self.open_frame >= self.min_event_frames:
+            self.confirmed = True
+            self.events += 1
+            self.bursts.append([max(0, self.open_frame - self.pre_roll_frames), None])
+        if self.frame - self.active_frame >= self.hang_frames:
+            self.is_open = False
+            if self.confirmed:
+                self.bursts[-1][1] = self.frame + self.block_frames
+
+    def stats(self) -> Dict:
+        return {"squelch_open": self.is_open, "squelch_level_db": round(self.level, 1), "squelch_floor_db": round(self.floor, 1),
+                "squelch_events": self.events, "squelch_block_cost_us": round(self.block_cost*1e6, 1)}
+
+
+def benchmark(samplerate: int = 48000, channels: int = 1, seconds: float = 60.0) -> float:
+    # Noise with a 3s tone burst every 10s, fed in 0.5s blocks as the capture worker does. Returns the realtime factor
+    rng = np.random.default_rng(1)
+    t = np.arange(int(seconds*samplerate))/samplerate
+    signal = rng.normal(0, 300, len(t)) + 8000*np.sin(2*np.pi*1000*t)*((t % 10) < 3)
+    data = np.repeat(signal.astype(np.int16), channels).tobytes()
+    gate = SquelchGate(samplerate, channels)
+    step = samplerate*channels*2//2
+    t_start = time.perf_counter()
+    for pos in range(0, len(data), step):
+        gate.process(data[pos:pos + step], pos//(2*channels))
+    duration = time.perf_counter() - t_start
+    print("{}s of {} Hz x {}: {:.3f}s, {:.0f}x realtime, {:.1f} us per block, {} bursts: {}".format(
+        seconds, samplerate, channels, duration, seconds/duration, gate.block_cost*1e6, len(gate.bursts),
+        ["{:.2f}-{:.2f}s".format(b[0]/samplerate, (b[1] or 0)/samplerate) for b in gate.bursts]))
+    return seconds/duration
+
+
+if __name__ == "__main__":
+    # python3 squelch.py [samplerate] [channels]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 48000, int(sys.argv[2]) if len(sys.argv) > 2 else 1)
@@ -0,0 +1,135 @@
+import os
+import time
+import queue
+import logging
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
+import audio
+import status
+import worker
+
+
+def parse_station(spec: str) -> Tuple[str, str]:
+    # "IC-7300=hw:2,0": transceiver name and the audio device name filter
+    name, _, audio_filter = spec.partition("=")
+    if len(name) == 0 or len(audio_filter) == 0:
+        raise ValueError("Station format: RADIO=AUDIO_DEVICE, for example IC-7300=hw:2,0")
+    return name, audio_filter
+
+
+def station_core(index: int) -> Optional[int]:
+    # Core 0 is left for the web server and the transceiver readers, the capture workers get the other cores in turn
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    if len(cores) < 2:
+        return None
+    return cores[1 + index % (len(cores) - 1)]
+
+
+class Throughput:
+    # Write rate from the bytes_written counter and the time of the capture process statistics
+    def __init__(self):
+        self.bytes_written = 0
+        self.time = 0.0
+        self.rate = 0.0
+
+    def update(self, bytes_written: int, now: float):
+        if self.time > 0 and now > self.time and bytes_written >= self.bytes_written:
+            self.rate = (bytes_written - self.bytes_written)/(now - self.time)
+        self.bytes_written, self.time = bytes_written, now
+
+    def reset(self):
+        self.bytes_written, self.time, self.rate = 0, 0.0, 0.0
+
+
+class Station:
+    # Additional transceiver and audio interface pair. It has its own CI-V reader (transceiver.py sends its messages
+    # with the station name) and its own capture process, recorded together with the main transceiver
+    def __init__(self, portaudio: audio.PortAudio, name: str, audio_filter: str, cpu_core: Optional[int] = None):
+        self.name = name
+        self.audio_filter = audio_filter
+        self.cpu_core = cpu_core
+        self.frequency = 0
+        self.mode = ""
+        self.levels: Dict[str, int] = {}
+        self.worker: Optional[worker.CaptureWorker] = None
+        self.recording = False
+        self.stats_queue = multiprocessing.Queue()
+        self.tuning_queue = multiprocessing.Queue()
+        self.stats: Dict = {}
+        self.histograms: Dict = {}  # Capture latency histograms, see metrics.Histogram.snapshot
+        self.throughput = Throughput()
+        # Checked again on a sound card hotplug, see rescan()
+        self.audio_status = status.CachedValue(lambda: portaudio.interface_connected(audio_filter), ttl=300.0)
+
+    def open(self):
+        logging.debug('Station {}: interface {}, core {}'.format(self.name, self.audio_filter, self.cpu_core))
+        self.worker = worker.CaptureWorker(self.audio_filter, self.stats_queue, self.tuning_queue, cpu_core=self.cpu_core)
+
+    def configure(self, channels: int, samplerate: int, writer_options: dict, split_on_tuning: bool, squelch: Optional[dict] = None, decimate: bool = False,
+                  disk_guard: Optional[dict] = None, folder: str = ""):
+        if self.worker is not None:
+            self.worker.configure(channels, samplerate, 0.0, writer_options, split_on_tuning, squelch, decimate, disk_guard, folder)
+
+    def rescan(self):
+        # Sound cards changed: the status is updated, the capture process looks for its device now
+        self.audio_status.invalidate()
+        if self.worker is not None:
+            self.worker.rescan()
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = None
+
+    def active(self) -> bool:
+        return self.recording
+
+    def start(self):
+        if self.worker is not None and self.recording is False:
+            self.recording = True
+            self.throughput.reset()
+            self.worker.record_start(self.name, self.frequency, self.mode)
+
+    def stop(self):
+        if self.worker is not None and self.recording:
+            self.recording = False
+            self.worker.record_stop()
+
+    def on_message(self, t_data: Dict):
+        if "mode" in t_data:
+            self.mode = t_data["mode"]
+        if "frequency" in t_data:
+            self.frequency = t_data["frequency"]
+        if "levels" in t_data:
+            self.levels = t_data["levels"]
+        if ("mode" in t_data or "frequency" in t_data) and self.worker is not None:
+            self.tuning_queue.put_nowait({"time": time.monotonic(), "frequency": self.frequency, "mode": self.mode})
+
+    def update_stats(self) -> Tuple[List[str], List[str]]:
+        # Latest statistics of the capture process, the files of the finished recording and the files deleted on a full disk
+        files, removed = [], []
+        while True:
+            try:
+                stats = self.stats_queue.get_nowait()
+            except queue.Empty:
+                break
+            files += stats.pop("files", None) or []
+            self.histograms = stats.pop("histograms", self.histograms)
+            removed += stats.pop("files_removed", None) or []
+            if stats.pop("disk_full", False):
+                logging.debug("Station {}: recording stopped, the disk is full".format(self.name))
+                self.recording = False
+            self.throughput.update(stats.get("bytes_written", 0), stats.get("time", time.monotonic()))
+            self.stats = stats
+        return files, removed
+
+    def status(self) -> Dict:
+        return {"name": self.name,
+                "audio": self.audio_status.get(),
+                "recording_active": self.active(),
+                "frequency": self.frequency,
+                "mode": self.mode,
+                "levels": self.levels,
+                "dropped_frames": self.stats.get("dropped_frames", 0),
+                "input_overflows": self.stats.get("input_overflows", 0),
+                "rate_kbps": round(self.throughput.rate/1024, 1) if self.active() else 0.0}
@@ -0,0 +1,55 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+
+class CachedValue:
+    # Value that is refreshed not more often than every ttl seconds.
+    # An optional probe is a cheap function, which result changes when the value needs to be refreshed earlier
+    # (for example, the list of the sound cards is changed on a hotplug)
+    def __init__(self, getter: Callable[[], Any], ttl: float, probe: Optional[Callable[[], Any]] = None):
+        self.getter = getter
+        self.ttl = ttl
+        self.probe = probe
+        self.probe_value = None
+        self.value = None
+        self.expires = 0.0
+        self.refreshes = 0
+
+    def get(self) -> Any:
+        if self.probe is not None:
+            probe_value = self.probe()
+            if probe_value != self.probe_value:
+                self.probe_value = probe_value
+                self.expires = 0.0
+        now = time.monotonic()
+        if now >= self.expires:
+            self.value = self.getter()
+            self.expires = now + self.ttl
+            self.refreshes += 1
+        return self.value
+
+    def invalidate(self):
+        self.expires = 0.0
+
+
+class CostMeter:
+    # Exponential moving average and maximum of a code block duration
+    def __init__(self, alpha: float = 0.05):
+        self.alpha = alpha
+        self.average = 0.0
+        self.maximum = 0.0
+        self.count = 0
+
+    def add(self, duration: float):
+        self.average = duration if self.count == 0 else self.average + self.alpha*(duration - self.average)
+        self.maximum = max(self.maximum, duration)
+        self.count += 1
+
+    @contextmanager
+    def measure(self):
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(time.perf_counter() - t_start)
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+# Storage layer of the recordings: large aligned writes, preallocation, periodic fsync and the free space guard
+
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import logging
+import collections
+import numpy as np
+from typing import Dict, Iterable, List, Optional
+
+FALLOC_FL_KEEP_SIZE = 1
+_fallocate = None
+
+
+def fallocate(fd: int, offset: int, length: int) -> bool:
+    # Reserve the disk blocks without changing the file size (FALLOC_FL_KEEP_SIZE), so the WAV header sizes
+    # still match the file after a power cut. False if not supported by the OS or the file system
+    global _fallocate
+    if _fallocate is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            _fallocate = libc.fallocate64
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        except (OSError, AttributeError, TypeError):
+            _fallocate = False
+    if _fallocate is False:
+        return False
+    return _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+class LatencyStats:
+    # Durations of the last size operations, the percentiles are calculated on request
+    def __init__(self, size: int = 1000):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+        self.maximum = 0.0
+
+    def add(self, duration: float):
+        self.samples.append(duration)
+        self.count += 1
+        self.maximum = max(self.maximum, duration)
+
+    def stats(self, prefix: str) -> Dict:
+        if self.count == 0:
+            return {}
+        p50, p95, p99 = np.percentile(np.fromiter(self.samples, dtype=np.float64, count=len(self.samples)), (50, 95, 99))*1000
+        return {prefix + "_count": self.count, prefix + "_p50_ms": round(float(p50), 2), prefix + "_p95_ms": round(float(p95), 2),
+                prefix + "_p99_ms": round(float(p99), 2), prefix + "_max_ms": round(self.maximum*1000, 2)}
+
+
+class BlockFile:
+    # Write-only file for long recordings on SD cards:
+    # - the data is collected to block_size blocks, each write ends at a block boundary of the file
+    # - the space is reserved in preallocate chunks ahead of the data, so the file does not grow one cluster at a time
+    # - sync() writes the rest of the buffer and calls fsync, the caller decides how often (data at risk vs write amplification)
+    # pwrite() updates the already written data in place (WAV header), also if it is still in the buffer
+    def __init__(self, filename: str, block_size: int = 1024*1024, preallocate: int = 32*1024*1024,
+                 write_latency: Optional[LatencyStats] = None, sync_latency: Optional[LatencyStats] = None):
+        self.filename = filename
+        self.block_size = block_size
+        self.preallocate = preallocate
+        self.write_latency = write_latency or LatencyStats()
+        self.sync_latency = sync_latency or LatencyStats()
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.buffer = bytearray()
+        self.pos = 0  # Bytes written to the file, the buffer starts here
+        self.allocated = 0
+
+    def tell(self) -> int:
+        return self.pos + len(self.buffer)
+
+    def write(self, data: bytes):
+        self.buffer += data
+        if self.block_size <= 0:
+            self._write(len(self.buffer))
+        elif len(self.buffer) >= self.block_size:
+            end = (self.pos + len(self.buffer))//self.block_size*self.block_size
+            self._write(end - self.pos)
+
+    def pwrite(self, data: bytes, offset: int):
+        written = max(0, min(len(data), self.pos - offset))
+        if written > 0:
+            os.pwrite(self.fd, data[:written], offset)
+        if written < len(data):
+            start = offset + written - self.pos
+            self.buffer[start:start + len(data) - written] = data[written:]
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self._write(len(self.buffer))
+
+    def sync(self):
+        self.flush()
+        t_start = time.perf_counter()
+        os.fsync(self.fd)
+        self.sync_latency.add(time.perf_counter() - t_start)
+
+    def close(self):
+        self.flush()
+        # The preallocated blocks after the end of the data are released
+        if self.allocated > self.pos:
+            os.ftruncate(self.fd, self.pos)
+        os.close(self.fd)
+
+    def _write(self, size: int):
+        if self.preallocate > 0 and self.pos + size > self.allocated:
+            length = max(self.preallocate, self.pos + size - self.allocated)
+            if fallocate(self.fd, self.allocated, length):
+                self.allocated += length
+            else:
+                logging.debug("Preallocation is not supported for %s", self.filename)
+                self.preallocate = 0
+        t_start = time.perf_counter()
+        view = memoryview(self.buffer)[:size]
+        while len(view) > 0:
+            n = os.write(self.fd, view)
+            view = view[n:]
+        view.release()
+        self.write_latency.add(time.perf_counter() - t_start)
+        del self.buffer[:size]
+        self.pos += size
+
+
+sidecar_extensions = (".jsonl", ".activity")  # Tuning and activity index files, deleted with the recording
+
+
+def remove_recording(path: str):
+    # The recording and its index files
+    for name in [path] + [os.path.splitext(path)[0] + extension for extension in sidecar_extensions]:
+        if os.path.exists(name):
+            os.remove(name)
+
+
+class DiskGuard:
+    # Free space of the recordings folder, checked every interval seconds. Below the reserve, the oldest recordings
+    # are deleted (action "rotate") or the recording is stopped (action "stop", or nothing is left to delete).
+    # The files to delete are taken from the recordings catalog (catalog.RecordingsCatalog), oldest first, the starred ones are kept,
+    # and removed from it. The files modified in the last busy_time seconds are never deleted, they can be recorded by another station
+    def __init__(self, folder: str, reserve: int = 200*1024*1024, action: str = "stop", interval: float = 2.0, busy_time: float = 60.0,
+                 recordings=None):
+        if action not in ("stop", "rotate"):
+            raise ValueError("Disk full action: stop or rotate")
+        if action == "rotate" and recordings is None:
+            raise ValueError("Disk full action rotate: the recordings catalog is required")
+        self.folder = folder
+        self.recordings = recordings
+        self.reserve = reserve
+        self.action = action
+        self.interval = interval
+        self.busy_time = busy_time
+        self.checked: Optional[float] = None
+        self.free = 0
+        self.removed: List[str] = []
+        self.removed_bytes = 0
+
+    def free_space(self) -> int:
+        st = os.statvfs(self.folder)
+        return st.f_bavail*st.f_frsize
+
+    def check(self, now: float, keep: Iterable[str] = (), force: bool = False) -> bool:
+        # True if the recording can continue. keep: files of the current recording
+        if force is False and self.checked is not None and now - self.checked < self.interval:
+            return self.free >= self.reserve
+        self.checked = now
+        self.free = self.free_space()
+        if self.free < self.reserve and self.action == "rotate":
+            self._rotate(set(os.path.basename(name) for name in keep))
+        if self.free < self.reserve:
+            logging.warning("Free space %d MB is below the reserve %d MB", self.free//(1024*1024), self.reserve//(1024*1024))
+        return self.free >= self.reserve
+
+    def _rotate(self, keep: set):
+        recent = time.time() - self.busy_time
+        skipped = set(keep)  # Busy or not deleted, the deleted files leave the catalog
+        while self.free < self.reserve:
+            candidates = [(name, size) for name, size in self.recordings.oldest(limit=len(skipped) + 50, starred=False) if name not in skipped]
+            if len(candidates) == 0:
+                break
+            for name, size in candidates:
+                if self.free >= self.reserve:
+                    break
+                path = os.path.join(self.folder, name)
+                try:
+                    if os.path.getmtime(path) >= recent:
+                        skipped.add(name)
+                        continue
+                    remove_recording(path)
+                except FileNotFoundError:
+                    # Deleted outside the recorder, only the catalog row is left
+                    self.recordings.remove_file(name)
+                    self.removed.append(name)
+                    continue
+                except OSError as e:
+                    logging.error("Cannot delete %s: %s", name, e)
+                    skipped.add(name)
+                    continue
+                self.recordings.remove_file(name)
+                logging.debug("Disk is full, the oldest recording %s is deleted", name)
+                self.removed.append(name)
+                self.removed_bytes += size
+                self.free = self.free_space()
+
+    def pop_removed(self) -> List[str]:
+        removed, self.removed = self.removed, []
+        return removed
+
+    def stats(self) -> Dict:
+        return {"disk_free_mb": self.free//(1024*1024), "disk_reserve_mb": self.reserve//(1024*1024), "disk_rotated_mb": self.removed_bytes//(1024*1024)}
+
+
+def benchmark(folder: str = ".", seconds: float = 30.0, samplerate: int = 48000, channels: int = 2, block_size: int = 1024*1024, fsync_interval: float = 10.0):
+    # Writes seconds of audio in 4096 frame chunks as fast as possible, compared to one write() per chunk
+    chunk = bytes(4096*channels*2)
+    chunks = int(seconds*samplerate)//4096
+    filename = os.path.join(folder, ".storage_benchmark.tmp")
+    for name, size in (("direct", 0), ("blocks", block_size)):
+        latency = LatencyStats(chunks)
+        f = BlockFile(filename, block_size=size, preallocate=32*1024*1024 if size > 0 else 0, write_latency=latency)
+        t_start = synced = time.perf_counter()
+        for _ in range(chunks):
+            f.write(chunk)
+            if time.perf_counter() - synced >= fsync_interval:
+                f.sync()
+                synced = time.perf_counter()
+        f.sync()
+        f.close()
+        duration = time.perf_counter() - t_start
+        print("{}: {:.0f} MB in {:.2f}s, {:.0f}x realtime, {}".format(name, chunks*len(chunk)/(1024*1024), duration, seconds/duration, latency.stats("write")))
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    # python3 storage.py [folder] [seconds]
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else ".", float(sys.argv[2]) if len(sys.argv) > 2 else 30.0)
@@ -0,0 +1,141 @@
+import os
+import mmap
+import zlib
+import struct
+import time
+import logging
+import multiprocessing
+import numpy as np
+from typing import Optional
+import catalog
+import utils
+
+
+# Thumbnail: min/max waveform on top, coarse spectrogram below
+thumbnail_width = 600
+waveform_height = 48
+spectrogram_height = 64
+fft_size = 2*spectrogram_height
+columns_per_block = 64
+
+
+def thumbnail_path(cache_dir: str, file_path: str) -> Optional[str]:
+    # Cache key includes the file size and mtime, so a changed file gets a new thumbnail
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return os.path.join(cache_dir, "{}-{:x}-{:x}.png".format(os.path.basename(file_path), st.st_size, st.st_mtime_ns))
+
+
+def no_thumbnail_path(path: str) -> str:
+    # Empty marker: the file has no thumbnail (shorter than the thumbnail width, or not a 16-bit WAV), it is not rendered again
+    return os.path.splitext(path)[0] + ".none"
+
+
+def write_png(path: str, rgb: np.ndarray):
+    # Minimal RGB PNG writer, no Pillow needed
+    height, width, _ = rgb.shape
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    raw = np.hstack((np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, width*3))).tobytes()
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+
+def render_thumbnail(file_path: str, width: int = thumbnail_width) -> Optional[np.ndarray]:
+    # The WAV file is memory mapped and processed in blocks of columns, it is never loaded as a whole
+    info = catalog.read_audio_info(file_path)
+    if "data_offset" not in info or info["block_align"] != 2*info["channels"]:
+        return None
+    channels = info["channels"]
+    with open(file_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        frames = min(info["data_size"], file_size - info["data_offset"]) // info["block_align"]
+        if frames < width:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            samples = np.frombuffer(mm, dtype=np.int16, count=frames*channels, offset=info["data_offset"]).reshape(frames, channels)
+            column_frames = frames // width
+            waveform = np.zeros((width, 2), dtype=np.float32)
+            spectrogram = np.zeros((width, spectrogram_height), dtype=np.float32)
+            window = np.hanning(fft_size).astype(np.float32)
+            for col in range(0, width, columns_per_block):
+                cols = min(columns_per_block, width - col)
+                block = samples[col*column_frames:(col + cols)*column_frames, 0].reshape(cols, column_frames)
+                waveform[col:col + cols, 0] = block.min(axis=1)/32768.0
+                waveform[col:col + cols, 1] = block.max(axis=1)/32768.0
+                # One FFT from the middle of each column is enough for an overview
+                start = (column_frames - fft_size)//2 if column_frames > fft_size else 0
+                segment = block[:, start:start + fft_size].astype(np.float32)
+                if segment.shape[1] < fft_size:
+                    segment = np.pad(segment, ((0, 0), (0, fft_size - segment.shape[1])))
+                spectrum = np.abs(np.fft.rfft(segment*window, axis=1))[:, :spectrogram_height]
+                spectrogram[col:col + cols] = 20*np.log10(spectrum/(32768.0*fft_size/4) + 1e-9)
+                del block, segment
+            del samples
+
+    image = np.zeros((waveform_height + spectrogram_height, width, 3), dtype=np.uint8)
+    # Waveform: vertical line from min to max in each column
+    rows = np.arange(waveform_height)[:, None]
+    y_min = ((1.0 - waveform[:, 1])*(waveform_height - 1)/2).astype(np.int32)
+    y_max = ((1.0 - waveform[:, 0])*(waveform_height - 1)/2).astype(np.int32)
+    mask = (rows >= y_min[None, :]) & (rows <= y_max[None, :])
+    image[:waveform_height][mask] = (120, 220, 120)
+    # Spectrogram: low frequencies at the bottom, -100..0 dB
+    level = np.clip((spectrogram.T[::-1] + 100.0)/100.0, 0.0, 1.0)
+    image[waveform_height:, :, 0] = (255*np.clip(2*level - 1, 0, 1)).astype(np.uint8)
+    image[waveform_height:, :, 1] = (255*np.clip(2*level - 0.5, 0, 1)*level).astype(np.uint8)
+    image[waveform_height:, :, 2] = (255*np.clip(2*level, 0, 1)*(1 - level)).astype(np.uint8)
+    return image
+
+
+def evict(cache_dir: str, budget: int):
+    # LRU: the access time is updated on each request, the oldest thumbnails are deleted first
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".png"):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        os.remove(path)
+        total -= size
+
+
+def touch(path: str):
+    os.utime(path)
+
+
+def thumbnail_worker(folder: str, cache_dir: str, request_queue: multiprocessing.Queue, pause_event: multiprocessing.Event, budget: int):
+    # Background process with the lowest CPU and IO priority, it waits while the recording is active
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s] (THUMB)  %(message)s')
+    utils.set_low_priority()
+    os.makedirs(cache_dir, exist_ok=True)
+    while True:
+        name = request_queue.get()
+        if name is None:
+            break
+        while pause_event.is_set():
+            time.sleep(1.0)
+        file_path = os.path.join(folder, name)
+        path = thumbnail_path(cache_dir, file_path)
+        if path is None or os.path.exists(path) or os.path.exists(no_thumbnail_path(path)):
+            continue
+        try:
+            t_start = time.monotonic()
+            image = render_thumbnail(file_path)
+            if image is not None:
+                write_png(path + ".tmp", image)
+                os.replace(path + ".tmp", path)
+                evict(cache_dir, budget)
+                logging.debug("Thumbnail %s: %.2fs", name, time.monotonic() - t_start)
+            else:
+                open(no_thumbnail_path(path), 'wb').close()
+        except (OSError, ValueError) as e:
+            logging.error("Thumbnail %s error: %s", name, e)
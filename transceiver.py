@@ -4,19 +4,18 @@
 import serial
 import serial.tools.list_ports
 from threading import Thread, Lock, Timer
-import socket
-import queue
-from typing import Tuple, Optional
-import json
+from typing import Dict, List, Tuple, Optional
 import logging
 import time
 import sys
 import os
+import civ
+import ipc
+import hotplug
 
 
 app_active = True
 socket_server, socket_port = "127.0.0.1", 12020
-tx_queue = queue.Queue()
 
 class TransceiverData:
     def __init__(self):
@@ -26,178 +25,218 @@ class TransceiverData:
         self.mode: Optional[str] = None
         self.port_name: Optional[str] = None
         self.port_connected = False
+        # Polled values: smeter, filter_width, preamp, attenuator, rf_gain
+        self.levels: Dict[str, int] = {}
+        # Status updates to the recorder, each transceiver has its own connection
+        self.updates = ipc.UpdateQueue()
         # Supported transceiver models
         self.transceiver_addresses = {"IC-705": 0xA4, "IC-7300": 0x94, "IC-9700": 0xA2}
 
 
-def socket_transmit_thread():
+def socket_transmit_thread(transceiver: TransceiverData):
     logging.debug("socket_transmit_thread started")
+    ipc.sender_loop(transceiver.updates, (socket_server, socket_port), lambda: app_active and transceiver.port_connected)
+    logging.debug("socket_transmit_thread done")
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(5.0)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-    while app_active is True:
-        try:
-            s.connect((socket_server, socket_port))
-
-            logging.debug("Socket connected")
-            while True:
-                try:
-                    data = tx_queue.get_nowait()
-                    data_str = json.dumps(data)
-                    # logging.debug("Socket Send: %s", data_str)
-                    s.sendall(data_str.encode() + b'\xFD')
-                except queue.Empty:
-                    time.sleep(0.01)
-        except Exception as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            logging.error(f"socket_transmit_thread error {e}, line {exc_tb.tb_lineno}")
-            time.sleep(10)
-
-    s.close()
 
-    logging.debug("socket_transmit_thread done")
+def find_transceivers() -> List[TransceiverData]:
+    # All CI-V transceiver ports
+    transceivers = []
+    for port, desc, hwid in sorted(serial.tools.list_ports.comports()):
+        logging.debug(f"PORT: {port}: {desc} [{hwid}]")
+        if (os.name == 'nt' and "CI-V" in desc) or (os.name != 'nt' and "IC-" in desc):
+            # COM12: IC-705 Serial Port A (CI-V) (COM12)
+            transceiver = TransceiverData()
+            transceiver.port_name = port
+            transceiver.name = port
+            for tr_name in transceiver.transceiver_addresses.keys():
+                if tr_name in desc:
+                    transceiver.name = tr_name
+                    transceiver.civ_address = bytes([transceiver.transceiver_addresses[tr_name]])
+            transceivers.append(transceiver)
+    # Radios of the same model: the port is added to the name, "IC-705@ttyACM1", so the stations are not mixed
+    names = [transceiver.name for transceiver in transceivers]
+    for transceiver in transceivers:
+        if names.count(transceiver.name) > 1:
+            transceiver.name = "{}@{}".format(transceiver.name, os.path.basename(transceiver.port_name))
+    return transceivers
 
 
 def transceiver_read_civ():
     logging.debug("transceiver_update_thread started")
 
-    # Send transceiver status via sockets
-    # tx_queue = queue.Queue()
-    Thread(target=socket_transmit_thread, name="SocketTX").start()
-
-    # Serial data read loop
-    active = True
-    while active:
-        transceiver = TransceiverData()
-
-        # Find a CI-V transceiver port
-        for port, desc, hwid in sorted(serial.tools.list_ports.comports()):
-            logging.debug(f"PORT: {port}: {desc} [{hwid}]")
-            if (os.name == 'nt' and "CI-V" in desc) or (os.name != 'nt' and "IC-" in desc):
-                # COM12: IC-705 Serial Port A (CI-V) (COM12)
-                transceiver.port_name = port
-                for tr_name in transceiver.transceiver_addresses.keys():
-                    if tr_name in desc:
-                        transceiver.name = tr_name
-                        transceiver.civ_address = bytes([transceiver.transceiver_addresses[tr_name]])
-                break
-
-        # If no connection, wait
-        if transceiver.port_name is None:
-            logging.debug("CI-V port not found, wait 10s...")
-            tx_queue.put_nowait({"transceiver": "not found"})
-            time.sleep(10.0)
+    # One reader thread per transceiver, the ports are rescanned when a serial port is added or removed
+    # (and every rescan_interval seconds, if a port was busy or the events are missed)
+    readers: Dict[str, Thread] = {}
+    watcher = hotplug.DeviceWatcher(("tty",))
+    rescan_interval, scan_time = 60.0, 0.0
+    while app_active:
+        events = watcher.wait(5.0)
+        if len(events) == 0 and time.monotonic() - scan_time < rescan_interval:
             continue
+        scan_time = time.monotonic()
+        for transceiver in find_transceivers():
+            reader = readers.get(transceiver.port_name)
+            if reader is None or reader.is_alive() is False:
+                readers[transceiver.port_name] = Thread(target=transceiver_port_thread, args=(transceiver,), name=transceiver.name)
+                readers[transceiver.port_name].start()
+
+        # If no connection, wait for a port
+        if len(readers) == 0:
+            logging.debug("CI-V port not found, waiting for a serial device (%s)...", watcher.method)
+
+    watcher.close()
+    logging.debug("transceiver_update_thread ended")
 
-        logging.debug("Transceiver found: {}, addr={} on port {}".format(transceiver.name, transceiver.civ_address, transceiver.port_name))
-        tx_queue.put_nowait({"name": transceiver.name})
 
+def transceiver_port_thread(transceiver: TransceiverData):
+    logging.debug("Transceiver found: {}, addr={} on port {}".format(transceiver.name, transceiver.civ_address, transceiver.port_name))
+    try:
         ser = serial.Serial(transceiver.port_name, 19200, timeout=0.1)
+    except serial.SerialException as e:
+        logging.error("Transceiver %s: cannot open port %s: %s", transceiver.name, transceiver.port_name, e)
+        return
 
-        serial_data = b''
-        while active:
-            # Read incoming commands
-            # try:
-            #     cmd = queue_in.get_nowait()
-            #     if cmd and "command" in cmd and cmd["command"] == "quit":
-            #         active = False
-            # except queue.Empty:
-            #     pass
-
-            # First run, get parameters
-            if transceiver.frequency is None and transceiver.mode is None:
-                # Get Frequency
-                ser.write(b"\xfe\xfe%b\xE0\x03\xfd" % transceiver.civ_address)
-            if transceiver.frequency is not None and transceiver.mode is None:
-                # Get Mode
-                ser.write(b"\xfe\xfe%b\xE0\x04\xfd" % transceiver.civ_address)
-
-            # Update serial data
-            try:
-                s = ser.read(size=32)
-                serial_data += s
-
-                # CI-V Commands: http://www.plicht.de/ekki/civ/civ-p41.html
-                # Command body: FE FE E0 addr cmd <body> FD
-                while serial_data.find(b'\xFD') != -1:
-                    cmd_end = serial_data.find(b'\xFD')
-                    # print("S:", serial_data, cmd_end)
-                    if cmd_end != -1:
-                        # New command found
-                        cmd = serial_data[:cmd_end+1]
-                        on_civ_command_received(cmd, transceiver)
-                        serial_data = serial_data[cmd_end+1:]
-                    else:
-                        # If command too big, something is wrong
-                        if len(serial_data) > 1024:
-                            serial_data = b''
-
-                # if len(s) > 0:
-                #    print("S:", s, serial_data)
-
-            except Exception as e:
-                logging.error("transceiver_update_process exception %s", str(e))
-
-            # time.sleep(0.01)
-
-        ser.close()
-
-    logging.debug("transceiver_update_thread ended")
-
-
-def on_civ_command_received(cmd_data: bytes, transciever: TransceiverData):
-    if cmd_data[0:2] == b'\xFE\xFE':
-        cmd_id = cmd_data[4]
-        # logging.debug("CI-V CMD: %s", ' '.join('{:02x}'.format(x) for x in serial_data))
-        if cmd_id == 0x00 or cmd_id == 0x03:
-            # 00h: Frequency changed: b'\xfe\xfe\x00\xa4\x00\x00 1\x07\x00\xfd'
-            # 03h: Read operating frequency: b'\xfe\xfe\xe0\xa4\x03\x00\x00\x05\x07\x00\xfd'
-            cmd = cmd_data.hex()
-            # "fefee0a4038967452301fd" = > "0123456789" = > "123456789"
-            freq = int((cmd[18:20] + cmd[16:18] + cmd[14:16] + cmd[12:14] + cmd[10:12]).lstrip("0"))
-            if freq != transciever.frequency:
-                logging.debug("Transceiver Frequency: %d", freq)
-                tx_queue.put_nowait({"frequency": freq})
-                # queue_out.put_nowait({})  # Bug, on Windows the last message stuck in queue, needs to send a second one
-                transciever.frequency = freq
-        elif cmd_id == 0x01 or cmd_id == 0x04:
-            # 01h: Mode/filter changed: b'\xfe\xfe\x00\xa4\x04\x00\x01\xfd'
-            # 04h: Read operating mode: b'\xfe\xfe\xe0\xa4\x04\x00\x01\xfd'
-            mode, filter = cmd_data[5], cmd_data[6]
-            # Mode: http://www.plicht.de/ekki/civ/civ-p33.html
-            # LSB	        $00
-            # USB	        $01
-            # AM	        $02
-            # CW	        $03
-            # RTTY (FSK)	$04	FM on IC-910
-            # FM	        $05
-            # Wide FM	    $06	IC-706xxx, IC-R8500, IC-R20
-            # CW-R	        $07	CW reverse sideband
-            # RTTY-R	    $08	RTTY reverse sideband
-            # S-AM	        $11	Synchronous AM detection, IC-R75, Dual Sideband S-AM on IC-R8600
-            # PSK	        $12	PSK31, IC-7800 only
-            # PSK-R	        $12	PSK31, IC-7800 only, reverse sideband
-            # S-AM (L)	    $14	S-AM LSB on IC-R8600
-            # S-AM (U)	    $15	S-AM USB on IC-R8600
-            # P25	        $16	IC-R8600
-            # DV	        $17	Digital Voice (D-Star), IC-9100, IC-R8600, IC-9700, IC-705
-            # dPMR	        $18	IC-R8600
-            # NXDN-VN	    $19	IC-R8600
-            # NXDN-N	    $20	IC-R8600
-            # DCR	        $21	IC-R8600
-            # DD	        $22	Digital Data (D-Star), IC-9700
-            modes = {0: "LSB", 1: "USB", 2: "AM", 3: "CW", 4: "RTTY", 5: "FM", 6: "WFM", 7: "CW-R", 8: "RTTY-R", 0x11: "SAM", 0x12: "PSK", 0x16: "P25", 0x17: "DV"}
-            mode_str = modes[mode] if mode in modes else str(mode)
-            if mode_str != transciever.mode:
-                logging.debug("Transceiver Mode: %s", mode_str)
-                tx_queue.put_nowait({"mode": mode_str})
-                # queue_out.put_nowait({})  # Bug, on Windows the last message stuck in queue, needs to send a second one
-                transciever.mode = mode_str
-        else:
-            # Unsupported command
-            logging.debug("CI-V CMD: %s", ' '.join('{:02x}'.format(x) for x in cmd_data))
+    transceiver.port_connected = True
+    transceiver.updates.put({"name": transceiver.name})
+    # Send transceiver status via sockets
+    Thread(target=socket_transmit_thread, args=(transceiver,), name=f"{transceiver.name}-TX").start()
+
+    decoder = civ.CivDecoder(radio_address=transceiver.civ_address[0] if len(transceiver.civ_address) > 0 else None)
+    # Unknown model: the requests go to the broadcast address until the radio sends its first frame
+    poller = create_poller(transceiver.civ_address[0] if len(transceiver.civ_address) > 0 else civ.BROADCAST)
+    stats_time = time.monotonic()
+    while app_active and transceiver.port_connected:
+        # Update serial data
+        try:
+            # Read all waiting bytes, or wait for the first one up to the port timeout
+            s = ser.read(size=max(1, ser.in_waiting))
+
+            # CI-V Commands: http://www.plicht.de/ekki/civ/civ-p41.html
+            # Command body: FE FE E0 addr cmd <body> FD
+            now = time.monotonic()
+            for frame in decoder.feed(s):
+                if len(transceiver.civ_address) == 0 and frame.to in (civ.CONTROLLER, civ.BROADCAST) and frame.src not in (civ.CONTROLLER, civ.BROADCAST):
+                    transceiver.civ_address = bytes([frame.src])
+                    decoder.radio_address = poller.radio_address = frame.src
+                    logging.debug("Transceiver %s: CI-V address %02X", transceiver.name, frame.src)
+                on_civ_command_received(frame, transceiver)
+                poller.on_frame(frame, now)
+
+            # Requests are sent only when the incoming data is handled and the bus is idle,
+            # so the transceive frames (VFO tuning) are never delayed by the polling
+            if ser.in_waiting == 0:
+                request = poller.poll(now)
+                if request is not None:
+                    ser.write(request)
+            if now - stats_time > 5.0:
+                # Decoder counters and the pid are used for the recorder metrics
+                stats = {"civ_decoder": decoder.stats(), "civ_poll": poller.stats(now), "pid": os.getpid()}
+                transceiver.updates.put(stats)
+                stats_time = now
+
+        except serial.SerialException as e:
+            # Transceiver disconnected, the port will be found again by the rescan
+            logging.error("Transceiver %s: port error %s", transceiver.name, str(e))
+            transceiver.port_connected = False
+        except Exception as e:
+            logging.error("transceiver_update_process exception %s", str(e))
+
+    ser.close()
+    logging.debug("Transceiver %s: reader ended", transceiver.name)
+
+
+def create_poller(radio_address: int) -> civ.CivPoller:
+    # Frequency and mode are sent by the radio itself (CI-V transceive), they are polled fast only until the first answer
+    # and then re-synced every 30s. S-meter is polled every second, the receiver settings every 5s
+    poller = civ.CivPoller(radio_address)
+    poller.add("frequency", b'\x03', interval=30.0, initial_interval=0.5)
+    poller.add("mode", b'\x04', interval=30.0, initial_interval=0.5)
+    poller.add("smeter", b'\x15\x02', interval=1.0)
+    poller.add("filter_width", b'\x1A\x03', interval=5.0)
+    poller.add("preamp", b'\x16\x02', interval=5.0)
+    poller.add("attenuator", b'\x11', interval=5.0)
+    poller.add("rf_gain", b'\x14\x02', interval=5.0)
+    return poller
+
+
+def filter_width(index: int, mode: Optional[str]) -> int:
+    # 1Ah 03h: IF filter width index, Hz. AM: 200..10000Hz with 200Hz step,
+    # other modes: 50..500Hz with 50Hz step, 600..3600Hz with 100Hz step
+    if mode == "AM":
+        return (index + 1)*200
+    return (index + 1)*50 if index < 10 else (index - 4)*100
+
+
+def on_level_received(name: str, value: int, transciever: TransceiverData):
+    if transciever.levels.get(name) != value:
+        transciever.levels[name] = value
+        transciever.updates.put({"levels": dict(transciever.levels)})
+
+
+def on_civ_command_received(frame: civ.CivFrame, transciever: TransceiverData):
+    cmd_id = frame.cmd
+    if (cmd_id == 0x00 or cmd_id == 0x03) and len(frame.data) >= 5:
+        # 00h: Frequency changed: b'\xfe\xfe\x00\xa4\x00\x00 1\x07\x00\xfd'
+        # 03h: Read operating frequency: b'\xfe\xfe\xe0\xa4\x03\x00\x00\x05\x07\x00\xfd'
+        freq = civ.decode_frequency(frame.data)
+        if freq != transciever.frequency:
+            logging.debug("Transceiver Frequency: %d", freq)
+            transciever.updates.put({"frequency": freq, "civ_time": time.time()})
+            # queue_out.put_nowait({})  # Bug, on Windows the last message stuck in queue, needs to send a second one
+            transciever.frequency = freq
+    elif (cmd_id == 0x01 or cmd_id == 0x04) and len(frame.data) >= 1:
+        # 01h: Mode/filter changed: b'\xfe\xfe\x00\xa4\x04\x00\x01\xfd'
+        # 04h: Read operating mode: b'\xfe\xfe\xe0\xa4\x04\x00\x01\xfd'
+        mode = frame.data[0]
+        # Mode: http://www.plicht.de/ekki/civ/civ-p33.html
+        # LSB	        $00
+        # USB	        $01
+        # AM	        $02
+        # CW	        $03
+        # RTTY (FSK)	$04	FM on IC-910
+        # FM	        $05
+        # Wide FM	    $06	IC-706xxx, IC-R8500, IC-R20
+        # CW-R	        $07	CW reverse sideband
+        # RTTY-R	    $08	RTTY reverse sideband
+        # S-AM	        $11	Synchronous AM detection, IC-R75, Dual Sideband S-AM on IC-R8600
+        # PSK	        $12	PSK31, IC-7800 only
+        # PSK-R	        $12	PSK31, IC-7800 only, reverse sideband
+        # S-AM (L)	    $14	S-AM LSB on IC-R8600
+        # S-AM (U)	    $15	S-AM USB on IC-R8600
+        # P25	        $16	IC-R8600
+        # DV	        $17	Digital Voice (D-Star), IC-9100, IC-R8600, IC-9700, IC-705
+        # dPMR	        $18	IC-R8600
+        # NXDN-VN	    $19	IC-R8600
+        # NXDN-N	    $20	IC-R8600
+        # DCR	        $21	IC-R8600
+        # DD	        $22	Digital Data (D-Star), IC-9700
+        modes = {0: "LSB", 1: "USB", 2: "AM", 3: "CW", 4: "RTTY", 5: "FM", 6: "WFM", 7: "CW-R", 8: "RTTY-R", 0x11: "SAM", 0x12: "PSK", 0x16: "P25", 0x17: "DV"}
+        mode_str = modes[mode] if mode in modes else str(mode)
+        if mode_str != transciever.mode:
+            logging.debug("Transceiver Mode: %s", mode_str)
+            transciever.updates.put({"mode": mode_str, "civ_time": time.time()})
+            # queue_out.put_nowait({})  # Bug, on Windows the last message stuck in queue, needs to send a second one
+            transciever.mode = mode_str
+    elif cmd_id == 0x15 and len(frame.data) >= 3 and frame.data[0] == 0x02:
+        # 15h 02h: S-meter level, 0000..0255 (S9 = 0120)
+        on_level_received("smeter", civ.decode_bcd(frame.data[1:3]), transciever)
+    elif cmd_id == 0x14 and len(frame.data) >= 3 and frame.data[0] == 0x02:
+        # 14h 02h: RF gain, 0000..0255
+        on_level_received("rf_gain", civ.decode_bcd(frame.data[1:3]), transciever)
+    elif cmd_id == 0x1A and len(frame.data) >= 2 and frame.data[0] == 0x03:
+        on_level_received("filter_width", filter_width(civ.decode_bcd(frame.data[1:2]), transciever.mode), transciever)
+    elif cmd_id == 0x16 and len(frame.data) >= 2 and frame.data[0] == 0x02:
+        # 16h 02h: Preamp, 00 off, 01 P.AMP1, 02 P.AMP2
+        on_level_received("preamp", frame.data[1], transciever)
+    elif cmd_id == 0x11 and len(frame.data) >= 1:
+        # 11h: Attenuator, dB in BCD: 00 off, 20h 20dB
+        on_level_received("attenuator", civ.decode_bcd(frame.data[0:1]), transciever)
+    elif cmd_id == civ.OK or cmd_id == civ.NG:
+        pass
+    else:
+        # Unsupported command
+        logging.debug("CI-V CMD: %02x %s", cmd_id, ' '.join('{:02x}'.format(x) for x in frame.data))
 
 
 if __name__ == "__main__":
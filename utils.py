@@ -1,4 +1,4 @@
-import sys, os, time, socket
+import sys, os, time, socket, subprocess
 import psutil
 import logging
 
@@ -47,12 +47,29 @@ def get_ip_address():
             hostname = socket.gethostname()
             return socket.gethostbyname(hostname)
         else:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            return s.getsockname()[0]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.connect(("8.8.8.8", 80))
+                return s.getsockname()[0]
     except:
         return "-"
 
+def get_sound_cards():
+    # ALSA sound cards list, changes on USB audio hotplug. Returns None if not available (Windows)
+    try:
+        with open("/proc/asound/cards") as f:
+            return f.read()
+    except:
+        return None
+
+def set_low_priority():
+    # Lowest CPU and IO priority for the background workers (thumbnails, archive)
+    try:
+        os.nice(19)
+        if hasattr(psutil, "IOPRIO_CLASS_IDLE"):
+            psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+    except Exception as e:
+        logging.debug("Cannot set low priority: %s", e)
+
 def get_cpu_load():
     try:
         return int(psutil.cpu_percent())
@@ -64,3 +81,27 @@ def get_ram_usage():
         return int(psutil.virtual_memory().percent)
     except:
         return 0
+
+def get_soc_temperature():
+    # Degrees C, None if not available
+    try:
+        with open("/sys/class/thermal/thermal_zone0/temp") as f:
+            return int(f.read().strip())/1000.0
+    except:
+        return None
+
+def get_throttled():
+    # Raspberry Pi throttling flags (vcgencmd get_throttled): bit 0 under-voltage, 1 frequency capped, 2 throttled, 3 soft temperature limit,
+    # bits 16..19 - the same has occurred since the boot. None if not available
+    try:
+        output = subprocess.run(["vcgencmd", "get_throttled"], capture_output=True, text=True, timeout=2.0).stdout
+        return int(output.strip().partition("=")[2], 16)
+    except:
+        return None
+
+def get_process_start_time():
+    # time.time() of the process start, the interpreter start and the imports included
+    try:
+        return psutil.Process().create_time()
+    except:
+        return time.time()
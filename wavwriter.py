@@ -0,0 +1,198 @@
+import struct
+import time
+import os
+import logging
+import json
+from typing import Callable, List, Optional, Dict
+from storage import BlockFile, LatencyStats
+from activity import ActivityWriter
+
+
+# WAV header layout used by the writer:
+#   0  RIFF <size> WAVE
+#   12 JUNK <28> 28 zero bytes - reserved for the ds64 chunk, if the file grows over 4 GB (RF64, EBU Tech 3306)
+#   48 fmt  <16> PCM format
+#   72 data <size>
+#   80 samples
+# All size fields are patched in place, so a file is always readable up to the last header update.
+#
+# If segment_info is set, each segment has a sidecar index file (same name, .jsonl) with one JSON event per line:
+#   {"frequency": 7074000, "mode": "USB", "frame": 0, "offset": 80}
+# "frame" is the sample position in the segment and "offset" is the byte offset in the WAV file,
+# so a tool can seek to the frequency segment without scanning the audio.
+# If activity is set, each segment also has a per-second level summary (.activity), see activity.py
+RIFF_SIZE_OFFSET = 4
+JUNK_OFFSET = 12
+DS64_OFFSET = 20
+DATA_SIZE_OFFSET = 76
+HEADER_SIZE = 80
+MAX_RIFF_SIZE = 0xFFFFFFFF
+
+
+def wav_header(channels: int, samplerate: int, sample_width: int) -> bytes:
+    block_align = channels*sample_width
+    return (b'RIFF' + struct.pack('<I', HEADER_SIZE - 8) + b'WAVE' +
+            b'JUNK' + struct.pack('<I', 28) + bytes(28) +
+            b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, samplerate, samplerate*block_align, block_align, sample_width*8) +
+            b'data' + struct.pack('<I', 0))
+
+
+def index_filename(wav_filename: str) -> str:
+    return os.path.splitext(wav_filename)[0] + ".jsonl"
+
+
+def activity_filename(wav_filename: str) -> str:
+    return os.path.splitext(wav_filename)[0] + ".activity"
+
+
+class SegmentedWavWriter:
+    # WAV writer for long recordings:
+    # - the header is patched and the file is synced every patch_interval seconds, so after a power cut the file is still valid
+    #   and at most patch_interval seconds are lost. Between, the data is written in block_size blocks to the preallocated space
+    # - a new file is started after max_seconds or max_bytes of audio (0 - no limit)
+    # - a segment larger than 4 GB is converted to RF64 in place
+    extension = ".wav"
+
+    def __init__(self, make_filename: Callable[[], str], channels: int, samplerate: int, sample_width: int,
+                 max_seconds: float = 0, max_bytes: int = 0, patch_interval: float = 10.0, segment_info: Optional[Callable[[], Dict]] = None,
+                 block_size: int = 1024*1024, preallocate: int = 32*1024*1024, activity: bool = False):
+        self.make_filename = make_filename
+        self.channels = channels
+        self.samplerate = samplerate
+        self.sample_width = sample_width
+        self.frame_size = channels*sample_width
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.patch_interval = patch_interval
+        self.segment_info = segment_info
+        self.block_size = block_size
+        self.preallocate = preallocate
+        self.write_latency = LatencyStats()
+        self.sync_latency = LatencyStats()
+        self.index_file = None
+        self.activity = activity
+        self.activity_writer: Optional[ActivityWriter] = None
+        self.activity_stats: Dict = {}
+        self.filenames: List[str] = []
+        self.file = None
+        self.filename: Optional[str] = None
+        self.data_size = 0
+        self.rf64 = False
+        self.patched_at = 0.0
+        self.new_segment()
+
+    @property
+    def segment_limit(self) -> int:
+        # Segment size limit in bytes, aligned to the frame size
+        limits = []
+        if self.max_seconds > 0:
+            limits.append(int(self.max_seconds*self.samplerate)*self.frame_size)
+        if self.max_bytes > 0:
+            limits.append(max(self.frame_size, (self.max_bytes - HEADER_SIZE) // self.frame_size*self.frame_size))
+        return min(limits) if len(limits) > 0 else 0
+
+    def frames_written(self) -> int:
+        return self.data_size // self.frame_size
+
+    def new_segment(self):
+        self._end_segment()
+        self.filename = os.path.splitext(self.make_filename())[0] + self.extension
+        if os.path.exists(self.filename):
+            # Segments started within the same second
+            base, ext = os.path.splitext(self.filename)
+            index = 2
+            while os.path.exists("{}_{}{}".format(base, index, ext)):
+                index += 1
+            self.filename = "{}_{}{}".format(base, index, ext)
+        self._open_segment()
+        self.filenames.append(self.filename)
+        self.data_size = 0
+        self.rf64 = False
+        self.patched_at = time.monotonic()
+        if self.segment_info is not None:
+            self.index_file = open(index_filename(self.filename), 'w')
+            self.write_event(self.segment_info())
+        if self.activity:
+            self.activity_writer = ActivityWriter(activity_filename(self.filename), self.samplerate, self.channels)
+        logging.debug("WAV segment started: %s", self.filename)
+
+    def writeframes(self, data: bytes):
+        view = memoryview(data)
+        while len(view) > 0:
+            limit = self.segment_limit
+            if limit > 0 and self.data_size >= limit:
+                self.new_segment()
+            n = len(view) if limit == 0 else min(len(view), limit - self.data_size)
+            self._write_data(view[:n])
+            if self.activity_writer is not None:
+                self.activity_writer.process(view[:n])
+            self.data_size += n
+            view = view[n:]
+
+        if time.monotonic() - self.patched_at >= self.patch_interval:
+            self.patch_header()
+
+    def data_offset(self) -> Optional[int]:
+        # Byte offset of the current write position in the file
+        return HEADER_SIZE + self.data_size
+
+    def stats(self) -> Dict:
+        if self.activity_writer is not None:
+            self.activity_stats = self.activity_writer.stats()
+        return dict({"format": self.extension[1:], "segments": len(self.filenames)}, **self.write_latency.stats("write"), **self.sync_latency.stats("fsync"),
+                    **self.activity_stats)
+
+    def _open_segment(self):
+        limit = self.segment_limit
+        preallocate = min(self.preallocate, HEADER_SIZE + limit) if limit > 0 else self.preallocate
+        self.file = BlockFile(self.filename, self.block_size, preallocate, self.write_latency, self.sync_latency)
+        self.file.write(wav_header(self.channels, self.samplerate, self.sample_width))
+
+    def _write_data(self, data: memoryview):
+        if self.rf64 is False and HEADER_SIZE + self.data_size + len(data) > MAX_RIFF_SIZE:
+            self._convert_to_rf64()
+        self.file.write(data)
+
+    def _close_segment(self):
+        self.patch_header()
+        self.file.close()
+
+    def write_event(self, event: Dict):
+        # Event at the current write position, stored in the segment index
+        if self.index_file is not None:
+            self.index_file.write(json.dumps(dict(event, frame=self.frames_written(), offset=self.data_offset())) + "\n")
+            self.index_file.flush()
+
+    def patch_header(self, sync: bool = True):
+        # Cheap in-place update of the size fields, then the buffered data is written and synced
+        if self.rf64:
+            self.file.pwrite(struct.pack('<QQQ', HEADER_SIZE - 8 + self.data_size, self.data_size, self.frames_written()), DS64_OFFSET)
+        else:
+            self.file.pwrite(struct.pack('<I', HEADER_SIZE - 8 + self.data_size), RIFF_SIZE_OFFSET)
+            self.file.pwrite(struct.pack('<I', self.data_size), DATA_SIZE_OFFSET)
+        if sync:
+            self.file.sync()
+        self.patched_at = time.monotonic()
+
+    def _convert_to_rf64(self):
+        # RF64: RIFF -> RF64, JUNK -> ds64, 32-bit sizes are set to 0xFFFFFFFF and the real sizes are in ds64
+        logging.debug("WAV segment %s exceeds 4 GB, switching to RF64", self.filename)
+        self.file.pwrite(b'RF64' + struct.pack('<I', MAX_RIFF_SIZE), 0)
+        self.file.pwrite(b'ds64', JUNK_OFFSET)
+        self.file.pwrite(struct.pack('<I', MAX_RIFF_SIZE), DATA_SIZE_OFFSET)
+        self.rf64 = True
+        self.patch_header(sync=False)
+
+    def close(self):
+        self._end_segment()
+
+    def _end_segment(self):
+        if self.file is not None:
+            self._close_segment()
+            self.file = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+        if self.activity_writer is not None:
+            self.activity_writer.close()
+            self.activity_writer = None
@@ -0,0 +1,351 @@
+import time
+from datetime import datetime
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Optional
+import pyaudio
+import audio
+import spectrum
+import squelch
+import decimator
+import storage
+import catalog
+import live
+import metrics
+import utils
+from ringbuffer import HistoryBuffer
+
+
+def capture_worker(audio_device: str, conn: Connection, stats_queue: Optional[multiprocessing.Queue], tuning_queue: Optional[multiprocessing.Queue],
+                   spectrum_queue: Optional[multiprocessing.Queue] = None, spectrum_event: Optional[multiprocessing.Event] = None, spectrum_fps: float = 10.0,
+                   cpu_core: Optional[int] = None, monitor: Optional[dict] = None, buffer_seconds: float = audio.capture_buffer_seconds, write_interval: float = 0.5):
+    # Long-lived capture process: the stream is opened once and kept running, the recordings are started and stopped
+    # by the commands from the pipe. The last history_seconds of audio are kept in memory (time-shift),
+    # a recording starts at the sample position of the start request minus the history.
+    # The stream is reopened only if the sample rate or the number of channels is changed
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s] (CAPTURE)  %(message)s')
+    audio.pin_to_core(cpu_core)
+    # Own PortAudio instance, the parent one is not used after fork
+    pd = pyaudio.PyAudio()
+    sound_cards = utils.get_sound_cards()
+    # The stream is opened after the first "configure" command
+    settings = {}
+    pending_settings = {}
+    capture: Optional[audio.AudioCapture] = None
+    history: Optional[HistoryBuffer] = None
+    spectrum_stop = None
+    monitor_stop = None
+    tuning = audio.TuningTracker("", 0, "", tuning_queue)
+    start_request: Optional[dict] = None
+    # Squelch mode: the recording is armed, the data is written only during the signal bursts
+    gate: Optional[squelch.SquelchGate] = None
+    armed = False
+    burst_writing = False
+    # Free space of the recordings folder, checked while recording
+    guard: Optional[storage.DiskGuard] = None
+    wf, size_total, index, open_retry, stream_opens, start_latency = None, 0, 0, 0.0, 0, 0.0
+    # Latency of the capture buffer reads and of the writes (writer, index, disk), and the on-demand profiler
+    read_time, write_time = metrics.Histogram(), metrics.Histogram()
+    sampler = metrics.Sampler()
+
+    def history_frames() -> int:
+        return int(settings["history_seconds"]*settings["samplerate"])
+
+    def history_capacity() -> float:
+        # Time-shift or the squelch pre-roll and minimum event, and the margin of one capture buffer
+        squelch_seconds = settings["squelch"]["pre_roll"] + settings["squelch"]["min_event"] if settings.get("squelch") else 0.0
+        return max(settings["history_seconds"], squelch_seconds) + buffer_seconds
+
+    def create_file():
+        # Narrow modes are decimated, if enabled. The rate is chosen by the mode at the file start and kept for the file
+        profile = decimator.mode_profile(tuning.state["mode"], settings["samplerate"], settings["channels"]) if settings.get("decimate") else None
+        if profile is None:
+            return audio.create_recording_file(tuning, settings["channels"], settings["samplerate"], capture.sample_width, settings["writer_options"],
+                                               settings["folder"])
+        dec = decimator.Decimator(settings["samplerate"], settings["channels"], profile[0], profile[1])
+        filename, segment_writer = audio.create_recording_file(tuning, dec.out_channels, dec.out_samplerate, capture.sample_width, settings["writer_options"],
+                                                               settings["folder"])
+        logging.debug("Decimation for {}: {}".format(tuning.state["mode"], dec.stats()["decimation"]))
+        return filename, decimator.DecimatingWriter(segment_writer, dec)
+
+    def start_burst():
+        nonlocal wf, size_total, burst_writing
+        burst_writing = True
+        if wf is None:
+            filename, wf = create_file()
+            size_total = 0
+            logging.debug('Squelch: recording the file {}'.format(filename))
+        else:
+            # One file for all bursts, each burst is added to the index
+            wf.write_event({"burst": gate.events, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            "frequency": tuning.state["frequency"], "mode": tuning.state["mode"]})
+
+    def write_bursts():
+        # Write the confirmed bursts from the history, the silence between them is dropped
+        nonlocal size_total, burst_writing
+        head = capture.frames_read() - history.frames()
+        while len(gate.bursts) > 0:
+            start, end = gate.bursts[0]
+            if head < start:
+                history.pop(start - head)
+                head = start
+                tuning.discard(head)
+            if burst_writing is False:
+                start_burst()
+            upto = end if end is not None else capture.frames_read()
+            data = history.pop(max(0, upto - head))
+            with write_time.time():
+                tuning.write(wf, data, head)
+            size_total += len(data)
+            head += len(data)//capture.frame_size
+            if end is None:
+                return
+            gate.bursts.pop(0)
+            burst_writing = False
+            if settings["squelch"]["split"]:
+                stop_recording(flush=False)
+        history.pop(max(0, gate.keep_from(capture.frames_read()) - head))
+        tuning.discard(capture.frames_read() - history.frames())
+
+    def close_capture():
+        nonlocal capture, spectrum_stop, monitor_stop
+        if spectrum_stop is not None:
+            spectrum_stop.set()
+            spectrum_stop = None
+        if monitor_stop is not None:
+            monitor_stop.set()
+            monitor_stop = None
+        if capture is not None:
+            capture.close()
+            capture = None
+
+    def stop_recording(flush: bool = True):
+        # flush: write the data left in the history (not used in the squelch mode, it is the silence after the burst)
+        nonlocal wf, size_total
+        if flush:
+            start_frame = capture.frames_read() - history.frames()
+            data = history.pop(history.frames())
+            with write_time.time():
+                tuning.write(wf, data, start_frame)
+            size_total += len(data)
+        wf.close()
+        send_stats(files=wf.filenames)
+        saved = wf.stats().get("saved_bytes")
+        logging.debug("Recording complete: {} KBytes recorded{}".format(size_total//1024, ", {} KBytes saved by decimation".format(saved//1024) if saved else ""))
+        wf = None
+
+    def send_stats(**kwargs):
+        stats = dict(capture.stats() if capture is not None else {}, bytes_written=size_total, start_latency_ms=round(start_latency*1000, 1),
+                     stream_opens=stream_opens, time=time.monotonic(), **kwargs)
+        if history is not None:
+            stats.update(timeshift_memory=history.memory_bytes, timeshift_overwritten=history.overwritten,
+                         timeshift_seconds=round(min(history.frames(), history_frames())/settings["samplerate"], 1))
+        if wf is not None:
+            stats.update(wf.stats())
+        if gate is not None:
+            stats.update(gate.stats())
+        if guard is not None:
+            stats.update(guard.stats())
+        stats["histograms"] = {"read": read_time.snapshot(), "write": write_time.snapshot()}
+        if capture is not None:
+            stats["histograms"]["callback"] = capture.callback_time.snapshot()
+        audio.send_stats(stats_queue, stats)
+
+    while True:
+        if capture is None and len(settings) > 0 and time.monotonic() >= open_retry:
+            if utils.get_sound_cards() != sound_cards:
+                # PortAudio sees only the devices present at its initialization
+                sound_cards = utils.get_sound_cards()
+                pd.terminate()
+                pd = pyaudio.PyAudio()
+            device_index, device_name = audio.find_audio_device(pd, audio_device)
+            if device_index == -1:
+                # Device is not connected yet: the recorder sends "rescan" when a sound card is connected, the retry is only a fallback
+                open_retry = time.monotonic() + 30.0
+            else:
+                capture = audio.AudioCapture(pd, device_index, settings["channels"], settings["samplerate"], buffer_seconds)
+                # History has a margin of one capture buffer: while recording, each pass appends the data read from the capture buffer
+                # before it is written, this must never overwrite the history head
+                history = HistoryBuffer(int(history_capacity()*settings["samplerate"]), settings["channels"])
+                if spectrum_queue is not None:
+                    _, spectrum_stop = spectrum.start_spectrum(capture, spectrum_queue, spectrum_event, spectrum_fps)
+                if monitor is not None:
+                    _, monitor_stop = live.start_monitor(capture, monitor["ring"], monitor["event"], monitor["samplerate"], monitor["encoding"])
+                stream_opens += 1
+                logging.debug("Capture started: device #{} {}, {} Hz, {} channels, {}s history".format(device_index, device_name, settings["samplerate"],
+                                                                                                       settings["channels"], settings["history_seconds"]))
+
+        command, params = conn.recv() if conn.poll(write_interval) else (None, {})
+        if command == "quit":
+            break
+        if command == "configure":
+            pending_settings.update(params)
+        elif command == "start":
+            start_request = params
+        elif command == "stop":
+            # Stop before the start was handled (no device): nothing to record
+            start_request = None
+        elif command == "rescan":
+            open_retry = 0.0
+        elif command == "profile":
+            if params["seconds"] > 0:
+                sampler.start(params["seconds"], params["interval"])
+            else:
+                sampler.stop()
+        profile = sampler.pop_result()
+        if profile is not None:
+            send_stats(profile=profile)
+        if len(pending_settings) > 0 and wf is None and armed is False:
+            # New settings are applied between the recordings
+            reopen = any(pending_settings.get(key) != settings.get(key) for key in ("channels", "samplerate", "history_seconds", "squelch"))
+            settings.update(pending_settings)
+            tuning.split = settings["split_on_tuning"]
+            guard = create_disk_guard(settings["disk_guard"], settings["folder"]) if settings.get("disk_guard") else None
+            pending_settings = {}
+            if reopen:
+                close_capture()
+                open_retry = 0.0
+                continue
+        if capture is None:
+            continue
+
+        # Live data always goes to the history tail first, so the history and the live stream are contiguous
+        tuning.poll(capture)
+        with read_time.time():
+            data = capture.read()
+        history.append(data)
+
+        if guard is not None and (wf is not None or armed or start_request is not None):
+            # The recording is stopped before the disk is full, or the oldest files are deleted
+            if guard.check(time.monotonic(), wf.filenames if wf is not None else (), force=start_request is not None) is False:
+                logging.warning("Recording stopped: the disk is full")
+                if wf is not None:
+                    stop_recording(flush=armed is False)
+                start_request, armed, burst_writing, gate = None, False, False, None
+                send_stats(disk_full=True)
+            removed = guard.pop_removed()
+            if len(removed) > 0:
+                send_stats(files_removed=removed)
+
+        if start_request is not None and settings.get("squelch") and armed is False:
+            # Squelch mode: the detector starts with the new data, the files are created for the bursts
+            sq = settings["squelch"]
+            gate = squelch.SquelchGate(settings["samplerate"], settings["channels"], sq["threshold_db"], sq["pre_roll"], sq["hang_time"], sq["min_event"])
+            tuning.state.update(name=start_request["name"], frequency=start_request["frequency"], mode=start_request["mode"])
+            armed, burst_writing, size_total = True, False, 0
+            start_latency = time.monotonic() - start_request["time"]
+            start_request = None
+            logging.debug("Squelch armed: {} dB above the noise floor".format(sq["threshold_db"]))
+        elif armed:
+            gate.process(data, capture.frames_read() - len(data)//capture.frame_size)
+            write_bursts()
+            if command == "stop":
+                if wf is not None:
+                    stop_recording(flush=False)
+                armed, burst_writing, gate = False, False, None
+        elif start_request is not None and wf is None:
+            # The file starts at the request time minus the history
+            start_frame = capture.frame_at(start_request["time"]) - history_frames()
+            history.pop(max(0, start_frame - (capture.frames_read() - history.frames())))
+            tuning.discard(capture.frames_read() - history.frames())
+            tuning.state.update(name=start_request["name"], frequency=start_request["frequency"], mode=start_request["mode"])
+            filename, wf = create_file()
+            size_total = 0
+            logging.debug('Recording the file {} with {:.1f}s of history'.format(filename, history.frames()/settings["samplerate"]))
+
+        if armed:
+            pass
+        elif wf is None:
+            # Keep the history and the data of one pass, a start request can come at any moment of it
+            history.pop(max(0, history.frames() - history_frames() - int(write_interval*settings["samplerate"])))
+            tuning.discard(capture.frames_read() - history.frames())
+        else:
+            # Write the history in 1s blocks, draining the capture buffer between writes
+            while history.count > 0:
+                start_frame = capture.frames_read() - history.frames()
+                data = history.pop(settings["samplerate"])
+                with write_time.time():
+                    tuning.write(wf, data, start_frame)
+                size_total += len(data)
+                with read_time.time():
+                    data = capture.read()
+                history.append(data)
+            if start_request is not None:
+                start_latency = time.monotonic() - start_request["time"]
+                start_request = None
+                send_stats()
+            if command == "stop":
+                stop_recording()
+
+        index += 1
+        if index*write_interval >= 2.0:
+            send_stats()
+            index = 0
+
+    if capture is not None:
+        if spectrum_stop is not None:
+            spectrum_stop.set()
+        if monitor_stop is not None:
+            monitor_stop.set()
+        capture.close()
+        data = capture.read()
+        history.append(data)
+        if armed:
+            gate.process(data, capture.frames_read() - len(data)//capture.frame_size)
+            write_bursts()
+        if wf is not None:
+            stop_recording(flush=armed is False)
+    pd.terminate()
+    logging.debug("Capture worker stopped")
+
+
+def create_disk_guard(params: dict, folder: str) -> storage.DiskGuard:
+    # The rotation deletes the recordings through the catalog, the process has its own connection to the database
+    folder = folder or "."
+    recordings = catalog.RecordingsCatalog(folder) if params.get("action") == "rotate" else None
+    return storage.DiskGuard(folder, recordings=recordings, **params)
+
+
+class CaptureWorker:
+    # Parent side of the capture process
+    def __init__(self, audio_device: str, stats_queue: multiprocessing.Queue, tuning_queue: multiprocessing.Queue,
+                 spectrum_queue: Optional[multiprocessing.Queue] = None, spectrum_event: Optional[multiprocessing.Event] = None, spectrum_fps: float = 10.0,
+                 cpu_core: Optional[int] = None, monitor: Optional[dict] = None):
+        # monitor: None, or the live listening ring (live.SharedRing), event (set while there are listeners), samplerate and encoding
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=capture_worker, args=(audio_device, child_conn, stats_queue, tuning_queue,
+                                                                            spectrum_queue, spectrum_event, spectrum_fps, cpu_core, monitor))
+        self.process.start()
+
+    def configure(self, channels: int, samplerate: int, history_seconds: float, writer_options: dict, split_on_tuning: bool, squelch: Optional[dict] = None,
+                  decimate: bool = False, disk_guard: Optional[dict] = None, folder: str = ""):
+        # squelch: None, or threshold_db, pre_roll, hang_time, min_event and split (a file per burst, otherwise one file with the burst index).
+        # decimate: narrow modes are recorded at a lower sample rate, see decimator.mode_profiles.
+        # disk_guard: None, or storage.DiskGuard parameters (reserve, action).
+        # folder: the recordings are created there, "" - the current folder
+        self.conn.send(("configure", {"channels": channels, "samplerate": samplerate, "history_seconds": history_seconds,
+                                      "writer_options": writer_options, "split_on_tuning": split_on_tuning, "squelch": squelch, "decimate": decimate,
+                                      "disk_guard": disk_guard, "folder": folder}))
+
+    def record_start(self, name: str, frequency: int, mode: str):
+        self.conn.send(("start", {"name": name, "frequency": frequency, "mode": mode, "time": time.monotonic()}))
+
+    def record_stop(self):
+        self.conn.send(("stop", {}))
+
+    def rescan(self):
+        # Sound card hotplug: look for the device now, if the stream is not open
+        self.conn.send(("rescan", {}))
+
+    def profile(self, seconds: float, interval: float = 0.01):
+        # Sampling profile of the capture process, sent back with the statistics ("profile"). 0 seconds - stop now
+        self.conn.send(("profile", {"seconds": seconds, "interval": interval}))
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def close(self, timeout: float = 5.0):
+        if self.process.is_alive():
+            self.conn.send(("quit", {}))
+            self.process.join(timeout=timeout)